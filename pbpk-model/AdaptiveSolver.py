@@ -1,207 +1,191 @@
 import numpy as np
-import matplotlib.pyplot as plt
-
-
-class AdaptiveSolver:
-    def __init__(self, encoder):
-        self.SystemMat = encoder.SystemMat.copy()
-        self.BigVect = encoder.BigVect.copy()
-        self.organsObj = encoder.organsObj
-        self.injectionProfile = self.organsObj.therapy.injectionProfile
-
-        self.setSimConf()
-        self.setInjection()
-
-        self.BigVectList = np.zeros((self.BigVect.shape[0], self.dataPoints))
-        self.inject(0)  ## Doing the very first Injection
-        self.BigVectList[:,0] = self.BigVect.copy()
-
-
-
-
-    def setInjection(self):
-        self.totalHot = 0.0
-        self.totalCold = 0.0
-        Vein_dict = self.organsObj.organsDict["ArtVein"]["Vein"]
-        self.Vein_index_cold = Vein_dict["stencil"]["base"] + Vein_dict["bigVectMap"]["P"]  ## the place of P_vein in the BigVect
-        self.Vein_index_hot = Vein_dict["stencil"]["base"] + Vein_dict["bigVectMap"]["P*"]  ## the place of P_vein in the BigVect
-        if self.injectionProfile["type"] == "constant":
-            t0 = self.injectionProfile["t0"]
-            tf = self.injectionProfile["tf"]
-            self.toInjectAtEachTimeStep_Hot = self.injectionProfile["totalAmountHot"]*self.h / (tf - t0)    ## injection amount at each time step
-            self.toInjectAtEachTimeStep_Cold = self.injectionProfile["totalAmountCold"]*self.h / (tf - t0)    ## injection amount at each time step
-
-        if self.injectionProfile["type"] == "bolus":
-            self.singleBolusFlag = 0    ## This will help us to make sure that just one bolus will be injected
-
-        if self.injectionProfile["type"] == "bolusTrain":
-            self.multiBolusFlag = 0     ## This will help us to inject exactly N boluses
-            self.eachBolusCold = self.injectionProfile["totalAmountCold"] / self.injectionProfile["N"]
-            self.eachBolusHot = self.injectionProfile["totalAmountHot"] / self.injectionProfile["N"]
-
-
-
-    def setSimConf(self):
-        t_0 = 0
-        self.dataPoints = 5000
-        self.tList = np.zeros(self.dataPoints)
-        self.h = 0.01
-        self.e = 1e-7
-        self.h_new = 0
-        self.h_min = 0.01
-
-    def F(self, X, i):
-        SystemMat = self.getSystemMat(X, i)
-        return np.matmul(SystemMat, X)
-
-    def getSystemMat(self, X, i):
-        SystemMat = self.SystemMat.copy()
-        ## TODO: Kidney needs to be added as well
-        for key in self.organsObj.organsDict["RecPos"].keys():  ## RecPos Organs: Tumor, Liver, Kidney, etc
-            organ = self.organsObj.organsDict["RecPos"][key]
-            BigVector_pre = self.BigVectList[:,i-1].copy()
-            RP_index = organ["stencil"]["base"] + organ["bigVectMap"]["RP"]
-            RP_unlabeled_index = organ["stencil"]["base"] + organ["bigVectMap"]["RP*"]
-            K_on_pre = (organ["R0"] - (BigVector_pre[RP_index] + BigVector_pre[RP_unlabeled_index])) * organ["k_on"]
-            K_on = (organ["R0"] - (X[RP_index] + X[RP_unlabeled_index])) * organ["k_on"]
-            for elem in organ["sysMatMap"]["K_on"]:
-                sign = elem[-1]
-                pos = np.array(elem[:-1]) + organ["stencil"]["base"]
-                SystemMat[pos[0], pos[1]] += sign*(K_on - K_on_pre)
-
-        return SystemMat
-
+from scipy.optimize import OptimizeResult
+
+from StiffSolver import StiffSolver
+from TrajectoryRecorder import TrajectoryRecorder
+
+
+class AdaptiveSolver(StiffSolver):
+    """
+    Explicit adaptive Runge-Kutta solver: Dormand-Prince 5(4) with a PI step size controller.
+
+    It is meant for the non-stiff part of a run (e.g. the first minutes of an infusion, the horizon of the fixed step
+    Solver), where it needs a small fraction of the RHS calls of RK4 at the same accuracy. Over the long clearance
+    phase the step is limited by the stability of the fast compartments, where the implicit StiffSolver methods are
+    much cheaper.
+
+    - FSAL: the last stage of a step is the right hand side at the new state, so an accepted step costs 6 RHS calls
+      and a rejected one reuses the first stage.
+    - The local error is the difference of the 5th and 4th order solutions in the RMS norm scaled by
+      atol + rtol * max(|y|, |y_new|), and the step size is set by the PI controller of Hairer's DOPRI5 (no increase
+      right after a rejection).
+    - Dense output: the 4th order continuous extension of every step, so SolverResults evaluates the solution at any
+      time between the steps.
+
+    The model, the injection schedule and the results are the ones of the StiffSolver. The accepted steps are also
+    streamed to the recorder (a TrajectoryRecorder, which grows with the run), and tList / BigVectList are its
+    memory-mapped records after solve.
+    """
+    ## Butcher tableau of Dormand-Prince 5(4)
+    nodes = np.array([0, 1 / 5, 3 / 10, 4 / 5, 8 / 9, 1])
+    stageWeights = [np.array([]),
+                    np.array([1 / 5]),
+                    np.array([3 / 40, 9 / 40]),
+                    np.array([44 / 45, -56 / 15, 32 / 9]),
+                    np.array([19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729]),
+                    np.array([9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656])]
+    weights = np.array([35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84])
+    ## Difference of the 5th and 4th order weights (with the FSAL stage)
+    errorWeights = np.array([-71 / 57600, 0, 71 / 16695, -71 / 1920, 17253 / 339200, -22 / 525, 1 / 40])
+    ## Continuous extension: y(t_old + x h) = y_old + h K^T denseWeights [x, x^2, x^3, x^4]
+    denseWeights = np.array([
+        [1, -8048581381 / 2820520608, 8663915743 / 2820520608, -12715105075 / 11282082432],
+        [0, 0, 0, 0],
+        [0, 131558114200 / 32700410799, -68118460800 / 10900136933, 87487479700 / 32700410799],
+        [0, -1754552775 / 470086768, 14199869525 / 1410260304, -10690763975 / 1880347072],
+        [0, 127303824393 / 49829197408, -318862633887 / 49829197408, 701980252875 / 199316789632],
+        [0, -282668133 / 205662961, 2019193451 / 616988883, -1453857185 / 822651844],
+        [0, 40617522 / 29380423, -110615467 / 29380423, 69997945 / 29380423]])
+
+    ## PI controller of DOPRI5: h_new = h * err^-alpha * errOld^beta * safety, limited to [h / 5, 10 h]
+    beta = 0.04
+    alpha = 0.2 - 0.75 * beta
+    safety = 0.9
+    minFactor = 0.2
+    maxFactor = 10.0
+
+    def __init__(self, encoder, useSparse=True, recorder=None, rtol=1e-6, atol=1e-9, t_f=75, maxStep=np.inf,
+                 outputTimes=None, monitor=None):
+        super().__init__(encoder, useSparse=useSparse, outputTimes=outputTimes, rtol=rtol, atol=atol, monitor=monitor)
+        self.method = "DOPRI5"
+        self.t_f = t_f  ## End of the run (min), the fixed step Solver horizon by default
+        self.maxStep = maxStep
+        if recorder is None:
+            recorder = TrajectoryRecorder(self.BigVect.shape[0])
+        self.recorder = recorder
+
+    def getNorm(self, x, scale):
+        return np.sqrt(np.mean((x / scale) ** 2))
+
+    def getInitialStep(self, t, X, f0, t_end):
+        ## Starting step of Hairer and Wanner (Solving ODEs I, II.4)
+        scale = self.atol + self.rtol * np.abs(X)
+        d0 = self.getNorm(X, scale)
+        d1 = self.getNorm(f0, scale)
+        h0 = 1e-6 if d0 < 1e-5 or d1 < 1e-5 else 0.01 * d0 / d1
+        h0 = min(h0, t_end - t)
+        f1 = self.F(t + h0, X + h0 * f0)
+        d2 = self.getNorm(f1 - f0, scale) / h0
+        if max(d1, d2) <= 1e-15:
+            h1 = max(1e-6, h0 * 1e-3)
+        else:
+            h1 = (0.01 / max(d1, d2)) ** (1 / 5)
+        return min(100 * h0, h1, self.maxStep, t_end - t)
+
+    def step(self, t, X, f0, h):
+        ## One Dormand-Prince step: (X_new, f_new, stages K (7, N), error norm)
+        K = np.empty((7, X.shape[0]))
+        K[0] = f0
+        for s in range(1, 6):
+            K[s] = self.F(t + self.nodes[s] * h, X + h * (self.stageWeights[s] @ K[:s]))
+        X_new = X + h * (self.weights @ K[:6])
+        K[6] = self.F(t + h, X_new)
+        scale = self.atol + self.rtol * np.maximum(np.abs(X), np.abs(X_new))
+        return X_new, K[6], K, self.getNorm(h * (self.errorWeights @ K), scale)
+
+    def integrateSegment(self, t_start, t_end, X):
+        ## The post-injection state starts a new record when a bolus changed it
+        if self.recorder.count == 0 or not np.array_equal(self.recorder.getPrevious(), X):
+            self.recorder.append(t_start, X)
+
+        f = self.F(t_start, X)
+        nfev = 1
+        if self.firstStep is None:
+            h = self.getInitialStep(t_start, X, f, t_end)
+            nfev += 1
+        else:
+            h = self.firstStep
+        errorOld = 1e-4
+        rejected = False
+        nrejected = 0
+        t = t_start
+        tList = [t_start]
+        XList = [X.copy()]
+        QList = []
+        success = True
+        while t < t_end:
+            if h < 10 * np.spacing(t_end):
+                success = False
+                break
+            lastStep = t + h >= t_end
+            if lastStep:
+                h = t_end - t
+            X_new, f_new, K, error = self.step(t, X, f, h)
+            nfev += 6
+            errorAlpha = max(error, 1e-10) ** self.alpha
+
+            if error > 1:
+                nrejected += 1
+                rejected = True
+                h = h / min(1 / self.minFactor, errorAlpha / self.safety)
+                continue
+
+            factor = min(1 / self.minFactor, max(1 / self.maxFactor, errorAlpha / errorOld ** self.beta / self.safety))
+            h_new = min(h / factor, self.maxStep)
+            if rejected:
+                h_new = min(h_new, h)
+            errorOld = max(error, 1e-4)
+            rejected = False
+
+            QList.append(K.T @ self.denseWeights)
+            t = t_end if lastStep else t + h
+            X = X_new
+            f = f_new
+            tList.append(t)
+            XList.append(X.copy())
+            self.recorder.append(t, X)
+            if self.monitor is not None:
+                self.monitor.addStep(t, X, XList[-2] + h * (QList[-1] @ [1 / 2, 1 / 4, 1 / 8, 1 / 16]))
+            h = h_new
+
+        tList = np.array(tList)
+        y = np.stack(XList, axis=1)
+        return OptimizeResult(t=tList, y=y, sol=DormandPrinceInterpolant(tList, XList, QList), nfev=nfev, njev=0,
+                              nlu=0, nrejected=nrejected, success=success)
+
+    def reset(self):
+        ## A new run is recorded by a new recorder of the same kind, the records of the earlier run stay valid
+        super().reset()
+        if self.recorder.count:
+            self.recorder = self.recorder.getEmpty()
 
     def solve(self):
-        for j, t in enumerate(self.tList[:-1]):
-            i = j+1
-            self.inject(t)
-            flag = 0
-            while flag == 0:
-                # y = self.BigVectList[:,i-1].copy()
-                y = self.BigVect.copy()
-                f0 = self.F(y,i)
-                f1 = self.F(y + f0*self.h/4, i)
-                f2 = self.F(y + 3*self.h/32*f0 + 9*self.h/32*f1, i)
-                f3 = self.F(y + 1932*self.h/2197*f0 - 7200*self.h/2197*f1 + 7296*self.h/2197*f2, i)
-                f4 = self.F(y + 439*self.h/216*f0 - 8*self.h*f1 + 3680*self.h/513*f2 - 845*self.h/4104*f3, i)
-                f5 = self.F(y - 8*self.h/27*f0 + 2*self.h*f1 - 3544*self.h/2565*f2 + 1859*self.h/4104*f3 - 11*self.h/40*f4, i)
-
-                # Err = np.linalg.norm(self.h * (1/360*f0 - 128/4275*f2 - 2197/75240*f3 + 1/50*f4 + 2/55*f5))
-                Err = np.abs(np.max(self.h * (1/360*f0 - 128/4275*f2 - 2197/75240*f3 + 1/50*f4 + 2/55*f5)))
-                MaxErr = np.abs(self.h * self.e)
-                ratio = MaxErr / Err
-
-                self.h_new = 0.9 * self.h * np.power(ratio, 1/4)
-                # print( np.power(ratio, 1/4))
-
-                # if self.h_new < self.h_min:
-                #     self.h_new = self.h_min
-
-                # if ratio < 1:
-                if self.h_new < self.h:
-                    if self.h_new < 0.5*self.h:
-                        self.h_new = 0.5 * self.h
-                    self.h = self.h_new
-                else:
-                    # print("Hely")
-                    # if self.h_new > 4 * self.h:
-                    #     self.h_new = 4 * self.h
-                    flag = 1
-
-
-                # if self.h_new < self.h:
-                #     # if self.h_new < 0.1*self.h:
-                #     #     print("hello")
-                #     #     self.h_new = 0.1*self.h
-                #     #     pass
-                #     # else:
-                #     #     self.h = self.h_new
-                #     self.h = self.h_new
-                # else:
-                #     # if self.h_new > 100*self.h:
-                #     #     self.h_new = 100*self.h
-                #     #     pass
-                #     # else:
-                #     #     self.h = self.h_new
-                #
-                #     #self.h = self.h_new
-                #     flag = 1
-
-            # if self.h < self.h_min:
-            #     self.h = self.h_min
-
-            y += self.h * (16/135*f0 + 6656/12825*f2 + 28561/56430*f3 - 9/50*f4 + 2/55*f5)
-            self.BigVect = y.copy()
-            t_new = t + self.h
-            self.BigVectList[:,i] = self.BigVect.copy()
-            self.tList[i] = t_new
-            self.SystemMat = self.getSystemMat(self.BigVect, i)
-            self.h = self.h_new
-
-            # print(j)
-            if j%1000 == 0:
-                print(j)
-
-
-
-
-
-            # self.BigVect += 1/6 * (f0 + 2*f1 + 2*f2 + f3)
-            # self.BigVect = self.BigVect + self.h/6 * (f0 + 2*f1 + 2*f2 + f3)
-            # #self.SystemMat = self.getSystemMat(self.BigVect,i)
-            # self.SystemMat = self.getSystemMat(self.BigVect,i)
-            #
-            # #self.BigVectList[:,i+1] = self.BigVect.copy()
-            # self.BigVectList[:,i] = self.BigVect.copy()
-
-
-        ####  Debugging
-        # debugList = [9,11,13,15]
-        # peptide = self.BigVectList[0,:]*0
-        # for i in debugList:
-        #     peptide += self.BigVectList[i,:]
-        print("Hello")
-
-
-    def inject(self, t):
-        if self.injectionProfile["type"] == "constant":
-            if t < self.injectionProfile["tf"]:
-                self.BigVect[self.Vein_index_cold] += self.toInjectAtEachTimeStep_Cold
-                self.BigVect[self.Vein_index_hot] += self.toInjectAtEachTimeStep_Hot
-                self.totalHot += self.toInjectAtEachTimeStep_Hot
-                self.totalCold += self.toInjectAtEachTimeStep_Cold
-
-        if self.injectionProfile["type"] == "bolus":
-            if t >= self.injectionProfile["t0"] and self.singleBolusFlag == 0:
-                self.BigVect[self.Vein_index_cold] += self.injectionProfile["totalAmountCold"]
-                self.BigVect[self.Vein_index_hot] += self.injectionProfile["totalAmountHot"]
-                self.totalCold += self.injectionProfile["totalAmountCold"]
-                self.totalHot += self.injectionProfile["totalAmountHot"]
-                self.singleBolusFlag = 1
-
-        ## TODO: I think I need to fix something. when I only have
-        ## RecNeg organ, with 5 bolus trains and total amount of 10,
-        ## instead of 10*2 total peptide in body (cold + disintegerated hot), I get
-        ## 5 * (10*2). There must be something wrong
-        if self.injectionProfile["type"] == "bolusTrain":
-            if self.multiBolusFlag != self.injectionProfile["N"]:
-                if t >= self.injectionProfile["t"][self.multiBolusFlag]:
-                    self.BigVect[self.Vein_index_cold] += self.eachBolusCold
-                    self.BigVect[self.Vein_index_hot] += self.eachBolusHot
-                    self.totalCold += self.eachBolusCold
-                    self.totalHot += self.eachBolusHot
-                    self.multiBolusFlag += 1
-
-
-
-
-
-
-
-
-
-
-
-
-
+        super().solve()
+        self.tList = self.recorder.getTimes()
+        self.BigVectList = self.recorder.getStates().T
+
+    def fork(self):
+        ## The steps of the fork are recorded by a new recorder of the same kind (starting at the fork)
+        child = super().fork()
+        child.recorder = TrajectoryRecorder(self.BigVect.shape[0], chunkSize=self.recorder.chunk.shape[0],
+                                            float32=self.recorder.dtype == np.float32,
+                                            history=self.recorder.ring.shape[0])
+        return child
+
+
+class DormandPrinceInterpolant:
+    ## Dense output of the accepted steps of a segment (the continuous extension of each step)
+    def __init__(self, tList, XList, QList):
+        self.tList = np.asarray(tList, dtype=float)
+        self.Y = np.stack(XList)
+        self.Q = np.stack(QList) if len(QList) else np.zeros((0, self.Y.shape[1], 4))
+
+    def __call__(self, t):
+        t = np.atleast_1d(np.asarray(t, dtype=float))
+        if self.Q.shape[0] == 0:
+            return np.repeat(self.Y[:1].T, t.shape[0], axis=1)
+        k = np.clip(np.searchsorted(self.tList, t, side="right") - 1, 0, self.Q.shape[0] - 1)
+        h = self.tList[k + 1] - self.tList[k]
+        x = (t - self.tList[k]) / h
+        powers = np.stack([x, x ** 2, x ** 3, x ** 4], axis=1)
+        return (self.Y[k] + h[:, None] * np.einsum("kij,kj->ki", self.Q[k], powers)).T
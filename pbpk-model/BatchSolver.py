@@ -0,0 +1,261 @@
+import time
+
+import numpy as np
+from scipy import sparse
+from scipy.integrate import solve_ivp
+
+from InjectionSchedule import InjectionSchedule
+from SolverStats import SolverStats
+
+
+class BatchSolver:
+    """
+    Virtual population mode: integrates M encoded patients at once.
+
+    The states of the patients are stacked into an (M, N) array and the right hand side is evaluated for all of them
+    together: SystemMat is a block diagonal sparse matrix (one block per patient) and the receptor binding terms are
+    computed with the index arrays of the BindingEncoder, which are the same for every patient. The implicit methods
+    of solve_ivp get the block diagonal analytic Jacobian, "RK4" integrates the batch with the fixed step h. RK4 is
+    only stable for h below about 0.01 min (the fastest compartments of the model), so its run ends at t_f = 75 min
+    by default (the horizon of the fixed step Solver), the implicit methods run to 100000 min.
+
+    All patients must have the same organs (so the same BigVect layout) and the same kind of injection profile with
+    the same injection times. The injected amounts can be different for each patient. Boluses are applied between
+    two smooth integration segments and constant infusions are a rate source term (see InjectionSchedule).
+
+    rtol and atol are the tolerances of every patient, as for a StiffSolver. The error norm of solve_ivp is an RMS
+    over all the M*N components of the batch, so the error of one patient could be up to sqrt(M) times the batch
+    norm: the implicit methods get the tolerances divided by sqrt(M).
+    """
+    def __init__(self, encoders, method="BDF", useJacobian=True, outputTimes=None, t_f=None, h=0.005, rtol=1e-3,
+                 atol=1e-6):
+        self.encoders = encoders
+        self.M = len(encoders)
+        self.organsObj = encoders[0].organsObj
+        self.N = self.organsObj.N
+        self.method = method    ## BDF, Radau, LSODA or RK4 (fixed step)
+        self.useJacobian = useJacobian
+        self.rtol = rtol    ## Tolerances of each patient (see above)
+        self.atol = atol
+        self.stats = SolverStats(countsRejections=self.method == "RK4")
+
+        self.checkLayout()
+        self.setSimConf(outputTimes, t_f, h)
+        self.setSystemMat()
+        self.setBinding()
+        self.setJacobian()
+        self.setInjection()
+
+        self.BigVect = np.stack([encoder.BigVect for encoder in encoders])  ## (M, N)
+
+    def setPatients(self, indices, encoders):
+        ## Replaces the patients of the rows `indices` by new encoders with the same layout and injection times. Only
+        ## their blocks of SystemMat and JacobianPattern and their rows of the binding parameters and of BigVect are
+        ## rewritten, unless a new block has another sparsity pattern (then the block diagonal matrices are rebuilt)
+        for m, encoder in zip(indices, encoders):
+            self.encoders[m] = encoder
+        self.checkLayout()
+        samePattern = True
+        for m, encoder in zip(indices, encoders):
+            samePattern &= setBlock(self.SystemMat, m, encoder.SystemMatSparse)
+            samePattern &= setBlock(self.JacobianPattern, m, encoder.JacobianPattern)
+            self.kOnPerVolume[m] = encoder.bindingEncoder.kOnPerVolume
+            self.R0[m] = encoder.bindingEncoder.R0
+            self.BigVect[m] = encoder.BigVect
+            self.injectionSchedules[m] = InjectionSchedule(encoder.organsObj.therapy.injectionProfile)
+        self.checkInjectionTimes()
+        if not samePattern:
+            self.setSystemMat()
+            self.setJacobian()
+
+    def checkLayout(self):
+        binding = self.encoders[0].bindingEncoder
+        for encoder in self.encoders[1:]:
+            if encoder.organsObj.N != self.N or not (
+                    np.array_equal(encoder.bindingEncoder.RP, binding.RP) and
+                    np.array_equal(encoder.bindingEncoder.P_int, binding.P_int)):
+                raise ValueError("All patients of a batch must have the same organs (the same BigVect layout)")
+
+    def setSimConf(self, outputTimes, t_f, h):
+        self.t_0 = 0
+        if t_f is None:
+            t_f = 75 if self.method == "RK4" else 100000
+        self.t_f = t_f
+        self.h = h  ## Step of the fixed step RK4 method
+        if outputTimes is None:
+            outputTimes = np.concatenate([[self.t_0], np.logspace(-2, np.log10(self.t_f), 200)])
+        self.outputTimes = np.asarray(outputTimes, dtype=float)
+
+    def setSystemMat(self):
+        self.SystemMat = blockDiagonal([encoder.SystemMatSparse for encoder in self.encoders])
+
+    def setBinding(self):
+        ## The binding indices are shared by all patients, the parameters are (M, K) arrays
+        self.binding = self.encoders[0].bindingEncoder
+        self.kOnPerVolume = np.stack([encoder.bindingEncoder.kOnPerVolume for encoder in self.encoders])
+        self.R0 = np.stack([encoder.bindingEncoder.R0 for encoder in self.encoders])
+        self.B = np.zeros((self.M, self.N))
+
+    def setJacobian(self):
+        ## Block diagonal Jacobian pattern. JacobianDataIndex[m, k] holds the positions of the 12 binding derivatives
+        ## of the k-th receptor organ of patient m in the data array of the block diagonal matrix
+        patterns = [encoder.JacobianPattern for encoder in self.encoders]
+        self.JacobianPattern = blockDiagonal(patterns)
+        offsets = np.concatenate([[0], np.cumsum([pattern.nnz for pattern in patterns])[:-1]])
+        dataIndex = []
+        for encoder, pattern, offset in zip(self.encoders, patterns, offsets):
+            rows, cols = encoder.systemMatricEncoder.getBindingPositions()
+            dataIndex.append(encoder.systemMatricEncoder.getSparseDataIndex(rows, cols, pattern).reshape(-1, 12)
+                             + offset)
+        self.JacobianDataIndex = np.stack(dataIndex)
+
+    def setInjection(self):
+        ## Each patient's injection profile is compiled into an InjectionSchedule. The kind of profile and the
+        ## injection times are shared by the batch, the amounts are (M,) arrays
+        self.injectionSchedules = [InjectionSchedule(encoder.organsObj.therapy.injectionProfile)
+                                   for encoder in self.encoders]
+        self.injectionSchedule = self.injectionSchedules[0]
+        self.checkInjectionTimes()
+
+        self.totalHot = np.zeros(self.M)
+        self.totalCold = np.zeros(self.M)
+
+        Vein_dict = self.organsObj.organsDict["ArtVein"]["Vein"]
+        self.Vein_index_cold = Vein_dict["stencil"]["base"] + Vein_dict["bigVectMap"]["P"]
+        self.Vein_index_hot = Vein_dict["stencil"]["base"] + Vein_dict["bigVectMap"]["P*"]
+        self.rateCold = np.zeros(self.M)
+        self.rateHot = np.zeros(self.M)
+
+    def checkInjectionTimes(self):
+        timeKeys = ["type", "t0", "tf", "N", "t"]
+        for schedule in self.injectionSchedules[1:]:
+            for key in timeKeys:
+                if schedule.injectionProfile.get(key) != self.injectionSchedule.injectionProfile.get(key):
+                    raise ValueError("All patients of a batch must have the same injection type and injection times")
+
+    def inject(self, t, X):
+        ## Apply the boluses at time t and set the infusion rate of the segment that starts at t
+        bolus = np.array([schedule.getBolus(t) for schedule in self.injectionSchedules])    ## (M, 2)
+        X[:, self.Vein_index_cold] += bolus[:, 0]
+        X[:, self.Vein_index_hot] += bolus[:, 1]
+        self.totalCold += bolus[:, 0]
+        self.totalHot += bolus[:, 1]
+
+        rate = np.array([schedule.getRate(t) for schedule in self.injectionSchedules])   ## (M, 2)
+        self.rateCold[:] = rate[:, 0]
+        self.rateHot[:] = rate[:, 1]
+        return X
+
+    def getBFunction(self, X):
+        ## Receptor binding of every receptor organ of every patient, X is (M, N)
+        binding = self.binding
+        rate = self.kOnPerVolume * (self.R0 - (X[:, binding.RP_labeled] + X[:, binding.RP_unlabeled]))
+        flux = np.concatenate([rate, rate], axis=1) * X[:, binding.P_int]
+        self.B[:, binding.RP] = flux
+        self.B[:, binding.P_int] = -flux
+        return self.B
+
+    def F(self, t, x):
+        ## x is the flattened (M*N) state of the batch
+        X = x.reshape(self.M, self.N)
+        dX = (self.SystemMat @ x).reshape(self.M, self.N) + self.getBFunction(X)
+        dX[:, self.Vein_index_cold] += self.rateCold
+        dX[:, self.Vein_index_hot] += self.rateHot
+        return dX.ravel()
+
+    def jac(self, t, x):
+        X = x.reshape(self.M, self.N)
+        binding = self.binding
+        rate = self.kOnPerVolume * (self.R0 - (X[:, binding.RP_labeled] + X[:, binding.RP_unlabeled]))
+        labeled = self.kOnPerVolume * X[:, binding.P_int_labeled]
+        unlabeled = self.kOnPerVolume * X[:, binding.P_int_unlabeled]
+        labeled = np.stack([rate, -labeled, -labeled], axis=2)
+        unlabeled = np.stack([rate, -unlabeled, -unlabeled], axis=2)
+
+        J = self.JacobianPattern.copy()
+        J.data[self.JacobianDataIndex] += np.concatenate([labeled, -labeled, unlabeled, -unlabeled], axis=2)
+        if self.method == "LSODA":  ## LSODA only accepts dense Jacobians
+            return J.toarray()
+        return J
+
+    def solve(self):
+        ## Integrates the smooth segments between the injection breakpoints. The output is stored at outputTimes
+        ## (the value right after a bolus for output times that fall on a bolus). The stats count the steps of the
+        ## whole batch (every step advances all the patients)
+        start = time.perf_counter()
+        self.stats = SolverStats(countsRejections=self.method == "RK4")
+        self.t = self.outputTimes[(self.outputTimes >= self.t_0) & (self.outputTimes <= self.t_f)]
+        self.Y = np.zeros((self.M, self.N, self.t.shape[0]))
+        X = self.BigVect.copy()
+        for a, b in self.injectionSchedule.getSegments(self.t_0, self.t_f):
+            X = self.inject(a, X)
+            outputIndex = np.flatnonzero((self.t >= a) & (self.t < b))
+            if self.method == "RK4":
+                X = self.integrateRK4(a, b, X, outputIndex)
+            else:
+                X = self.integrateImplicit(a, b, X, outputIndex).y[:, -1].reshape(self.M, self.N).copy()
+            self.totalCold += self.rateCold * (b - a)
+            self.totalHot += self.rateHot * (b - a)
+        self.Y[:, :, self.t == self.t_f] = X[:, :, None]
+        self.BigVect = X
+        self.stats.wallTime = time.perf_counter() - start
+
+    def integrateImplicit(self, a, b, X, outputIndex=None):
+        ## solve_ivp result of the (M*N) batch over [a, b] from X, with its dense output written into Y at the
+        ## output times of outputIndex
+        jac = self.jac if self.useJacobian else None
+        scale = 1 / np.sqrt(self.M)
+        solution = solve_ivp(self.F, [a, b], X.ravel(), method=self.method, jac=jac, dense_output=True,
+                             rtol=self.rtol * scale, atol=self.atol * scale)
+        self.stats.addSolveIvp(solution)
+        if outputIndex is not None and outputIndex.shape[0]:
+            self.Y[:, :, outputIndex] = solution.sol(self.t[outputIndex]).reshape(self.M, self.N, -1)
+        return solution
+
+    def integrateRK4(self, a, b, X, outputIndex):
+        ## Fixed step RK4 on the (M, N) batch. Output times between two steps are linearly interpolated
+        steps = max(1, int(np.ceil((b - a) / self.h)))
+        h = (b - a) / steps
+        x = X.ravel().copy()
+        t = a
+        pointer = 0
+        for j in range(steps):
+            f0 = self.F(t, x)
+            f1 = self.F(t + h / 2, x + f0 * h / 2)
+            f2 = self.F(t + h / 2, x + f1 * h / 2)
+            f3 = self.F(t + h, x + f2 * h)
+            x_new = x + h / 6 * (f0 + 2 * f1 + 2 * f2 + f3)
+            while pointer < outputIndex.shape[0] and self.t[outputIndex[pointer]] <= t + h:
+                weight = (self.t[outputIndex[pointer]] - t) / h
+                self.Y[:, :, outputIndex[pointer]] = ((1 - weight) * x + weight * x_new).reshape(self.M, self.N)
+                pointer += 1
+            x = x_new
+            t = a + (j + 1) * h
+        self.stats.addStep(h, count=steps)
+        self.stats.nfev += 4 * steps
+        return x.reshape(self.M, self.N)
+
+
+def setBlock(matrix, m, block):
+    ## Writes the data of block m of a blockDiagonal matrix in place. False (nothing written) when the block has
+    ## another sparsity pattern
+    n = block.shape[0]
+    indptr = matrix.indptr[m * n:(m + 1) * n + 1]
+    start, stop = indptr[0], indptr[-1]
+    if not (np.array_equal(indptr - start, block.indptr) and
+            np.array_equal(matrix.indices[start:stop], block.indices + m * n)):
+        return False
+    matrix.data[start:stop] = block.data
+    return True
+
+
+def blockDiagonal(blocks):
+    ## Block diagonal CSR matrix of same shaped CSR blocks. Unlike scipy.sparse.block_diag, the data of block m is
+    ## kept in its original order (and with its explicit zeros) right after the data of block m-1
+    n = blocks[0].shape[0]
+    nnz = np.array([block.nnz for block in blocks])
+    offsets = np.concatenate([[0], np.cumsum(nnz)[:-1]])
+    data = np.concatenate([block.data for block in blocks])
+    indices = np.concatenate([block.indices + m * n for m, block in enumerate(blocks)])
+    indptr = np.concatenate([block.indptr[:-1] + offset for block, offset in zip(blocks, offsets)] + [[nnz.sum()]])
+    return sparse.csr_matrix((data, indices, indptr), shape=(n * len(blocks), n * len(blocks)))
@@ -0,0 +1,219 @@
+import sys
+import json
+import time
+import platform
+import argparse
+import tracemalloc
+
+import numpy as np
+import scipy
+
+from AdaptiveSolver import AdaptiveSolver
+from Encoder import Encoder
+from ExponentialSolver import ExponentialSolver
+from Patient import Patient
+from Solver import Solver
+from StiffSolver import StiffSolver
+from Therapy import Therapy
+
+
+## Engines of the benchmark: name -> (solver class, options). The tolerances are the settings of each run
+ENGINES = {
+    "BDF": (StiffSolver, {"method": "BDF", "countRejections": True}),
+    "Radau": (StiffSolver, {"method": "Radau", "countRejections": True}),
+    "LSODA": (StiffSolver, {"method": "LSODA"}),
+    "ETD2RK": (ExponentialSolver, dict()),
+    "DOPRI5": (AdaptiveSolver, dict()),
+    "RK4": (Solver, dict())
+}
+## The fixed step Solver integrates the older formulation of the receptor binding (K_on updated in the system matrix
+## from the previous state) over its own time grid, so it is not compared with the reference: only its cost is
+## reported
+LEGACY_ENGINES = {"RK4"}
+
+## Reference problems: a bolus, a constant infusion and a bolus train of Therapy.injectionProfiles
+PROBLEMS = ["bolusInjection", "constantInjection60", "bolusTrainInjection3"]
+
+REFERENCE_OPTIONS = {"method": "Radau", "rtol": 1e-10, "atol": 1e-14}
+
+
+class Benchmark:
+    """
+    Accuracy and cost of every engine and setting on the reference problems.
+
+    The reference solution of each problem is a StiffSolver run at tight tolerance (REFERENCE_OPTIONS). Every other
+    run is compared with it at the same output times (up to the end of the run, the explicit AdaptiveSolver only
+    covers the first minutes) on the labeled amount of each organ: the error of an organ is the maximum absolute
+    difference over time divided by the maximum of its reference amount. The cost of a run is its wall time (best of
+    `repeats`), the peak of the memory allocated during the solve (tracemalloc, measured in a separate run so it does
+    not slow the timed ones) and the counters of its SolverStats.
+
+    The results are plain dictionaries, written as JSON by save, and compare checks them against a baseline file
+    of an earlier run, so a performance change can be judged on the same problems and settings.
+    """
+    def __init__(self, problems=None, engines=None, rtols=(1e-3, 1e-6), atol=1e-9, outputTimes=None, repeats=1,
+                 measureMemory=True):
+        self.problems = PROBLEMS if problems is None else list(problems)
+        self.engines = [name for name in ENGINES if name not in LEGACY_ENGINES] if engines is None else list(engines)
+        self.rtols = list(rtols)
+        self.atol = atol
+        if outputTimes is None:
+            outputTimes = np.concatenate([[0], np.logspace(-2, 5, 200)])
+        self.outputTimes = np.asarray(outputTimes, dtype=float)
+        self.repeats = repeats
+        self.measureMemory = measureMemory
+        self.patient = Patient()
+        self.references = dict()
+        self.results = []
+
+    def getEncoder(self, problem):
+        return Encoder(self.patient, Therapy(0, profileName=problem))
+
+    def getSolver(self, encoder, engine, rtol):
+        solverClass, options = ENGINES[engine]
+        if engine in LEGACY_ENGINES:
+            return solverClass(encoder, **options)
+        return solverClass(encoder, outputTimes=self.outputTimes, rtol=rtol, atol=self.atol, **options)
+
+    def getOrganAmounts(self, organsObj, y):
+        ## {organ: labeled amount at the output times} of the states y (N, T)
+        amounts = dict()
+        for type in organsObj.typesList:
+            for name, organDict in organsObj.organsDict[type].items():
+                base = organDict["stencil"]["base"]
+                indices = [base + shift for variable, shift in organDict["bigVectMap"].items() if "*" in variable]
+                amounts[name] = y[indices].sum(axis=0)
+        return amounts
+
+    def getReference(self, problem):
+        if problem not in self.references:
+            encoder = self.getEncoder(problem)
+            solver = StiffSolver(encoder, outputTimes=self.outputTimes, **REFERENCE_OPTIONS)
+            solver.solve()
+            self.references[problem] = self.getOrganAmounts(encoder.organsObj, solver.solution.y)
+        return self.references[problem]
+
+    def getErrors(self, problem, organsObj, y):
+        reference = self.getReference(problem)
+        amounts = self.getOrganAmounts(organsObj, y)
+        errors = dict()
+        for name, referenceAmount in reference.items():
+            referenceAmount = referenceAmount[:y.shape[1]]
+            scale = np.max(np.abs(referenceAmount))
+            errors[name] = float(np.max(np.abs(amounts[name] - referenceAmount)) / scale) if scale > 0 else 0.0
+        return errors
+
+    def runCase(self, problem, engine, rtol):
+        wallTime = np.inf
+        for _ in range(self.repeats):
+            encoder = self.getEncoder(problem)
+            solver = self.getSolver(encoder, engine, rtol)
+            start = time.perf_counter()
+            solver.solve()
+            wallTime = min(wallTime, time.perf_counter() - start)
+
+        result = {"problem": problem, "engine": engine, "rtol": None if engine in LEGACY_ENGINES else rtol,
+                  "wallTime": wallTime, "peakMemoryMB": None, "errors": None, "maxError": None}
+        for name in ["nsteps", "nrejected", "nfev", "njev", "nlu"]:
+            value = getattr(solver.stats, name)
+            result[name] = None if value is None else int(value)
+        if engine not in LEGACY_ENGINES:
+            result["errors"] = self.getErrors(problem, encoder.organsObj, solver.solution.y)
+            result["maxError"] = max(result["errors"].values())
+
+        if self.measureMemory:
+            encoder = self.getEncoder(problem)
+            solver = self.getSolver(encoder, engine, rtol)
+            tracemalloc.start()
+            solver.solve()
+            result["peakMemoryMB"] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+            tracemalloc.stop()
+        return result
+
+    def run(self):
+        self.results = []
+        for problem in self.problems:
+            for engine in self.engines:
+                ## The legacy engines have no tolerance, they are run once
+                for rtol in ([None] if engine in LEGACY_ENGINES else self.rtols):
+                    self.results.append(self.runCase(problem, engine, rtol))
+        return self.results
+
+    def getReport(self):
+        lines = ["{:<22}{:<8}{:>8}{:>10}{:>9}{:>9}{:>11}{:>11}".format(
+            "problem", "engine", "rtol", "wall (s)", "nsteps", "nfev", "mem (MB)", "max error")]
+        for result in self.results:
+            lines.append("{:<22}{:<8}{:>8}{:>10.3f}{:>9}{:>9}{:>11}{:>11}".format(
+                result["problem"], result["engine"], "-" if result["rtol"] is None else "{:.0e}".format(result["rtol"]),
+                result["wallTime"], result["nsteps"], result["nfev"],
+                "-" if result["peakMemoryMB"] is None else "{:.2f}".format(result["peakMemoryMB"]),
+                "-" if result["maxError"] is None else "{:.2e}".format(result["maxError"])))
+        return "\n".join(lines)
+
+    def save(self, path):
+        document = {"machine": {"platform": platform.platform(), "python": platform.python_version(),
+                                "numpy": np.__version__, "scipy": scipy.__version__},
+                    "reference": REFERENCE_OPTIONS, "atol": self.atol, "repeats": self.repeats,
+                    "results": self.results}
+        with open(path, "w") as file:
+            json.dump(document, file, indent=2)
+
+    def compare(self, baselinePath, timeTolerance=1.2, errorTolerance=2.0):
+        ## Changes against the baseline run of the same (problem, engine, rtol). A run regresses when it is slower
+        ## than timeTolerance times the baseline or its error is larger than errorTolerance times the baseline
+        with open(baselinePath) as file:
+            baseline = {(result["problem"], result["engine"], result["rtol"]): result
+                        for result in json.load(file)["results"]}
+        lines = ["{:<22}{:<8}{:>8}{:>12}{:>12}{:>12}  {}".format("problem", "engine", "rtol", "time ratio",
+                                                                "nfev ratio", "error ratio", "status")]
+        regressions = []
+        for result in self.results:
+            key = (result["problem"], result["engine"], result["rtol"])
+            rtolText = "-" if result["rtol"] is None else "{:.0e}".format(result["rtol"])
+            if key not in baseline:
+                lines.append("{:<22}{:<8}{:>8}{:>12}{:>12}{:>12}  new".format(*key[:2], rtolText, "-", "-", "-"))
+                continue
+            old = baseline[key]
+            timeRatio = result["wallTime"] / old["wallTime"]
+            nfevRatio = result["nfev"] / old["nfev"] if old["nfev"] else np.nan
+            errorRatio = np.nan
+            if result["maxError"] is not None and old["maxError"]:
+                errorRatio = result["maxError"] / old["maxError"]
+            regressed = timeRatio > timeTolerance or errorRatio > errorTolerance
+            if regressed:
+                regressions.append(key)
+            lines.append("{:<22}{:<8}{:>8}{:>12.2f}{:>12.2f}{:>12.2f}  {}".format(
+                *key[:2], rtolText, timeRatio, nfevRatio, errorRatio, "REGRESSION" if regressed else "ok"))
+        return "\n".join(lines), regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Accuracy and cost of the solvers on the reference problems")
+    parser.add_argument("--problems", nargs="+", default=PROBLEMS, choices=list(Therapy(0).injectionProfiles))
+    parser.add_argument("--engines", nargs="+", default=[name for name in ENGINES if name not in LEGACY_ENGINES],
+                        choices=list(ENGINES))
+    parser.add_argument("--rtols", nargs="+", type=float, default=[1e-3, 1e-6])
+    parser.add_argument("--atol", type=float, default=1e-9)
+    parser.add_argument("--repeats", type=int, default=1, help="timed runs of each case, the best one is reported")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc run of each case")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file of the results")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--time-tolerance", type=float, default=1.2)
+    parser.add_argument("--error-tolerance", type=float, default=2.0)
+    args = parser.parse_args(argv)
+
+    benchmark = Benchmark(args.problems, args.engines, args.rtols, args.atol, repeats=args.repeats,
+                          measureMemory=not args.no_memory)
+    benchmark.run()
+    print(benchmark.getReport())
+    benchmark.save(args.output)
+
+    if args.baseline:
+        report, regressions = benchmark.compare(args.baseline, args.time_tolerance, args.error_tolerance)
+        print(report)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
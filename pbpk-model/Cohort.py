@@ -0,0 +1,155 @@
+import numpy as np
+
+from Patient import Patient
+
+
+class Cohort:
+    """
+    Struct-of-arrays of a population of patients: the organ parameters of Patient for all of them at once.
+
+    The covariates are (n,) arrays (see CohortSampler): BW, BSA, H, male (bool), GFR, V_tu, NET (bool, the tumor
+    type) and the receptor densities R_tu_density, R_L_density, R_S_density, R_K_density and R_rest_density. The
+    organ parameters are derived from them with the formulas of Patient, as vectorized array expressions, into
+        organs[organName][paramName]    (n,) array
+    The parameters that are the same for every patient (k_on, lambda_phys, ...) are read only broadcast views of a
+    scalar, so they take no memory. organTypes lists the organ names of each type in the order of Patient.Organs.
+
+    getPatient(i) builds the Patient of the i-th covariates for the rest of the pipeline (Encoder, solvers), and
+    getFlatValues stacks the whole cohort into the (n, P) array of FlatPatient.
+    """
+    covariateNames = ["BW", "BSA", "H", "male", "GFR", "V_tu", "NET", "R_tu_density", "R_L_density", "R_S_density",
+                      "R_K_density", "R_rest_density"]
+
+    def __init__(self, covariates):
+        self.covariates = {name: np.asarray(covariates[name]) for name in self.covariateNames}
+        self.n = self.covariates["BW"].shape[0]
+        self.organs = dict()
+        self.setOrgans()
+
+    def __len__(self):
+        return self.n
+
+    def constant(self, value):
+        return np.broadcast_to(np.float64(value), (self.n,))
+
+    def addOrgan(self, name, parameters):
+        self.organs[name] = {key: value if np.ndim(value) else self.constant(value)
+                             for key, value in parameters.items()}
+
+    def setOrgans(self):
+        ## The formulas of Patient.__init__, on the (n,) covariate arrays
+        c = self.covariates
+        BW, BSA, H, GFR, V_tu = c["BW"], c["BSA"], c["H"], c["GFR"], c["V_tu"]
+        male = c["male"].astype(bool)
+        NET = c["NET"].astype(bool)
+        R_K_density = c["R_K_density"]
+
+        lambda_phys = 7.23 * 1e-5
+        k_on = 0.04 / 0.5
+        k_off = 0.04
+        V_L = 1.811
+        V_S = 0.198
+        V_K = 0.193
+        lambda_rel_NT = 0.7 * 1e-4
+        f_tu = 0.1
+        k_mu = 0.02
+        lambda_rel_tu = 1.5 * 1e-4
+        lambda_intern_tu = 0.001
+        scale = BW / 71     ## Organ volumes scaled with the body weight
+
+        V_p = np.where(male, 2.8, 2.4) * (1 - H) * BSA
+        F = 1.23 * V_p
+        v_tu_int = np.where(NET, 0.3, 0.23)
+        v_tu_v = np.where(NET, 0.1, 0.11)
+        k_tu = np.where(NET, 0.2, 0.31)
+
+        receptor = {"k_on": k_on, "k_off": k_off, "lambda_intern": 1.7 * lambda_intern_tu, "lambda_rel": lambda_rel_NT,
+                    "lambda_phys": lambda_phys, "K_on": 0}
+        self.addOrgan("Tumor", dict(receptor, F=f_tu * (1 - H) * V_tu, PS=k_tu * V_tu, V_total=V_tu,
+                                    V_v=v_tu_v * (1 - H) * V_tu, V_int=v_tu_int * V_tu, lambda_intern=lambda_intern_tu,
+                                    lambda_rel=lambda_rel_tu, R0=c["R_tu_density"] * V_tu))
+        self.addOrgan("Liver", dict(receptor, F=0.065 * F, PS=100 * k_mu * V_L, V_total=V_L, V_v=0.085 * V_L,
+                                    V_int=0.2 * V_L, R0=c["R_L_density"] * V_L))
+        self.addOrgan("Spleen", dict(receptor, F=0.03 * F, PS=100 * k_mu * V_S, V_total=V_S, V_v=0.12 * V_S,
+                                     V_int=0.2 * V_S, R0=c["R_S_density"] * V_S))
+
+        ## Kidney: R0 is scaled with the spleen volume, as in Patient
+        V_int_K = 0.15 * V_K
+        V_v_K = 0.055 * V_K
+        F_fil = GFR * 1.1
+        self.addOrgan("Kidney", dict(receptor, F=0.19 * F, V_total=V_K, V_v=V_v_K, V_int=V_int_K,
+                                     V_intra=(V_K - (V_int_K + V_v_K)) * 2 / 3, R0=R_K_density * V_S, phi=1.1, GFR=GFR,
+                                     f_exc=0.98, F_fil=F_fil, F_R=F_fil * (1 - 0.98)))
+
+        V_total = np.where(male, 0.016, 0.08) * scale
+        self.addOrgan("ProstateUterus", dict(
+            receptor, F=np.where(male, 0.18, 1) * (1 - H) * V_total, PS=np.where(male, 0.1, 0.2) * V_total,
+            V_total=V_total, V_v=np.where(male, 0.04, 0.07) * (1 - H) * V_total,
+            V_int=np.where(male, 0.25, 0.5) * V_total, R0=R_K_density * np.where(male, 0.26, 0.092) * V_total))
+
+        V_total = 0.014 * scale
+        self.addOrgan("Adrenals", dict(receptor, F=6 * (1 - H) * V_total, PS=k_mu * 100 * V_total, V_total=V_total,
+                                       V_v=0.03 * (1 - H) * V_total, V_int=0.24 * V_total,
+                                       R0=R_K_density * 1.65 * V_total))
+
+        ## Organs of a fraction of the serum: (name, total volume / BW * 71, vascular fraction of V_p,
+        ## interstitial to vascular ratio, fraction of F, PS constant / k_mu, receptor density / R_K_density)
+        fractions = [("GI", 0.385 + 0.548 + 0.104 + 0.15, 0.076, 8.8, 0.16, 1, 0.16),
+                     ("RedMarrow", 1.1, 0.04, 3.7, 0.03, 100, 0.028),
+                     ("Muscle", 30.078, 0.14, 5.9, 0.17, 1, 0.0056),
+                     ("Lungs", 1, 0.105, 5.5, 1, 100, None),
+                     ("Skin", 3.408, 0.03, 8.9, 0.05, 1, None),
+                     ("Adipose", 13.465, 0.05, 15.5, 0.05, 1, None),
+                     ("Brain", 1.45, 0.012, 1, 0.04, 0, None),
+                     ("Heart", 0.341, 0.01, 3.7, 0.04, 1, None)]
+        for name, volume, vascular, alpha, flow, k, density in fractions:
+            V_total = volume * scale
+            V_v = vascular * V_p
+            parameters = {"F": flow * F, "PS": k * k_mu * V_total, "V_total": V_total, "V_v": V_v,
+                          "V_int": alpha * V_v, "lambda_phys": lambda_phys}
+            if density is not None:
+                parameters = dict(receptor, R0=R_K_density * density * V_total, **parameters)
+            self.addOrgan(name, parameters)
+
+        ## Bone is the skeleton without the red marrow
+        RedMarrow = self.organs["RedMarrow"]
+        V_v = 0.07 * V_p - RedMarrow["V_v"]
+        V_total = 10.165 * scale - RedMarrow["V_total"]
+        self.addOrgan("Bone", {"F": 0.05 * F, "PS": k_mu * V_total, "V_total": V_total, "V_v": V_v, "V_int": 9.3 * V_v,
+                               "lambda_phys": lambda_phys})
+
+        self.addOrgan("BloodProtein", {"k_pr": 5e-4, "lambda_phys": lambda_phys})
+        self.addOrgan("Art", {"F": F, "V_v": (0.06 + 0.045) * V_p, "lambda_phys": lambda_phys})
+        self.addOrgan("Vein", {"F": F, "V_v": (0.18 + 0.045) * V_p, "lambda_phys": lambda_phys})
+
+        self.organTypes = {"ArtVein": ["Art", "Vein"],
+                           "Lungs": ["Lungs"],
+                           "RecNeg": ["Skin", "Adipose", "Brain", "Heart", "Bone"],
+                           "BloodProtein": ["BloodProtein"],
+                           "RecPos": ["Tumor", "Liver", "Spleen", "RedMarrow", "GI", "Muscle", "ProstateUterus",
+                                      "Adrenals"],
+                           "Kidney": ["Kidney"]}
+
+        ## Rest: the body weight, flow and serum volume that the other tissues do not take (Patient.addRestOrgan)
+        tissues = [name for type in ["RecNeg", "RecPos", "Kidney"] for name in self.organTypes[type]]
+        V_total = BW - sum(self.organs[name]["V_total"] for name in tissues)
+        V_v = V_p - sum(self.organs[name]["V_v"] for name in tissues)
+        self.addOrgan("Rest", dict(receptor, F=F - sum(self.organs[name]["F"] for name in tissues), PS=k_mu * V_total,
+                                   V_total=V_total, V_v=V_v, V_int=3.7 * V_v, R0=c["R_rest_density"] * V_total))
+        self.organTypes["RecPos"].append("Rest")
+
+    def getFlatValues(self, schema):
+        ## (n, P) array of the organ parameters in the layout of a ParameterSchema (see FlatPatient)
+        values = np.empty((self.n, schema.size))
+        for i, (organName, paramName) in enumerate(schema.names):
+            values[:, i] = self.organs[organName][paramName]
+        return values
+
+    def getCovariates(self, i):
+        return {name: self.covariates[name][i].item() for name in self.covariateNames}
+
+    def getPatient(self, i):
+        covariates = self.getCovariates(i)
+        covariates["gender"] = "male" if covariates.pop("male") else "female"
+        covariates["tumorType"] = "NET" if covariates.pop("NET") else "MEN"
+        return Patient(**covariates)
@@ -0,0 +1,107 @@
+import zlib
+
+import numpy as np
+from scipy import stats
+from scipy.stats import qmc
+
+from Cohort import Cohort
+
+
+def truncatedNormal(mean, sd, low, high):
+    return stats.truncnorm((low - mean) / sd, (high - mean) / sd, loc=mean, scale=sd)
+
+
+def allometricBSA(covariates, sigma=0.06):
+    ## Conditional distribution of BSA (m^2) given BW (kg): log-normal around the allometric fit
+    ## BSA = 0.1173 BW^0.6466 of Livingston and Lee (2001)
+    return stats.lognorm(sigma, scale=0.1173 * covariates["BW"] ** 0.6466)
+
+
+## Default covariate distributions, around the reference patient of Patient (frozen scipy.stats distributions or
+## constants)
+defaultDistributions = {
+    "BW": truncatedNormal(80, 15, 45, 150),             ## kg
+    "BSA": truncatedNormal(1.94, 0.2, 1.4, 2.6),        ## m^2
+    "H": truncatedNormal(0.1, 0.02, 0.05, 0.2),
+    "GFR": truncatedNormal(0.11, 0.025, 0.03, 0.2),     ## L/min
+    "V_tu": stats.lognorm(0.8, scale=0.087),            ## L
+    "R_tu_density": stats.lognorm(0.5, scale=15),       ## nmol/L
+    "R_L_density": stats.lognorm(0.3, scale=1.4),
+    "R_S_density": stats.lognorm(0.3, scale=8.7),
+    "R_K_density": stats.lognorm(0.3, scale=6.5),
+    "R_rest_density": stats.lognorm(0.3, scale=0.5)
+}
+
+
+class CohortSampler:
+    """
+    Draws virtual populations: the covariates of n patients, returned as a Cohort (struct-of-arrays).
+
+    Every continuous covariate of Cohort.covariateNames has a distribution: a frozen scipy.stats distribution (its
+    ppf maps the uniform samples on the covariate), a constant, or a conditional distribution, i.e. a function of the
+    covariates drawn so far (the ones before it in Cohort.covariateNames, as (n,) arrays) that returns a frozen
+    distribution with array parameters, e.g. allometricBSA for a BSA that follows BW. gender and tumor type are drawn
+    with the probabilities maleFraction and NETFraction. The uniform samples come from
+        "random"    independent draws
+        "lhs"       a Latin hypercube (scipy.stats.qmc.LatinHypercube)
+        "sobol"     a scrambled Sobol sequence (scipy.stats.qmc.Sobol, balanced for n a power of 2)
+    over all the covariates that are drawn.
+
+    The random streams are reproducible: with "random" every covariate has its own stream, derived from the seed (an
+    int or a numpy SeedSequence) and the name of the covariate, so adding or removing a covariate does not change
+    the draws of the others. "lhs" and "sobol" draw one design over all the covariates from a stream of its own (so
+    its points change with the set of covariates). Successive calls of sample continue the streams, and spawn(k)
+    gives k samplers with independent child streams (e.g. for parallel workers).
+    """
+    def __init__(self, distributions=None, maleFraction=0.5, NETFraction=1.0, method="random", seed=None):
+        self.distributions = dict(defaultDistributions)
+        if distributions is not None:
+            self.distributions.update(distributions)
+        self.probabilities = {"male": maleFraction, "NET": NETFraction}
+        self.method = method
+        self.seedSequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+
+        ## Covariates drawn from a uniform sample, in a fixed order (the dimensions of the designs)
+        self.sampledNames = [name for name in Cohort.covariateNames
+                             if name in self.probabilities or not np.isscalar(self.distributions[name])]
+        self.rngs = {name: np.random.default_rng(self.getStream(name)) for name in self.sampledNames}
+        self.engine = None
+        designRng = np.random.default_rng(self.getStream("design"))
+        if method == "lhs":
+            self.engine = qmc.LatinHypercube(len(self.sampledNames), seed=designRng)
+        elif method == "sobol":
+            self.engine = qmc.Sobol(len(self.sampledNames), seed=designRng)
+        elif method != "random":
+            raise ValueError("Unknown sampling method: {}".format(method))
+
+    def getStream(self, name):
+        ## Seed sequence of the stream of a covariate (or of the "design"), keyed by a stable hash of the name
+        return np.random.SeedSequence(self.seedSequence.entropy, spawn_key=self.seedSequence.spawn_key + (
+            zlib.crc32(name.encode()),), pool_size=self.seedSequence.pool_size)
+
+    def spawn(self, k):
+        return [CohortSampler(self.distributions, self.probabilities["male"], self.probabilities["NET"], self.method,
+                              seed) for seed in self.seedSequence.spawn(k)]
+
+    def getUniform(self, n):
+        ## (n, sampled covariates) uniform samples in (0, 1)
+        if self.engine is not None:
+            U = self.engine.random(n)
+        else:
+            U = np.stack([self.rngs[name].random(n) for name in self.sampledNames], axis=1)
+        return np.clip(U, 1e-12, 1 - 1e-12)
+
+    def sample(self, n):
+        U = self.getUniform(n)
+        covariates = dict()
+        for name in Cohort.covariateNames:
+            if name in self.probabilities:
+                covariates[name] = U[:, self.sampledNames.index(name)] < self.probabilities[name]
+            elif name in self.sampledNames:
+                distribution = self.distributions[name]
+                if callable(distribution):
+                    distribution = distribution(covariates)
+                covariates[name] = distribution.ppf(U[:, self.sampledNames.index(name)])
+            else:
+                covariates[name] = np.full(n, float(self.distributions[name]))
+        return Cohort(covariates)
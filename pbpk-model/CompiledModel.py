@@ -0,0 +1,199 @@
+import copy
+import json
+
+import numpy as np
+from scipy import sparse
+
+
+class CompiledModel:
+    """
+    An encoded model (Patient + Therapy) loaded from a single .npz artifact written by compileModel.
+
+    It has the interface of the Encoder that the solvers use (BigVect, SystemMat, SystemMatSparse, JacobianPattern,
+    organsObj, bindingEncoder, systemMatricEncoder), but loading it only reads flat arrays, so it takes milliseconds
+    and every worker process of a batch job can load the same file instead of rebuilding the Organs, BigVectEncoder
+    and SystemMatrixEncoder.
+
+    The artifact also holds the COO assembly map (see AssemblyMap), so setParameters reassembles the model of
+    another patient with the same organs, and the observable projections: Projection_labeled @ X (and
+    Projection_unlabeled @ X) is the summed labeled (unlabeled) amount of each organ of observableNames.
+    """
+    def __init__(self, path, injectionProfile=None):
+        with np.load(path) as data:
+            self.arrays = {name: data[name] for name in data.files}
+        arrays = self.arrays
+
+        organsDict = json.loads(str(arrays["organsDict"]))
+        if injectionProfile is None:
+            injectionProfile = json.loads(str(arrays["injectionProfile"]))
+        self.organsObj = CompiledOrgans(organsDict, int(arrays["N"]), injectionProfile)
+        self.BigVect = arrays["BigVect"].copy()
+
+        self.SystemMatSparse = sparse.csr_matrix(
+            (arrays["SystemMat_data"], arrays["SystemMat_indices"], arrays["SystemMat_indptr"]),
+            shape=(self.organsObj.N, self.organsObj.N))
+        self.SystemMat = self.SystemMatSparse.toarray()
+        self.JacobianPattern = sparse.csr_matrix(
+            (arrays["Jacobian_data"], arrays["Jacobian_indices"], arrays["Jacobian_indptr"]),
+            shape=(self.organsObj.N, self.organsObj.N))
+
+        self.bindingEncoder = CompiledBinding(arrays)
+        self.systemMatricEncoder = self
+
+        self.theta = arrays["theta"].copy()
+        self.parameterIndex = {tuple(name.split("/", 1)): i
+                               for i, name in enumerate(arrays["parameterNames"].tolist())}
+        self.observableNames = [str(name) for name in arrays["observableNames"]]
+        self.Projection_labeled = arrays["Projection_labeled"]
+        self.Projection_unlabeled = arrays["Projection_unlabeled"]
+
+    def getBindingPositions(self):
+        return self.arrays["Binding_rows"], self.arrays["Binding_cols"]
+
+    def getK_onPositions(self):
+        return self.arrays["K_on_rows"], self.arrays["K_on_cols"]
+
+    def getSparseDataIndex(self, rows, cols, matrix=None):
+        ## Position of the entries [rows[k], cols[k]] in matrix.data (SystemMatSparse by default), the same as
+        ## SystemMatrixEncoder.getSparseDataIndex. The entries must be part of the sparsity pattern
+        if matrix is None:
+            matrix = self.SystemMatSparse
+        patternRows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+        patternKeys = patternRows * matrix.shape[1] + matrix.indices    ## Sorted, as the CSR matrix is canonical
+        keys = np.asarray(rows) * matrix.shape[1] + np.asarray(cols)
+        dataIndex = np.clip(np.searchsorted(patternKeys, keys), 0, patternKeys.shape[0] - 1)
+        if np.any(patternKeys[dataIndex] != keys):
+            raise ValueError("Some entries are not in the sparsity pattern of the matrix")
+        return dataIndex
+
+    def getValues(self, theta):
+        arrays = self.arrays
+        return arrays["Assembly_signs"] * theta[arrays["Assembly_paramIndex"]] / theta[arrays["Assembly_volumeIndex"]]
+
+    def setParameters(self, theta):
+        ## Reassembles the model for the flat parameter vector theta of another patient with the same organs. The
+        ## matrices, the bindingEncoder and the organsObj are replaced by new objects, so the solvers built before
+        ## keep the model they were built with
+        arrays = self.arrays
+        self.theta = np.asarray(theta, dtype=float)
+        dataIndex = arrays["Assembly_dataIndex"]
+        inPattern = dataIndex >= 0
+        values = self.getValues(self.theta)
+        if np.any(values[~inPattern] != 0):
+            raise ValueError("Some nonzero entries of the system matrix are not in the sparsity pattern")
+
+        self.SystemMatSparse = self.SystemMatSparse.copy()
+        self.SystemMatSparse.data[:] = 0
+        np.add.at(self.SystemMatSparse.data, dataIndex[inPattern], values[inPattern])
+        self.SystemMat = self.SystemMatSparse.toarray()
+        self.JacobianPattern = self.JacobianPattern.copy()
+        self.JacobianPattern.data[:] = 0
+        np.add.at(self.JacobianPattern.data, arrays["Assembly_jacobianDataIndex"][inPattern], values[inPattern])
+
+        binding = copy.copy(self.bindingEncoder)
+        binding.k_on = self.theta[[self.parameterIndex[(name, "k_on")] for name in binding.names]]
+        binding.R0 = self.theta[[self.parameterIndex[(name, "R0")] for name in binding.names]]
+        binding.V_int = self.theta[[self.parameterIndex[(name, "V_int")] for name in binding.names]]
+        binding.kOnPerVolume = binding.k_on / binding.V_int
+        self.bindingEncoder = binding
+
+        organsDict = copy.deepcopy(self.organsObj.organsDict)
+        for type in ["RecPos", "Kidney"]:
+            for name, organDict in organsDict[type].items():
+                organDict["R0"] = self.theta[self.parameterIndex[(name, "R0")]]
+                organDict["k_on"] = self.theta[self.parameterIndex[(name, "k_on")]]
+        self.organsObj = CompiledOrgans(organsDict, self.organsObj.N, self.organsObj.therapy.injectionProfile)
+
+
+class CompiledOrgans:
+    ## The parts of the Organs object that the solvers and DataProcessing read
+    def __init__(self, organsDict, N, injectionProfile):
+        self.organsDict = organsDict
+        self.N = N
+        self.typesList = list(organsDict.keys())
+        self.therapy = CompiledTherapy(injectionProfile)
+
+
+class CompiledTherapy:
+    def __init__(self, injectionProfile):
+        self.injectionProfile = injectionProfile
+
+
+class CompiledBinding:
+    ## The arrays of the BindingEncoder
+    def __init__(self, arrays):
+        self.RP_labeled = arrays["Binding_RP_labeled"]
+        self.RP_unlabeled = arrays["Binding_RP_unlabeled"]
+        self.P_int_labeled = arrays["Binding_P_int_labeled"]
+        self.P_int_unlabeled = arrays["Binding_P_int_unlabeled"]
+        self.RP = np.concatenate([self.RP_labeled, self.RP_unlabeled])
+        self.P_int = np.concatenate([self.P_int_labeled, self.P_int_unlabeled])
+        self.k_on = arrays["Binding_k_on"].copy()
+        self.R0 = arrays["Binding_R0"].copy()
+        self.V_int = arrays["Binding_V_int"].copy()
+        self.kOnPerVolume = self.k_on / self.V_int
+        self.names = [str(name) for name in arrays["Binding_names"]]
+
+
+def compileModel(encoder, path):
+    ## Writes the artifact of an Encoder (uncompressed, so loading is only a read)
+    organsObj = encoder.organsObj
+    binding = encoder.bindingEncoder
+    assemblyMap = encoder.assemblyMap
+    SystemMatSparse = encoder.SystemMatSparse
+    JacobianPattern = encoder.JacobianPattern
+
+    ## Observables: the summed labeled / unlabeled amount of each organ
+    observableNames = []
+    labeled = []
+    unlabeled = []
+    for type in organsObj.typesList:
+        for name, organDict in organsObj.organsDict[type].items():
+            observableNames.append(name)
+            rowLabeled = np.zeros(organsObj.N)
+            rowUnlabeled = np.zeros(organsObj.N)
+            for variable, shift in organDict["bigVectMap"].items():
+                if "*" in variable:
+                    rowLabeled[organDict["stencil"]["base"] + shift] = 1
+                else:
+                    rowUnlabeled[organDict["stencil"]["base"] + shift] = 1
+            labeled.append(rowLabeled)
+            unlabeled.append(rowUnlabeled)
+
+    bindingRows, bindingCols = encoder.systemMatricEncoder.getBindingPositions()
+    K_onRows, K_onCols = encoder.systemMatricEncoder.getK_onPositions()
+    np.savez(path,
+             N=organsObj.N,
+             organsDict=json.dumps(organsObj.organsDict),
+             injectionProfile=json.dumps(organsObj.therapy.injectionProfile),
+             BigVect=encoder.BigVect,
+             SystemMat_data=SystemMatSparse.data,
+             SystemMat_indices=SystemMatSparse.indices,
+             SystemMat_indptr=SystemMatSparse.indptr,
+             Jacobian_data=JacobianPattern.data,
+             Jacobian_indices=JacobianPattern.indices,
+             Jacobian_indptr=JacobianPattern.indptr,
+             Binding_rows=bindingRows,
+             Binding_cols=bindingCols,
+             K_on_rows=K_onRows,
+             K_on_cols=K_onCols,
+             Binding_RP_labeled=binding.RP_labeled,
+             Binding_RP_unlabeled=binding.RP_unlabeled,
+             Binding_P_int_labeled=binding.P_int_labeled,
+             Binding_P_int_unlabeled=binding.P_int_unlabeled,
+             Binding_k_on=binding.k_on,
+             Binding_R0=binding.R0,
+             Binding_V_int=binding.V_int,
+             Binding_names=np.array(binding.names),
+             theta=encoder.theta,
+             parameterNames=np.array(["/".join(name) for name in assemblyMap.parameterNames]),
+             Assembly_rows=assemblyMap.rows,
+             Assembly_cols=assemblyMap.cols,
+             Assembly_signs=assemblyMap.signs,
+             Assembly_paramIndex=assemblyMap.paramIndex,
+             Assembly_volumeIndex=assemblyMap.volumeIndex,
+             Assembly_dataIndex=assemblyMap.getPatternDataIndex(SystemMatSparse),
+             Assembly_jacobianDataIndex=assemblyMap.getPatternDataIndex(JacobianPattern),
+             observableNames=np.array(observableNames),
+             Projection_labeled=np.array(labeled),
+             Projection_unlabeled=np.array(unlabeled))
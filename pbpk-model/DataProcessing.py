@@ -71,7 +71,6 @@ class DataProcessing:
 
 
         # plt.legend()
-        print("Hello")
 
 
         self.connectivity = self.results.SystemMat.copy()
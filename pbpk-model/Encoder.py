@@ -1,5 +1,5 @@
 import numpy as np
-import matplotlib.pyplot as plt
+from scipy import sparse
 
 ### BigVector contains all of the variables
 ### SystemMat is the system matrix which includes all of the parameters and differential equations
@@ -10,8 +10,13 @@ class Encoder:
         self.organsObj = Organs(patient, therapy)
         self.bigVectEncoder = BigVectEncoder(self.organsObj)
         self.systemMatricEncoder = SystemMatrixEncoder(self.organsObj)
+        self.bindingEncoder = BindingEncoder(self.organsObj)
         self.BigVect = self.bigVectEncoder.BigVect
         self.SystemMat = self.systemMatricEncoder.SystemMat
+        self.SystemMatSparse = self.systemMatricEncoder.SystemMatSparse
+        self.JacobianPattern = self.systemMatricEncoder.JacobianPattern
+        self.assemblyMap = self.systemMatricEncoder.assemblyMap
+        self.theta = self.systemMatricEncoder.theta
 
 
 class Organs:
@@ -166,110 +171,261 @@ class BigVectEncoder:
                     self.BigVect[pointer] = organ[variableName]
                     pointer += 1
 
-class SystemMatrixEncoder:
+class BindingEncoder:
+    """
+    Compiles the receptor binding terms of the receptor organs (Kidney and RecPos) into flat arrays, so the
+    nonlinear part of the model can be evaluated for all of them with a few NumPy operations. Entry k of every array
+    belongs to the k-th receptor organ (Kidney first, then RecPos, in the order of patient.Organs).
+    """
     def __init__(self, organs):
         self.organs = organs
-        self.LiverDict = self.organs.organsDict["RecPos"]["Liver"]
-
-        self.createSysMat()
-
-
-    def createSysMat(self):
-        self.SystemMat = np.zeros((self.organs.N,self.organs.N))
-        pointer = 0
-        #debugList = [self.organs.typesList["RecPos"]]
+        self.organTypes = ["Kidney", "RecPos"]
+        self.createBindingArrays()
+
+    def createBindingArrays(self):
+        index = {"RP*": [], "RP": [], "P*_int": [], "P_int": []}    ## Positions of the variables in the BigVect
+        k_on = []
+        R0 = []
+        V_int = []
+        self.names = []
+        for type in self.organTypes:
+            for organ in self.organs.patient.Organs[type]:
+                organDict = self.organs.organsDict[type][organ["name"]]
+                for key in index.keys():
+                    index[key].append(organDict["stencil"]["base"] + organDict["bigVectMap"][key])
+                k_on.append(organDict["k_on"])
+                R0.append(organDict["R0"])
+                V_int.append(organ["V_int"])
+                self.names.append(organ["name"])
+
+        self.RP_labeled = np.array(index["RP*"], dtype=int)
+        self.RP_unlabeled = np.array(index["RP"], dtype=int)
+        self.P_int_labeled = np.array(index["P*_int"], dtype=int)
+        self.P_int_unlabeled = np.array(index["P_int"], dtype=int)
+        ## Labeled and unlabeled indices stacked, so both binding fluxes are computed in one go
+        self.RP = np.concatenate([self.RP_labeled, self.RP_unlabeled])
+        self.P_int = np.concatenate([self.P_int_labeled, self.P_int_unlabeled])
+
+        self.k_on = np.array(k_on, dtype=float)
+        self.R0 = np.array(R0, dtype=float)
+        self.V_int = np.array(V_int, dtype=float)
+        self.kOnPerVolume = self.k_on / self.V_int
+
+
+class AssemblyMap:
+    """
+    The system matrix compiled into COO arrays. Entry k of the arrays is
+        SystemMat[rows[k], cols[k]] += signs[k] * theta[paramIndex[k]] / theta[volumeIndex[k]]
+    where theta is a flat vector of all the numerical parameters of the organs of a patient (theta[0] = 1 is the
+    volume of the entries that are not normalized). The map only depends on the organs of the model, so the system
+    matrix of any patient with the same organs is assembled by getSysMat / getSparseSysMat without any Python loops.
+
+    The entries are listed in the order of the original organ by organ assembly, so the duplicates are summed in the
+    same order and the assembled matrix is bit for bit the same.
+    """
+    def __init__(self, organs):
+        self.organs = organs
+        self.N = organs.N
+        self.createParameterIndex()
+        self.createEntries()
+
+    def createParameterIndex(self):
+        ## (organ name, parameter name) --> position in theta, for every numerical parameter of every organ
+        self.parameterNames = [("", "1")]
+        for type in self.organs.typesList:
+            for organ in self.organs.patient.Organs[type]:
+                for paramName, value in organ.items():
+                    if isinstance(value, (int, float)) and not isinstance(value, bool):
+                        self.parameterNames.append((organ["name"], paramName))
+        self.parameterIndex = {name: i for i, name in enumerate(self.parameterNames)}
+
+    def createEntries(self):
+        rows = []
+        cols = []
+        signs = []
+        paramIndex = []
+        volumeIndex = []
+
+        def addEntry(row, col, sign, organName, paramName, volumeOrganName=None, volumeName=None):
+            rows.append(row)
+            cols.append(col)
+            signs.append(sign)
+            paramIndex.append(self.parameterIndex[(organName, paramName)])
+            if volumeName is None:
+                volumeIndex.append(0)
+            else:
+                volumeIndex.append(self.parameterIndex[(volumeOrganName, volumeName)])
+
+        liverBase = self.organs.organsDict["RecPos"]["Liver"]["stencil"]["base"]
+        veinBase = self.organs.organsDict["ArtVein"]["Vein"]["stencil"]["base"]
         for type in self.organs.typesList:  ## ArtVein, Lungs, RecNeg, RecPos, Kidney
-            for organ in self.organs.patient.Organs[type]:  ## [Art, Vein] | [Lungs] | [RecNeg1, RecNeg2, ...] | [RecPos1, ...] | [Kidney]
+            for organ in self.organs.patient.Organs[type]:
                 organDict = self.organs.organsDict[type][organ["name"]]
-                subMat_initialPosition = np.array([ [organDict["stencil"]["base"], organDict["stencil"]["base"]] ]) ## [8,8]
-                L = organDict["stencil"]["length"]  ## Length of sub matrix
-                subMat = np.zeros((L,L))
-                ## Contents of organDict:
-                ## - stencil
-                ## - bigVectMap
-                ## - sysMatMap
-                ## - name
-                ## - type       ## ArtVein - Lungs - RecNeg - RecPos
-
-                ## Contents of sysMatMap (for example for a RecPos organ)
-                ## F: [list]
-                ## PS: [list]
-                ## K_on = k_on*R: [list]
-                ## k_off: [list]
-                ## lambda_intern: [list]
-                ## lambda_rel: [list]
-                ## lambda_phys: [list]
-                ##
-                ## the corresponding value to each of these keys is a list. The elements of this list shows the coordinates
-                ## of the variable in the sub matrix. For example for the case of F for a RecPos organ we have:
-                ## "F": [[0, 0, -1], [1, 1, -1]]. Note that the last number shows the sign of parameter in that location
-                ## and the first two numbers are the location of the parameter in the sub matrix. For example the values
-                ## in the example says that F is in the [0,0] position and the [1,1] position of tha matrix with negative
-                ## sign.
-                for paramName in organDict["sysMatMap"].keys(): ## For RecPos: F, PS, K_on, k_off, lambda_intern, etc
-                    for elem in organDict["sysMatMap"][paramName]: ## [[0,0,-1],[1,1,-1],...]
-                        sign = elem[-1]
-                        pos = np.array(elem[:-1])
-
-
-                        if paramName in ["F", "PS", "K_on", "F_fil", "F_R"]:    ## Normalizing with Volume
-                            if organDict["name"] == "Kidney":       ## For Kidney that has a different volumeMap
-                                volumeMap = ["V_v", "V_v", "V_intra", "V_intra", "V_int", "V_int"]
-                                subMat[pos[0], pos[1]] += sign * organ[paramName] / organ[volumeMap[pos[1]]]
-                            else:
-                                # print(organDict["name"])
-                                # print(paramName)
-                                subMat[pos[0], pos[1]] += sign*organ[paramName]/organ[organDict["volumeMap"][pos[1]]]
-                                ### Contents of organ[organDict["volumeMap"] is this list: ["V_v", "V_v", "V_int", "V_int"]
-                                ### That is because F,PS, and K_on parameters must be normalized by the volume corresponding
-                                ### to the column. Since in the sub matrix, column 0,1 are for the vascular compartment,
-                                ### and column 2,3 are for the interestitial compartments, I am using pos[1] to get the
-                                ### number of column and then by using the volume map list I can get the appropriate key
-                                ### and go and get the value from the patient object
+                name = organ["name"]
+                base = organDict["stencil"]["base"]
+                ## sysMatMap gives the [row, column, sign] of each parameter in the block of the organ.
+                ## F, PS, K_on, F_fil and F_R are normalized with the volume of the compartment of the column
+                volumeMap = organDict["volumeMap"]
+                if name == "Kidney":    ## The Kidney has its own volumeMap
+                    volumeMap = ["V_v", "V_v", "V_intra", "V_intra", "V_int", "V_int"]
+                for paramName in organDict["sysMatMap"].keys():
+                    for elem in organDict["sysMatMap"][paramName]:
+                        if paramName in ["F", "PS", "K_on", "F_fil", "F_R"]:
+                            addEntry(base + elem[0], base + elem[1], elem[-1], name, paramName, name,
+                                     volumeMap[elem[1]])
                         else:
-                            # if (organ["name"] == "Adipose"):
-                            #     print("H")
-                            subMat[pos[0], pos[1]] += sign * organ[paramName]
-
-                x1 = subMat_initialPosition[0,0]
-                y1 = x1
-                x2 = x1 + L
-                y2 = x2
-                print(organ)
-                self.SystemMat[x1:x2, y1:y2] = subMat.copy()
-
-                if type in ["RecPos", "RecNeg", "Kidney"]  : ## The outer F insertion
-                    if organ["name"] in ["GI","Spleen"]:
-                        thisOrganStencil = self.organs.organsDict[type][organ["name"]]["stencil"]
-                        col = thisOrganStencil["base"]
-                        row = self.LiverDict["stencil"]["base"]
-                        self.SystemMat[row, col] = organ["F"]/organ["V_v"]
-                        self.SystemMat[row+1, col+1] = organ["F"]/organ["V_v"]
-
-                        self.SystemMat[x1, 0] = organ['F'] / self.organs.patient.Art["V_v"]
-                        self.SystemMat[x1 + 1, 1] = organ['F'] / self.organs.patient.Art["V_v"]
-                    else:
-                        self.SystemMat[2,x1] = organ['F']/organ["V_v"]
-                        self.SystemMat[3,x1+1] = organ['F']/organ["V_v"]
+                            addEntry(base + elem[0], base + elem[1], elem[-1], name, paramName)
 
-                        self.SystemMat[x1, 0] = organ['F'] / self.organs.patient.Art["V_v"]
-                        self.SystemMat[x1 + 1, 1] = organ['F'] / self.organs.patient.Art["V_v"]
+                if type in ["RecPos", "RecNeg", "Kidney"]:  ## The outer F insertion
+                    if name in ["GI", "Spleen"]:    ## GI and Spleen drain into the Liver instead of the Vein
+                        addEntry(liverBase, base, 1, name, "F", name, "V_v")
+                        addEntry(liverBase + 1, base + 1, 1, name, "F", name, "V_v")
+                    else:
+                        addEntry(2, base, 1, name, "F", name, "V_v")
+                        addEntry(3, base + 1, 1, name, "F", name, "V_v")
+                    addEntry(base, 0, 1, name, "F", "Art", "V_v")
+                    addEntry(base + 1, 1, 1, name, "F", "Art", "V_v")
 
                 if type == "Lungs":
-                    shift = self.organs.organsDict["ArtVein"]["Vein"]["stencil"]["base"]    ## 2
-                    self.SystemMat[x1,0+shift] = organ['F']/self.organs.patient.Vein["V_v"]
-                    self.SystemMat[x1+1,1+shift] = organ['F']/self.organs.patient.Vein["V_v"]
+                    addEntry(base, veinBase, 1, name, "F", "Vein", "V_v")
+                    addEntry(base + 1, veinBase + 1, 1, name, "F", "Vein", "V_v")
+                    addEntry(0, base, 1, name, "F", name, "V_v")
+                    addEntry(1, base + 1, 1, name, "F", name, "V_v")
 
-                    self.SystemMat[0, x1] = organ['F']/organ["V_v"]
-                    self.SystemMat[1, x1+1] = organ['F']/organ["V_v"]
+                if type == "BloodProtein":
+                    addEntry(base, veinBase, 1, name, "k_pr")
+                    addEntry(base + 1, veinBase + 1, 1, name, "k_pr")
+
+        self.rows = np.array(rows, dtype=int)
+        self.cols = np.array(cols, dtype=int)
+        self.signs = np.array(signs, dtype=float)
+        self.paramIndex = np.array(paramIndex, dtype=int)
+        self.volumeIndex = np.array(volumeIndex, dtype=int)
+        self.flatIndex = self.rows * self.N + self.cols
+
+    def getParameters(self, patient):
+        ## Flat parameter vector theta of a patient with the same organs. A FlatPatient is gathered from its vector
+        if hasattr(patient, "schema"):
+            return self.getParameterMatrix(patient.values[None, :], patient.schema)[0]
+        organsByName = {organ["name"]: organ for type in self.organs.typesList for organ in patient.Organs[type]}
+        theta = np.ones(len(self.parameterNames))
+        for i, (organName, paramName) in enumerate(self.parameterNames[1:]):
+            theta[i + 1] = organsByName[organName][paramName]
+        return theta
+
+    def getParameterMatrix(self, values, schema):
+        ## (n, len(theta)) matrix of the theta of a stacked (n, P) array of FlatPatient parameters (see ParameterSchema)
+        theta = np.ones((values.shape[0], len(self.parameterNames)))
+        theta[:, 1:] = values[:, schema.getIndex(self.parameterNames[1:])]
+        return theta
+
+    def getValues(self, theta):
+        return self.signs * theta[self.paramIndex] / theta[self.volumeIndex]
+
+    def getSysMat(self, theta):
+        SystemMat = np.zeros(self.N * self.N)
+        np.add.at(SystemMat, self.flatIndex, self.getValues(theta))
+        return SystemMat.reshape(self.N, self.N)
+
+    def getPatternDataIndex(self, matrix):
+        ## Position of each entry in matrix.data, -1 for the entries that are not in the pattern of the CSR matrix
+        patternRows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+        patternKeys = patternRows * self.N + matrix.indices     ## Sorted, as the CSR matrix is canonical
+        position = np.clip(np.searchsorted(patternKeys, self.flatIndex), 0, patternKeys.shape[0] - 1)
+        return np.where(patternKeys[position] == self.flatIndex, position, -1)
+
+    def getSparseSysMat(self, theta, pattern, dataIndex=None):
+        ## SystemMat of theta on the sparsity pattern of a CSR matrix (e.g. SystemMatSparse of an Encoder). Pass the
+        ## dataIndex of getPatternDataIndex(pattern) to skip the lookup when assembling many patients
+        if dataIndex is None:
+            dataIndex = self.getPatternDataIndex(pattern)
+        values = self.getValues(theta)
+        inPattern = dataIndex >= 0
+        if np.any(values[~inPattern] != 0):
+            raise ValueError("Some nonzero entries of the system matrix are not in the sparsity pattern")
+        SystemMat = pattern.copy()
+        SystemMat.data[:] = 0
+        np.add.at(SystemMat.data, dataIndex[inPattern], values[inPattern])
+        return SystemMat
 
 
-                if type == "BloodProtein":
-                    shift = self.organs.organsDict["ArtVein"]["Vein"]["stencil"]["base"]
-                    self.SystemMat[x1,0+shift] = organ["k_pr"]
-                    self.SystemMat[x1+1,1+shift] = organ["k_pr"]
+class SystemMatrixEncoder:
+    def __init__(self, organs):
+        self.organs = organs
+        self.LiverDict = self.organs.organsDict["RecPos"]["Liver"]
 
-        print("Hello")
+        self.createSysMat()
+        self.createSparseSysMat()
+        self.createJacobianPattern()
+
+    def createSysMat(self):
+        ## The stencil layout is compiled once into an AssemblyMap (see below). SystemMat is the gather-multiply-
+        ## scatter of the flat parameter vector theta of this patient
+        self.assemblyMap = AssemblyMap(self.organs)
+        self.theta = self.assemblyMap.getParameters(self.organs.patient)
+        self.SystemMat = self.assemblyMap.getSysMat(self.theta)
+
+    def createSparseSysMat(self):
+        ## SystemMat is almost entirely zeros (the organ blocks on the diagonal plus a few Art/Vein/Liver couplings),
+        ## so the solvers use this CSR copy of it for the mat-vec product of the right hand side.
+        ## The K_on entries are zero at encoding time (K_on is state dependent and the solvers update them while
+        ## integrating), so they are kept in the sparsity pattern as explicit zeros. This way a solver can update
+        ## them in the data array without changing the structure of the matrix.
+        K_on_rows, K_on_cols = self.getK_onPositions()
+        self.SystemMatSparse = self.getSparseSysMat(K_on_rows, K_on_cols)
+
+    def createJacobianPattern(self):
+        ## The right hand side of the StiffSolver is SystemMat @ X + B(X), so its Jacobian is SystemMat plus the
+        ## derivatives of the receptor binding terms of B. JacobianPattern is SystemMat on the union of both
+        ## nonzero patterns, the solver only has to add the binding derivatives to its data array.
+        binding_rows, binding_cols = self.getBindingPositions()
+        self.JacobianPattern = self.getSparseSysMat(binding_rows, binding_cols)
+
+    def getSparseSysMat(self, extraRows, extraCols):
+        ## CSR copy of SystemMat whose sparsity pattern also contains the [extraRows, extraCols] entries
+        rows, cols = np.nonzero(self.SystemMat)
+        positions = np.unique(np.stack([np.concatenate([rows, extraRows]), np.concatenate([cols, extraCols])]), axis=1)
+        return sparse.csr_matrix((self.SystemMat[positions[0], positions[1]], (positions[0], positions[1])),
+                                 shape=self.SystemMat.shape)
+
+    def getK_onPositions(self):
+        rows = []
+        cols = []
+        for type in ["RecPos", "Kidney"]:
+            for organDict in self.organs.organsDict[type].values():
+                for elem in organDict["sysMatMap"]["K_on"]:
+                    rows.append(organDict["stencil"]["base"] + elem[0])
+                    cols.append(organDict["stencil"]["base"] + elem[1])
+        return np.array(rows, dtype=int), np.array(cols, dtype=int)
+
+    def getBindingPositions(self):
+        ## Positions of the nonzero derivatives of the receptor binding terms. For each receptor organ:
+        ## d/dX of B[RP*] and B[P*_int] is nonzero in the P*_int, RP and RP* columns and
+        ## d/dX of B[RP] and B[P_int] is nonzero in the P_int, RP and RP* columns
+        rows = []
+        cols = []
+        for type in ["Kidney", "RecPos"]:
+            for organDict in self.organs.organsDict[type].values():
+                index = {key: organDict["stencil"]["base"] + shift for key, shift in organDict["bigVectMap"].items()}
+                for RP, P_int in [("RP*", "P*_int"), ("RP", "P_int")]:
+                    for row in [index[RP], index[P_int]]:
+                        for col in [index[P_int], index["RP"], index["RP*"]]:
+                            rows.append(row)
+                            cols.append(col)
+        return np.array(rows, dtype=int), np.array(cols, dtype=int)
+
+    def getSparseDataIndex(self, rows, cols, matrix=None):
+        ## Returns the position of the entries [rows[k], cols[k]] in matrix.data (SystemMatSparse by default). The
+        ## entries must be part of the sparsity pattern (see createSparseSysMat and createJacobianPattern)
+        if matrix is None:
+            matrix = self.SystemMatSparse
+        indptr = matrix.indptr
+        indices = matrix.indices
+        dataIndex = np.zeros(len(rows), dtype=int)
+        for k, (row, col) in enumerate(zip(rows, cols)):
+            rowIndices = indices[indptr[row]:indptr[row + 1]]
+            dataIndex[k] = indptr[row] + np.flatnonzero(rowIndices == col)[0]
+        return dataIndex
 
 
 
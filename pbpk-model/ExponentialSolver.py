@@ -0,0 +1,162 @@
+import numpy as np
+from scipy.interpolate import CubicHermiteSpline
+from scipy.linalg import expm
+from scipy.optimize import OptimizeResult
+
+from StiffSolver import StiffSolver
+
+
+class ExponentialSolver(StiffSolver):
+    """
+    Exponential integrator (ETD2RK of Cox and Matthews) for the mostly linear PBPK model.
+
+    The right hand side is split into a linear part A @ X, which is integrated exactly with the matrix exponential,
+    and the nonlinear remainder N(X) = F(X) - A @ X:
+        a      = e^(hA) X + h phi_1(hA) N(X)
+        X_new  = a + h phi_2(hA) (N(a) - N(X))
+    The second term is the difference between this second order step and the exponential Euler step, so it is also
+    used as the local error estimate.
+
+    A is SystemMat plus the receptor binding terms linearized at a frozen state (the analytic Jacobian of F), so the
+    remainder is only the change of the binding terms since the linearization. A is frozen at the start of each
+    injection segment and only updated when a step is rejected.
+
+    The step sizes are restricted to the ladder h0 * 2^k, so e^(hA), phi_1(hA) and phi_2(hA) are computed once per
+    linearization and level and reused for every step of that size (the levels above h0 only cost a squaring). Every
+    step, also a cut one, is rejected when it fails the error test and retried lower on the ladder, below h0 if
+    needed. A segment fails (success False, as in solve_ivp) when the step gets smaller than the spacing of the
+    floating point numbers at its end. A step never crosses an output time: the steps cut to end on an output time or
+    on the breakpoint are applied with the exponential of a small augmented matrix instead (getPhiAction), so the
+    solution at the output times is the one of the integrator and not of the interpolant. Between the steps the dense
+    output of a segment is the cubic Hermite interpolant of the steps. The model, the injection schedule and the
+    results are the ones of the StiffSolver.
+    """
+    snapshotAttributes = ("level",)
+
+    def __init__(self, encoder, rtol=1e-3, atol=1e-9, h0=1e-3, outputTimes=None, monitor=None):
+        super().__init__(encoder, outputTimes=outputTimes, monitor=monitor)
+        self.method = "ETD2RK"
+        self.rtol = rtol
+        self.atol = atol
+        self.h0 = h0    ## Base step of the ladder (min), the rejected steps can go below it
+        self.level = 0  ## The current step is h0 * 2^level
+        self.nexpm = 0  ## Number of matrix exponentials computed
+
+    def reset(self):
+        super().reset()
+        self.level = 0
+
+    def setLinearization(self, X):
+        self.A = self.jac(self.t_0, X)
+        if not isinstance(self.A, np.ndarray):
+            self.A = self.A.toarray()
+        self.phiCache = dict()  ## h --> (e^(hA), h phi_1(hA), h^2 phi_2(hA))
+
+    def getPhi(self, h):
+        ## Top block row of expm(h [[A, I, 0], [0, 0, I], [0, 0, 0]]) = [e^(hA), h phi_1(hA), h^2 phi_2(hA)]
+        if h not in self.phiCache:
+            level = np.log2(h / self.h0)
+            if level >= 1 and level == np.round(level):
+                ## A ladder step is the square of the step below it:
+                ## [E, P1, P2; 0, I, hI; 0, 0, I]^2 = [E E, E P1 + P1, E P2 + h P1 + P2; ...]
+                E, P1, P2 = self.getPhi(h / 2)
+                self.phiCache[h] = (E @ E, E @ P1 + P1, E @ P2 + h / 2 * P1 + P2)
+            else:
+                N = self.A.shape[0]
+                W = np.zeros((3 * N, 3 * N))
+                W[:N, :N] = h * self.A
+                W[:N, N:2 * N] = h * np.eye(N)
+                W[N:2 * N, 2 * N:] = h * np.eye(N)
+                E = expm(W)
+                self.nexpm += 1
+                self.phiCache[h] = (E[:N, :N].copy(), E[:N, N:2 * N].copy(), E[:N, 2 * N:].copy())
+        return self.phiCache[h]
+
+    def getPhiAction(self, h, X, b0, b1):
+        ## e^(hA) X + h phi_1(hA) b0 + h^2 phi_2(hA) b1, for the steps off the ladder: the top block of
+        ## expm(h [[A, b1, b0], [0, 0, 1], [0, 0, 0]]) [X, 0, 1], which is only of size N + 2
+        N = self.A.shape[0]
+        W = np.zeros((N + 2, N + 2))
+        W[:N, :N] = self.A
+        W[:N, N] = b1
+        W[:N, N + 1] = b0
+        W[N, N + 1] = 1
+        self.nexpm += 1
+        return expm(h * W)[:N] @ np.append(X, [0, 1])
+
+    def getNonlinear(self, X):
+        return self.F(self.t_0, X) - self.A @ X
+
+    def integrateSegment(self, t_start, t_end, X):
+        tList = [t_start]
+        XList = [X.copy()]
+        nfev = 1
+        njev = 1
+        nrejected = 0
+        nexpm = self.nexpm
+        t = t_start
+        self.setLinearization(X)
+        N_X = self.getNonlinear(X)
+        dXList = [self.A @ X + N_X]
+        linearizedAtX = True
+        stops = np.append(self.outputTimes[(self.outputTimes > t_start) & (self.outputTimes < t_end)], t_end)
+        stopIndex = 0
+        success = True
+        while t < t_end:
+            ## Next output time or end of the segment, a step is cut to end there
+            while stops[stopIndex] <= t:
+                stopIndex += 1
+            h = self.h0 * 2.0 ** self.level
+            if h < 10 * np.spacing(t_end):
+                success = False
+                break
+            cutStep = t + h >= stops[stopIndex]
+            if cutStep:
+                h = stops[stopIndex] - t
+                a = self.getPhiAction(h, X, N_X, 0)
+                N_a = self.getNonlinear(a)
+                correction = self.getPhiAction(h, np.zeros(X.shape), 0, (N_a - N_X) / h)
+            else:
+                expA, phi1, phi2 = self.getPhi(h)
+                a = expA @ X + phi1 @ N_X
+                N_a = self.getNonlinear(a)
+                correction = phi2 @ (N_a - N_X) / h
+            nfev += 1
+            X_new = a + correction
+
+            errorNorm = np.sqrt(np.mean((correction / (self.atol + self.rtol * np.abs(X_new))) ** 2))
+            if errorNorm > 1:
+                ## Rejected: update the linearization and retry with the next ladder step below h
+                nrejected += 1
+                if not linearizedAtX:
+                    self.setLinearization(X)
+                    N_X = self.getNonlinear(X)
+                    nfev += 1
+                    njev += 1
+                    linearizedAtX = True
+                self.level -= 1
+                while self.h0 * 2.0 ** self.level >= h:
+                    self.level -= 1
+                continue
+
+            t = stops[stopIndex] if cutStep else t + h
+            X = X_new
+            N_X = self.getNonlinear(X)
+            nfev += 1
+            linearizedAtX = False
+            tList.append(t)
+            XList.append(X.copy())
+            dXList.append(self.A @ X + N_X)
+            if self.monitor is not None:
+                ## Midpoint of the cubic Hermite interpolant of the step
+                self.monitor.addStep(t, X, (XList[-2] + X) / 2 + h / 8 * (dXList[-2] - dXList[-1]))
+            if errorNorm < 0.25 and not cutStep:   ## The error estimate is O(h^2), doubling h multiplies it by ~4
+                self.level += 1
+
+        ## Dense output: cubic Hermite interpolant of the accepted steps and their derivatives
+        tList = np.array(tList)
+        y = np.stack(XList, axis=1)
+        return OptimizeResult(t=tList, y=y, sol=CubicHermiteSpline(tList, y, np.stack(dXList, axis=1), axis=1),
+                              nfev=nfev, njev=njev, nlu=self.nexpm - nexpm, nrejected=nrejected, success=success,
+                              message="The solver successfully reached the end of the segment" if success else
+                              "Required step size is less than spacing between numbers.")
@@ -0,0 +1,83 @@
+from collections.abc import MutableMapping
+
+import numpy as np
+
+from ParameterSchema import getSchema, loadSchema
+
+
+class FlatPatient:
+    """
+    Patient backed by one contiguous float vector: `values` holds every organ parameter at the position given by
+    its ParameterSchema.
+
+    Organs has the layout of Patient.Organs (type --> list of organ dicts), but its dicts are OrganView objects that
+    read and write the vector, so the Encoder and the rest of the existing code work unchanged. Code that knows the
+    schema gathers the parameters with integer indices instead (AssemblyMap.getParameters, getParameterMatrix).
+
+    values can be a row of a stacked (n, P) cohort array (stackPatients, Cohort.getFlatValues) or of a memory-mapped
+    one (saveStack, loadStack): the patient is a view of the row, so it costs no copy.
+    """
+    def __init__(self, values, schema):
+        if values.shape != (schema.size,):
+            raise ValueError("The values must have the shape ({},) of the schema".format(schema.size))
+        self.values = values
+        self.schema = schema
+        self.Organs = {type: [OrganView(self, name) for name in names] for type, names in schema.organTypes.items()}
+
+
+class OrganView(MutableMapping):
+    ## Dict view of the parameters of one organ of a FlatPatient (plus its "name")
+    def __init__(self, patient, name):
+        self.patient = patient
+        self.name = name
+        self.slice = patient.schema.organSlices[name]
+        self.offsets = {paramName: i for i, paramName in enumerate(patient.schema.organParameters[name])}
+
+    def __getitem__(self, key):
+        if key == "name":
+            return self.name
+        return self.patient.values[self.slice.start + self.offsets[key]]
+
+    def __setitem__(self, key, value):
+        if key not in self.offsets:
+            raise KeyError("{} is not a parameter of {} in the schema".format(key, self.name))
+        self.patient.values[self.slice.start + self.offsets[key]] = value
+
+    def __delitem__(self, key):
+        raise TypeError("The parameters of a FlatPatient cannot be deleted")
+
+    def __iter__(self):
+        yield "name"
+        yield from self.offsets
+
+    def __len__(self):
+        return len(self.offsets) + 1
+
+
+def flattenPatient(patient, schema=None):
+    ## FlatPatient with the parameters of a Patient (in the schema of that patient by default)
+    if schema is None:
+        schema = getSchema(patient)
+    return FlatPatient(stackPatients([patient], schema)[0], schema)
+
+
+def stackPatients(patients, schema):
+    ## (n, P) array of the parameters of patients with the organs of the schema
+    values = np.empty((len(patients), schema.size))
+    for i, patient in enumerate(patients):
+        for organs in patient.Organs.values():
+            for organ in organs:
+                organSlice = schema.organSlices[organ["name"]]
+                values[i, organSlice] = [organ[key] for key in schema.organParameters[organ["name"]]]
+    return values
+
+
+def saveStack(path, values, schema):
+    ## Writes the (n, P) array as path.npy and the schema as path.json
+    np.save(path + ".npy", np.ascontiguousarray(values))
+    schema.save(path + ".json")
+
+
+def loadStack(path, mmapMode="r"):
+    ## (values, schema) of saveStack, the values memory-mapped (mmapMode=None reads them into memory)
+    return np.load(path + ".npy", mmap_mode=mmapMode), loadSchema(path + ".json")
@@ -0,0 +1,75 @@
+import numpy as np
+
+
+class InjectionSchedule:
+    """
+    Compiles an injection profile of the Therapy class into its discontinuities:
+    - boluses: [(t, amountCold, amountHot)], instantaneous jumps of the Vein state
+    - infusions: [(t0, tf, rateCold, rateHot)], constant rate source terms (nmol/min) of the Vein on [t0, tf)
+
+    Between two breakpoints the right hand side of the model is smooth, so the solvers integrate each segment on
+    its own and restart at the next breakpoint (after applying the boluses of that time).
+    """
+    def __init__(self, injectionProfile):
+        self.injectionProfile = injectionProfile
+        self.boluses = []
+        self.infusions = []
+
+        if injectionProfile["type"] == "bolus":
+            self.boluses.append((injectionProfile["t0"], injectionProfile["totalAmountCold"],
+                                 injectionProfile["totalAmountHot"]))
+
+        if injectionProfile["type"] == "bolusTrain":
+            ## The total amount is split evenly over the N boluses of the train
+            for t in injectionProfile["t"][:injectionProfile["N"]]:
+                self.boluses.append((t, injectionProfile["totalAmountCold"] / injectionProfile["N"],
+                                     injectionProfile["totalAmountHot"] / injectionProfile["N"]))
+
+        if injectionProfile["type"] == "constant":
+            t0 = injectionProfile["t0"]
+            tf = injectionProfile["tf"]
+            self.infusions.append((t0, tf, injectionProfile["totalAmountCold"] / (tf - t0),
+                                   injectionProfile["totalAmountHot"] / (tf - t0)))
+
+    def getBreakpoints(self, t_0, t_f):
+        ## Sorted times in [t_0, t_f] (both included) where a new smooth segment starts or ends
+        breakpoints = [t_0, t_f] + [bolus[0] for bolus in self.boluses]
+        for infusion in self.infusions:
+            breakpoints += [infusion[0], infusion[1]]
+        breakpoints = np.unique(np.array(breakpoints, dtype=float))
+        return breakpoints[(breakpoints >= t_0) & (breakpoints <= t_f)]
+
+    def getSegments(self, t_0, t_f):
+        breakpoints = self.getBreakpoints(t_0, t_f)
+        return list(zip(breakpoints[:-1], breakpoints[1:]))
+
+    def getBolus(self, t):
+        ## Total (cold, hot) amount injected as a bolus exactly at time t
+        cold = 0.0
+        hot = 0.0
+        for tBolus, amountCold, amountHot in self.boluses:
+            if tBolus == t:
+                cold += amountCold
+                hot += amountHot
+        return cold, hot
+
+    def getRate(self, t):
+        ## (cold, hot) infusion rate of the segment that starts at t
+        cold = 0.0
+        hot = 0.0
+        for t0, tf, rateCold, rateHot in self.infusions:
+            if t0 <= t < tf:
+                cold += rateCold
+                hot += rateHot
+        return cold, hot
+
+    def getTotalAmount(self, t_f=np.inf, includeBolusesAt=True):
+        ## (cold, hot) amount of the profile injected until t_f (the whole profile by default), with or without the
+        ## boluses of time t_f itself
+        boluses = [bolus for bolus in self.boluses if bolus[0] < t_f or (includeBolusesAt and bolus[0] == t_f)]
+        durations = [max(min(infusion[1], t_f) - infusion[0], 0) for infusion in self.infusions]
+        cold = sum(bolus[1] for bolus in boluses) + sum(
+            duration * infusion[2] for duration, infusion in zip(durations, self.infusions))
+        hot = sum(bolus[2] for bolus in boluses) + sum(
+            duration * infusion[3] for duration, infusion in zip(durations, self.infusions))
+        return cold, hot
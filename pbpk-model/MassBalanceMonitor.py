@@ -0,0 +1,162 @@
+import numpy as np
+
+
+class MassBalanceError(Exception):
+    ## Raised by a MassBalanceMonitor with abort=True at the first violation
+    def __init__(self, violation):
+        t, kind, value = violation
+        super().__init__("{} violated at t = {:g} min: {:.3e}".format(kind, t, value))
+        self.violation = violation
+
+
+class MassBalanceMonitor:
+    """
+    Online mass balance of the peptide, updated at every accepted step of a StiffSolver, ExponentialSolver or
+    AdaptiveSolver run.
+
+    With the labeled (hot) and unlabeled (cold) states summed separately, the only terms of the model that change
+    the total amounts are the injections and the columns of the system matrix that do not sum to zero:
+        decay      lambda_phys moves the hot peptide of every compartment to the cold one
+        excretion  everything else that leaves the body: the renal filtration that is not returned (F_fil - F_R)
+                   and the release of the internalized peptide (lambda_rel)
+    The receptor binding terms conserve both totals. So at any time
+        injectedHot  = residentHot + decayed + excretedHot
+        injectedCold = residentCold - decayed + excretedCold
+    where the decayed and excreted amounts are the time integrals of their fluxes (Simpson's rule over each step
+    when the solver gives the state at its midpoint, trapezoidal otherwise). A net source of the model shows up as a
+    negative excretion.
+
+    A conservation violation is a residual of either balance larger than rtol times the injected total (plus atol),
+    a non-negativity violation is a state below -negativeTolerance times the injected total. At the start of every
+    segment and at every step the injected totals are checked against the amount of the injection profile up to that
+    time (so a wrong bolus is caught at its segment), and at the end of the run also against the solver bookkeeping
+    (totalCold, totalHot) and the amount of the whole profile. Every violation is kept in `violations` as
+    (t, kind, value); with abort=True the first one raises a MassBalanceError instead, so a broken configuration
+    stops after a few steps.
+    """
+    def __init__(self, rtol=1e-3, atol=1e-12, negativeTolerance=1e-6, abort=False, keepHistory=True):
+        self.rtol = rtol
+        self.atol = atol
+        self.negativeTolerance = negativeTolerance
+        self.abort = abort
+        self.keepHistory = keepHistory
+
+    def setModel(self, solver):
+        ## Flux vectors of the solver model (called by the solver at the start of solve), resets the balance
+        organsObj = solver.organsObj
+        self.hot = np.zeros(organsObj.N, dtype=bool)
+        for type in organsObj.typesList:
+            for organDict in organsObj.organsDict[type].values():
+                for variable, shift in organDict["bigVectMap"].items():
+                    if "*" in variable:
+                        self.hot[organDict["stencil"]["base"] + shift] = True
+
+        ## decayVector @ X is the hot -> cold flux, excretedHot @ X and excretedCold @ X the fluxes out of the body
+        SystemMat = solver.SystemMatSparse.tocsc()
+        self.decayVector = np.asarray(SystemMat[~self.hot].sum(axis=0)).ravel() * self.hot
+        self.excretedHotVector = -np.asarray(SystemMat[self.hot].sum(axis=0)).ravel() - self.decayVector
+        self.excretedColdVector = -np.asarray(SystemMat[~self.hot].sum(axis=0)).ravel() + self.decayVector
+
+        self.injectionSchedule = solver.injectionSchedule
+        self.expectedCold, self.expectedHot = self.injectionSchedule.getTotalAmount(solver.t_f)
+        self.injectedCold = 0.0
+        self.injectedHot = 0.0
+        self.decayed = 0.0
+        self.excretedCold = 0.0
+        self.excretedHot = 0.0
+        self.rateCold = 0.0
+        self.rateHot = 0.0
+        self.t = None
+        self.X = None
+        self.violations = []
+        self.history = []
+
+    def addInjection(self, cold, hot):
+        ## A bolus, applied to the state before the next startSegment
+        self.injectedCold += cold
+        self.injectedHot += hot
+
+    def startSegment(self, t, X, rateCold, rateHot):
+        self.t = t
+        self.X = X.copy()
+        self.rateCold = rateCold
+        self.rateHot = rateHot
+        self.checkInjected(t, includeBolusesAt=True)
+        self.check(t, X)
+
+    def addStep(self, t, X, Xmid=None):
+        h = t - self.t
+        if Xmid is None:
+            integral = h / 2 * (self.X + X)
+        else:
+            integral = h / 6 * (self.X + 4 * Xmid + X)
+        self.injectedCold += self.rateCold * h
+        self.injectedHot += self.rateHot * h
+        self.decayed += self.decayVector @ integral
+        self.excretedCold += self.excretedColdVector @ integral
+        self.excretedHot += self.excretedHotVector @ integral
+        self.t = t
+        self.X = X.copy()
+        self.checkInjected(t, includeBolusesAt=False)
+        self.check(t, X)
+
+    def getBalance(self, X=None):
+        if X is None:
+            X = self.X
+        residentCold = X[~self.hot].sum()
+        residentHot = X[self.hot].sum()
+        return {"injectedCold": self.injectedCold, "injectedHot": self.injectedHot,
+                "residentCold": residentCold, "residentHot": residentHot,
+                "decayed": self.decayed, "excretedCold": self.excretedCold, "excretedHot": self.excretedHot,
+                "residualCold": self.injectedCold - residentCold + self.decayed - self.excretedCold,
+                "residualHot": self.injectedHot - residentHot - self.decayed - self.excretedHot}
+
+    def getTolerance(self):
+        return self.rtol * (self.injectedCold + self.injectedHot) + self.atol
+
+    def check(self, t, X):
+        balance = self.getBalance(X)
+        if self.keepHistory:
+            self.history.append((t, balance["residentCold"], balance["residentHot"], self.decayed,
+                                 self.excretedCold, self.excretedHot))
+
+        tolerance = self.getTolerance()
+        for kind in ["residualCold", "residualHot"]:
+            if abs(balance[kind]) > tolerance:
+                self.addViolation(t, "conservation ({})".format(kind), balance[kind])
+        minimum = X.min()
+        if minimum < -self.negativeTolerance * (self.injectedCold + self.injectedHot):
+            self.addViolation(t, "non-negativity (state {})".format(int(X.argmin())), minimum)
+
+    def checkInjected(self, t, includeBolusesAt):
+        ## The amounts injected until t must be the ones of the injection profile. The boluses of time t are only
+        ## applied at the start of the segment that starts there, not at the end of the one before
+        expectedCold, expectedHot = self.injectionSchedule.getTotalAmount(t, includeBolusesAt)
+        tolerance = self.getTolerance()
+        for kind, seen, expected in [("cold", self.injectedCold, expectedCold), ("hot", self.injectedHot, expectedHot)]:
+            if abs(expected - seen) > tolerance:
+                self.addViolation(t, "injected amount ({})".format(kind), seen - expected)
+
+    def finish(self, solver):
+        ## Injection bookkeeping at the end of the run: the amounts the monitor saw, the totals of the solver and the
+        ## amounts of the injection profile must all agree
+        tolerance = self.getTolerance()
+        for kind, seen, counted, expected in [("Cold", self.injectedCold, solver.totalCold, self.expectedCold),
+                                              ("Hot", self.injectedHot, solver.totalHot, self.expectedHot)]:
+            if abs(counted - seen) > tolerance:
+                self.addViolation(self.t, "injection bookkeeping (total{})".format(kind), counted - seen)
+            if abs(expected - seen) > tolerance:
+                self.addViolation(self.t, "injected amount ({})".format(kind.lower()), seen - expected)
+
+    def addViolation(self, t, kind, value):
+        violation = (t, kind, float(value))
+        self.violations.append(violation)
+        if self.abort:
+            raise MassBalanceError(violation)
+
+    def getHistory(self):
+        ## Array (steps, 6) of t, residentCold, residentHot, decayed, excretedCold, excretedHot
+        return np.array(self.history)
+
+    def isValid(self):
+        return len(self.violations) == 0
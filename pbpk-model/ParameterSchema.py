@@ -0,0 +1,52 @@
+import json
+
+import numpy as np
+
+
+class ParameterSchema:
+    """
+    Named index of a flat parameter vector: the position of every numerical parameter of every organ of a patient.
+
+    organTypes lists the organ names of each type in the order of Patient.Organs and organParameters the parameter
+    names of each organ in the order of its dict. The parameters of an organ are contiguous in the vector
+    (organSlices[organName]), and index maps (organ name, parameter name) to the position. The schema only depends
+    on the organs of the model, so one schema is shared by every patient of a cohort.
+    """
+    def __init__(self, organTypes, organParameters):
+        self.organTypes = {type: list(names) for type, names in organTypes.items()}
+        self.organParameters = {name: list(parameters) for name, parameters in organParameters.items()}
+        self.names = []
+        self.organSlices = dict()
+        for names in self.organTypes.values():
+            for organName in names:
+                start = len(self.names)
+                self.names += [(organName, paramName) for paramName in self.organParameters[organName]]
+                self.organSlices[organName] = slice(start, len(self.names))
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.size = len(self.names)
+
+    def __eq__(self, other):
+        return isinstance(other, ParameterSchema) and self.organTypes == other.organTypes and \
+            self.organParameters == other.organParameters
+
+    def getIndex(self, names):
+        ## Positions of a list of (organ name, parameter name)
+        return np.array([self.index[tuple(name)] for name in names], dtype=int)
+
+    def save(self, path):
+        with open(path, "w") as file:
+            json.dump({"organTypes": self.organTypes, "organParameters": self.organParameters}, file, indent=2)
+
+
+def getSchema(patient):
+    ## The schema of the organs of a Patient (every parameter except the name)
+    organTypes = {type: [organ["name"] for organ in organs] for type, organs in patient.Organs.items()}
+    organParameters = {organ["name"]: [key for key in organ.keys() if key != "name"]
+                       for organs in patient.Organs.values() for organ in organs}
+    return ParameterSchema(organTypes, organParameters)
+
+
+def loadSchema(path):
+    with open(path) as file:
+        document = json.load(file)
+    return ParameterSchema(document["organTypes"], document["organParameters"])
@@ -11,7 +11,18 @@ import numpy as np
 
 class Patient:
 
-    def __init__(self):
+    def __init__(self, BW=80, BSA=1.94, H=0.1, gender="male", GFR=0.11, V_tu=0.087, tumorType="NET", R_tu_density=15,
+                 R_L_density=1.4, R_S_density=8.7, R_K_density=6.5, R_rest_density=0.5):
+        ## The covariates of the patient (see CohortSampler), the defaults are the reference 80 kg male:
+        ##  BW              body weight (kg)
+        ##  BSA             body surface area (m^2)
+        ##  H               hematocrit (fraction of blood that is red blood cells)
+        ##  gender          "male" or "female"
+        ##  GFR             glomerular filtration rate (L/min)
+        ##  V_tu            volume of the tumor (L)
+        ##  tumorType       "NET" (neuroendocrine tumor) or "MEN" (multiple endocrine neoplasia)
+        ##  R_tu_density, R_L_density, R_S_density, R_K_density, R_rest_density
+        ##                  receptor densities (nmol/L) of the tumor, liver, spleen, kidneys and rest of the body
 
         # Constants related to internalization and physiological clearance rates
         lambda_intern = 0.001  # Rate of internalization (l/min)
@@ -21,38 +32,20 @@ class Patient:
         k_on = 0.04 / 0.5  # Binding rate constant (/min/nmol)
         k_off = 0.04  # Unbinding rate constant (1/min)
 
-        # Patient-specific parameters
-        H = 0.1  # Hematocrit (fraction of blood that is red blood cells)
-        BW = 80  # Body weight of the patient (kg)
-        gender = "male"  # Gender of the patient
-        BSA = 1.94  # Body Surface Area (m^2)
-
         # Volume of various compartments in the body
         V_body = BW * 1000  # Total body volume (L), based on the assumption that 1 g = 1 mL
-        V_tu = 0.087  # Volume of the tumor (L)
         V_L = 1.811  # Volume of the liver (L)
         V_S = 0.198  # Volume of the spleen (L)
         V_K = 0.193  # Volume of the kidney (L)
 
-        # Receptor densities in various organs (in nmol/L)
-        R_tu_density = 15  # Receptor density in the tumor
-        R_L_density = 1.4  # Receptor density in the liver
-        R_S_density = 8.7  # Receptor density in the spleen
-        R_K_density = 6.5  # Receptor density in the kidneys
-        R_rest_density = 0.5  # Receptor density in the rest of the body
-
         # Rates of drug release from non-tumor and tumor tissues (in 1/min)
         lambda_rel_NT = 0.7 * 1e-4  # Rate of drug release from non-tumor tissue
         lambda_rel_TU = 1.1 * 1e-4  # Rate of drug release from tumor tissue
 
         # Tumor-specific parameters
-        tumorType = "NET"  # Type of tumor, either "NET" (Neuroendocrine Tumor) or "MEN" (Multiple Endocrine Neoplasia)
         f_tu = 0.1  # Blood flow rate through the tumor (in L/min/g of tumor)
         k_pr = 4.7 * 1e-4  # Rate constant for protein binding (in 1/min)
 
-        # Kidney function parameter
-        GFR = 0.11  # Glomerular Filtration Rate (in L/min), a measure of how well the kidneys are filtering blood
-
         ## Permeability surface area product
         k_mu = 0.02                                ## L/min/kg | for muscle | --> please see the important note bellow. In a nutshell, /kg is the right unit here
 
@@ -0,0 +1,99 @@
+import os
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+class Profiler:
+    """
+    Opt-in instrumentation of a Patient -> Encoder -> solver -> DataProcessing run.
+
+    Every event is the wall time, CPU time and (with trackAllocations, using tracemalloc) the net memory of one
+    phase: the change of the traced memory over the phase, i.e. what it allocated and did not free (not the total of
+    its allocations, and negative for a phase that frees more than it allocates). Phases are recorded either around
+    a block of code:
+        with profiler.phase("encode"):
+            encoder = Encoder(patient, therapy)
+    or for every call of a method of an object with instrument, e.g. the right hand side, the Jacobian and the
+    injection handling of a solver, without touching the solver code:
+        profiler.instrument(solver, {"F": "RHS", "jac": "Jacobian", "inject": "injection"})
+
+    The events can be written as a Chrome trace (open it in chrome://tracing or Perfetto) and aggregated per phase
+    into a text report.
+    """
+    solverPhases = {"F": "RHS", "F_incremental": "RHS", "jac": "Jacobian", "getSystemMat": "assemble",
+                    "getBFunction": "binding", "inject": "injection"}
+
+    def __init__(self, trackAllocations=False):
+        self.trackAllocations = trackAllocations
+        self.events = []
+        self.t_0 = time.perf_counter()
+        if trackAllocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def phase(self, name):
+        if self.trackAllocations:
+            memoryBefore = tracemalloc.get_traced_memory()[0]
+        wallStart = time.perf_counter()
+        cpuStart = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wallStart
+            cpu = time.process_time() - cpuStart
+            netMemory = tracemalloc.get_traced_memory()[0] - memoryBefore if self.trackAllocations else 0
+            self.events.append((name, wallStart - self.t_0, wall, cpu, netMemory))
+
+    def instrument(self, obj, methods=None):
+        ## Replaces the methods of obj ({method name: phase name}, by default all the solverPhases it has) with
+        ## timed wrappers. Only this instance is affected
+        if methods is None:
+            methods = {name: phase for name, phase in self.solverPhases.items() if hasattr(obj, name)}
+        for methodName, phaseName in methods.items():
+            setattr(obj, methodName, self.getWrapper(getattr(obj, methodName), phaseName))
+        return obj
+
+    def getWrapper(self, method, phaseName):
+        def wrapper(*args, **kwargs):
+            with self.phase(phaseName):
+                return method(*args, **kwargs)
+        return wrapper
+
+    def getSummary(self):
+        ## {phase: [calls, wall, CPU, net memory bytes]}
+        summary = dict()
+        for name, start, wall, cpu, netMemory in self.events:
+            entry = summary.setdefault(name, [0, 0.0, 0.0, 0])
+            entry[0] += 1
+            entry[1] += wall
+            entry[2] += cpu
+            entry[3] += netMemory
+        return summary
+
+    def getReport(self):
+        ## Phases sorted by total wall time. Nested phases (e.g. RHS inside solve) are counted in both
+        lines = ["{:<16}{:>10}{:>12}{:>12}{:>14}{:>14}".format("phase", "calls", "wall (s)", "CPU (s)",
+                                                             "mean (ms)", "net mem (MB)")]
+        summary = self.getSummary()
+        for name in sorted(summary, key=lambda phase: -summary[phase][1]):
+            calls, wall, cpu, netMemory = summary[name]
+            lines.append("{:<16}{:>10}{:>12.4f}{:>12.4f}{:>14.4f}{:>14.3f}".format(
+                name, calls, wall, cpu, wall / calls * 1e3, netMemory / 1024 ** 2))
+        return "\n".join(lines)
+
+    def exportChromeTrace(self, path):
+        ## Complete ("X") events with microsecond timestamps, the CPU time and net memory are in args
+        pid = os.getpid()
+        traceEvents = [{"name": name, "ph": "X", "ts": start * 1e6, "dur": wall * 1e6, "pid": pid, "tid": 0,
+                        "args": {"cpu_ms": cpu * 1e3, "net_memory_bytes": netMemory}}
+                       for name, start, wall, cpu, netMemory in self.events]
+        with open(path, "w") as file:
+            json.dump({"traceEvents": traceEvents, "displayTimeUnit": "ms"}, file)
+
+    def exportJSON(self, path):
+        summary = self.getSummary()
+        with open(path, "w") as file:
+            json.dump({name: {"calls": calls, "wall": wall, "cpu": cpu, "netMemory": netMemory}
+                       for name, (calls, wall, cpu, netMemory) in summary.items()}, file, indent=2)
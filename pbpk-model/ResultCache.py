@@ -0,0 +1,126 @@
+import os
+import json
+import time
+import hashlib
+from collections.abc import Mapping
+
+import numpy as np
+from scipy.integrate import trapezoid
+
+from Encoder import Encoder
+from StiffSolver import StiffSolver
+
+
+MODEL_VERSION = "1"    ## Change it whenever the equations of the model change, so the old cached results are not reused
+## Settings of the constructed solver that go into the key, so a change of a class default is a new key
+SOLVER_SETTINGS = ("method", "rtol", "atol", "t_f", "outputTimes")
+
+
+class ResultCache:
+    """
+    Persistent on-disk cache of solver runs.
+
+    The key is the sha256 of a canonical JSON of the patient and therapy parameters, the solver class with the
+    options it was given and its effective SOLVER_SETTINGS, and MODEL_VERSION. Each entry is one compressed .npz
+    file with the solution (t, y) at the output times and a few summary metrics. The entries are evicted least
+    recently used first (by the access time kept in the file modification time) whenever the cache grows over
+    maxBytes.
+
+    Only the solvers with the StiffSolver interface (outputTimes and a solution) can be cached, not the fixed step
+    RK4 Solver.
+    """
+    def __init__(self, directory="cache", maxBytes=2 * 1024 ** 3):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        os.makedirs(directory, exist_ok=True)
+
+    def getKey(self, patient, therapy, solver, solverOptions=None):
+        ## Key of the run of a constructed solver of this patient and therapy
+        description = {
+            "modelVersion": MODEL_VERSION,
+            "patient": patient.Organs if hasattr(patient, "schema") else patient.__dict__,    ## FlatPatient: its views
+            "therapy": therapy.__dict__,
+            "injectionProfile": therapy.injectionProfile,
+            "solver": type(solver).__name__,
+            "solverOptions": {name: value for name, value in (solverOptions or dict()).items()
+                              if name not in SOLVER_SETTINGS},
+            "solverSettings": {name: getattr(solver, name) for name in SOLVER_SETTINGS}
+        }
+        text = json.dumps(toCanonical(description), sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def getPath(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def load(self, key):
+        ## {"t", "y", metrics...} of a cached run, or None
+        path = self.getPath(key)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            entry = {name: data[name] for name in data.files}
+        touch(path)  ## Marks the entry as recently used
+        return entry
+
+    def save(self, key, entry):
+        path = self.getPath(key)
+        temporaryPath = path + ".tmp.npz"
+        np.savez_compressed(temporaryPath, **entry)
+        os.replace(temporaryPath, path)  ## Readers never see a partially written entry
+        touch(path)
+        self.evict()
+
+    def evict(self):
+        entries = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                   if name.endswith(".npz") and not name.endswith(".tmp.npz")]
+        entries.sort(key=os.path.getmtime)
+        totalBytes = sum(os.path.getsize(path) for path in entries)
+        while entries and totalBytes > self.maxBytes:
+            path = entries.pop(0)
+            totalBytes -= os.path.getsize(path)
+            os.remove(path)
+
+    def solve(self, patient, therapy, solverClass=StiffSolver, solverOptions=None, outputTimes=None):
+        ## The cached run of this patient, therapy and solver, solved and stored first if it is not in the cache. The
+        ## solver is constructed (not solved) in any case, the key holds its effective settings
+        if not issubclass(solverClass, StiffSolver):
+            raise TypeError("ResultCache only runs solvers with the StiffSolver interface (outputTimes and solution), "
+                            "not {}".format(solverClass.__name__))
+        solver = solverClass(Encoder(patient, therapy), outputTimes=outputTimes,
+                             **(dict() if solverOptions is None else solverOptions))
+        key = self.getKey(patient, therapy, solver, solverOptions)
+        entry = self.load(key)
+        if entry is not None:
+            return entry
+
+        solver.solve()
+        entry = {"t": solver.solution.t, "y": solver.solution.y, "BigVect": solver.BigVect,
+                 "totalCold": solver.totalCold, "totalHot": solver.totalHot, "nfev": solver.solution.nfev,
+                 "AUC": trapezoid(solver.solution.y, solver.solution.t, axis=1)}
+        self.save(key, entry)
+        return entry
+
+
+def touch(path):
+    ## Sets the modification time to the clock of the process, which is finer than the file system timestamps, so
+    ## the entries used one right after the other keep their order
+    now = time.time_ns()
+    os.utime(path, ns=(now, now))
+
+
+def toCanonical(value):
+    ## JSON friendly copy of nested parameters. Floats are written with repr, so equal parameters always give
+    ## the same text and different ones never do
+    if isinstance(value, Mapping):
+        return {str(key): toCanonical(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [toCanonical(item) for item in value]
+    if isinstance(value, np.ndarray):
+        return [toCanonical(item) for item in value.tolist()]
+    if isinstance(value, np.generic):
+        return toCanonical(value.item())
+    if isinstance(value, bool) or value is None or isinstance(value, (int, str)):
+        return value
+    if isinstance(value, float):
+        return repr(value)
+    raise TypeError("Cannot hash a parameter of type {}".format(type(value).__name__))
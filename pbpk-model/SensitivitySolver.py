@@ -0,0 +1,179 @@
+import numpy as np
+from scipy import linalg, sparse
+from scipy.integrate import solve_ivp
+from scipy.optimize import OptimizeResult
+
+from SolverResults import SolverResults
+from StiffSolver import StiffSolver
+
+
+## Parameters of Patient that only enter the model through the parameters derived from them:
+## name --> function of the organ parameters returning {derived parameter: d derived / d name}
+derivedParameters = {
+    "GFR": lambda organ: {"F_fil": organ["phi"], "F_R": organ["phi"] * (1 - organ["f_exc"])},
+    "phi": lambda organ: {"F_fil": organ["GFR"], "F_R": organ["GFR"] * (1 - organ["f_exc"])},
+    "f_exc": lambda organ: {"F_R": -organ["F_fil"]}
+}
+
+
+class SensitivitySolver(StiffSolver):
+    """
+    Forward sensitivity analysis: solves the model together with S_j = dX/dtheta_j for a subset of the parameters.
+
+    Each selected parameter is either (organ name, parameter name), e.g. ("Tumor", "R0"), or a parameter name alone,
+    e.g. "k_on", which stands for the same parameter of every organ that has it (the shared constants of Patient,
+    so S_j is the derivative with respect to all of them together). Parameters that only enter the model through
+    derived ones (GFR --> F_fil, F_R, see derivedParameters) are mapped on them with the chain rule.
+
+    Every selected parameter is a direction w_j in the flat parameter vector theta of the AssemblyMap, so
+        dS_j/dt = J(X) S_j + dSystemMat/dw_j @ X + dB/dw_j(X)
+    The entries of the system matrix that each parameter touches are known from the COO map, so all the
+    dSystemMat/dw_j are stacked once into one sparse (P N, N) matrix and the parameter term is a single mat-vec
+    product; the binding term is the derivative of the binding flux with respect to k_on, R0 and V_int.
+
+    The state and the sensitivities are integrated as one system. Its Jacobian is block lower triangular: J on the
+    diagonal and, below it, the derivative of the sensitivity equations with respect to X, which is only nonzero on
+    the entries of dSystemMat/dw_j and on the receptor binding positions (the binding terms are the only nonlinear
+    ones). Boluses do not depend on the parameters, so S is continuous at the breakpoints and S(t_0) = 0.
+
+    After solve, `sensitivity` holds dX/dtheta_j at the output times, shape (P, N, T), and `sensitivityResults`
+    evaluates it at any time.
+    """
+    snapshotAttributes = ("S",)
+    segmentAttributes = ("segments", "sensitivitySegments")
+
+    def __init__(self, encoder, parameters, useSparse=True, method="BDF", outputTimes=None, rtol=1e-3, atol=1e-6):
+        super().__init__(encoder, useSparse=useSparse, method=method, outputTimes=outputTimes, rtol=rtol, atol=atol)
+        self.assemblyMap = encoder.assemblyMap
+        self.theta = encoder.theta
+        self.N = self.BigVect.shape[0]
+        self.bindingRows, self.bindingCols = encoder.systemMatricEncoder.getBindingPositions()
+        self.setDirections(parameters)
+        self.setParameterDerivatives()
+
+    def setDirections(self, parameters):
+        ## W[:, j] is the direction of the j-th selected parameter in theta
+        parameterIndex = self.assemblyMap.parameterIndex
+        self.parameterNames = []
+        self.W = np.zeros((self.theta.shape[0], len(parameters)))
+        for j, parameter in enumerate(parameters):
+            if isinstance(parameter, str):
+                targets = [name for name in self.assemblyMap.parameterNames if name[1] == parameter]
+            else:
+                targets = [tuple(parameter)]
+            if not targets or any(target not in parameterIndex for target in targets):
+                raise KeyError("Unknown parameter: {}".format(parameter))
+            for organName, paramName in targets:
+                self.W[parameterIndex[(organName, paramName)], j] += 1
+                if paramName in derivedParameters:
+                    organ = {name[1]: self.theta[i] for name, i in parameterIndex.items() if name[0] == organName}
+                    for derivedName, derivative in derivedParameters[paramName](organ).items():
+                        self.W[parameterIndex[(organName, derivedName)], j] += derivative
+            self.parameterNames.append(parameter if isinstance(parameter, str) else "/".join(parameter))
+        self.P = len(parameters)
+
+    def setParameterDerivatives(self):
+        ## Entry k of the COO map is signs[k] * theta[paramIndex[k]] / theta[volumeIndex[k]], its derivative in the
+        ## direction w_j is signs[k] * w_j[paramIndex[k]] / volume - value[k] * w_j[volumeIndex[k]] / volume
+        assemblyMap = self.assemblyMap
+        volume = self.theta[assemblyMap.volumeIndex]
+        values = assemblyMap.getValues(self.theta)
+        dValues = ((assemblyMap.signs / volume)[:, None] * self.W[assemblyMap.paramIndex]
+                   - (values / volume)[:, None] * self.W[assemblyMap.volumeIndex])
+        j, k = np.nonzero(dValues.T)
+        self.dSystemMat = sparse.csr_matrix((dValues[k, j], (j * self.N + assemblyMap.rows[k], assemblyMap.cols[k])),
+                                            shape=(self.P * self.N, self.N))
+        ## dSystemMat/dw_j @ X is linear in X, so dSystemMat is also the constant part of the coupling blocks of the
+        ## Jacobian (see augmentedJac)
+        coupling = self.dSystemMat.tocoo()
+        self.couplingRows = coupling.row + self.N
+        self.couplingCols = coupling.col
+        self.couplingValues = coupling.data
+
+        ## Directions of the binding parameters (P, receptor organs)
+        parameterIndex = assemblyMap.parameterIndex
+        binding = self.binding
+        self.dK_on = self.W[[parameterIndex[(name, "k_on")] for name in binding.names]].T
+        self.dR0 = self.W[[parameterIndex[(name, "R0")] for name in binding.names]].T
+        self.dV_int = self.W[[parameterIndex[(name, "V_int")] for name in binding.names]].T
+
+    def getBindingTerms(self, X, S):
+        ## With flux = kOnPerVolume * P_int * free (free = R0 - RP - RP*, for the labeled and the unlabeled peptide)
+        ## and its derivative dKOnPerVolume in the direction w_j, returns the arrays (P, 2 * receptor organs)
+        ##   kOnPerVolume, P_int, dKOnPerVolume, the total derivative of the binding flux (J_B S_j + dB/dw_j) and
+        ##   the derivative of the flux with respect to P_int of the parameter part (dRate)
+        binding = self.binding
+        free = binding.R0 - (X[binding.RP_labeled] + X[binding.RP_unlabeled])
+        dKOnPerVolume = np.tile(self.dK_on / binding.V_int - binding.kOnPerVolume * self.dV_int / binding.V_int, 2)
+        dRate = dKOnPerVolume * np.tile(free, 2) + np.tile(binding.kOnPerVolume * self.dR0, 2)
+        kOnPerVolume = np.tile(binding.kOnPerVolume, 2)
+        P_int = X[binding.P_int]
+        S_bound = np.tile(S[:, binding.RP_labeled] + S[:, binding.RP_unlabeled], 2)
+        dFlux = (kOnPerVolume * np.tile(free, 2) * S[:, binding.P_int] - kOnPerVolume * P_int * S_bound
+                 + dRate * P_int)
+        return kOnPerVolume, P_int, dKOnPerVolume, S_bound, dFlux, dRate
+
+    def augmentedF(self, t, Y):
+        X = Y[:self.N]
+        S = Y[self.N:].reshape(self.P, self.N)
+        dX = self.F(t, X)
+        ## dS_j = SystemMat S_j + dSystemMat/dw_j X plus the binding terms of J S_j + dB/dw_j
+        dS = (self.SystemMatSparse @ S.T).T + (self.dSystemMat @ X).reshape(self.P, self.N)
+        binding = self.binding
+        dFlux = self.getBindingTerms(X, S)[4]
+        dS[:, binding.RP] += dFlux
+        dS[:, binding.P_int] -= dFlux
+        return np.concatenate([dX, dS.ravel()])
+
+    def augmentedJac(self, t, Y):
+        X = Y[:self.N]
+        S = Y[self.N:].reshape(self.P, self.N)
+        J = self.jac(t, X)
+        ## Coupling blocks d(dS_j)/dX: dSystemMat/dw_j plus the binding entries, in the order of getBindingPositions
+        ## (for each receptor organ: the RP* and P*_int rows, then the RP and P_int rows, each on the P_int, RP and
+        ## RP* columns)
+        kOnPerVolume, P_int, dKOnPerVolume, S_bound, dFlux, dRate = self.getBindingTerms(X, S)
+        binding = self.binding
+        dP_int = -kOnPerVolume * S_bound + dRate
+        dBound = -(kOnPerVolume * S[:, binding.P_int] + dKOnPerVolume * P_int)
+        n = binding.RP_labeled.shape[0]
+        blocks = []
+        for d_P, d_RP in [(dP_int[:, :n], dBound[:, :n]), (dP_int[:, n:], dBound[:, n:])]:
+            entries = np.stack([d_P, d_RP, d_RP], axis=2)
+            blocks += [entries, -entries]
+        values = np.concatenate([np.concatenate(blocks, axis=2).ravel(), self.couplingValues])
+        rows = np.concatenate([(np.arange(1, self.P + 1)[:, None] * self.N + self.bindingRows[None, :]).ravel(),
+                               self.couplingRows])
+        cols = np.concatenate([np.tile(self.bindingCols, self.P), self.couplingCols])
+        size = (self.P + 1) * self.N
+        if isinstance(J, np.ndarray):
+            augmented = linalg.block_diag(*[J] * (self.P + 1))
+            np.add.at(augmented, (rows, cols), values)
+            return augmented
+        return (sparse.block_diag([J] * (self.P + 1), format="csc")
+                + sparse.csc_matrix((values, (rows, cols)), shape=(size, size)))
+
+    def reset(self):
+        super().reset()
+        self.S = np.zeros(self.P * self.N)
+        self.sensitivitySegments = []
+
+    def integrateSegment(self, t_start, t_end, X):
+        options = dict() if self.firstStep is None else {"first_step": self.firstStep}
+        result = solve_ivp(self.augmentedF, [t_start, t_end], np.concatenate([X, self.S]), method=self.method,
+                           jac=self.augmentedJac, dense_output=True, rtol=self.rtol, atol=self.atol, **options)
+        self.S = result.y[self.N:, -1].copy()
+        self.sensitivitySegments.append(OptimizeResult(t=result.t, y=result.y[self.N:],
+                                                       sol=lambda t, sol=result.sol: sol(t)[self.N:]))
+        return OptimizeResult(t=result.t, y=result.y[:self.N], sol=lambda t, sol=result.sol: sol(t)[:self.N],
+                              nfev=result.nfev, njev=result.njev, nlu=result.nlu, success=result.success)
+
+    def solve(self):
+        super().solve()
+        self.sensitivityResults = SolverResults(self.sensitivitySegments, self.organsObj)
+        self.sensitivity = self.getSensitivity(self.solution.t)
+
+    def getSensitivity(self, t):
+        ## dX/dtheta_j at the times t, shape (P, N, len(t))
+        t = np.atleast_1d(np.asarray(t, dtype=float))
+        return self.sensitivityResults(t).reshape(self.P, self.N, t.shape[0])
@@ -1,13 +1,29 @@
+import time
+
 import numpy as np
-import matplotlib.pyplot as plt
 from scipy.integrate import solve_ivp
 
+from TrajectoryRecorder import TrajectoryRecorder
+from SolverStats import SolverStats
+
 
 class Solver:
-    def __init__(self, encoder):
+    def __init__(self, encoder, useSparse=True, incrementalK_on=False, recorder=None):
         # Copy the system matrix and initial state vector from the encoder object
-        self.SystemMat = encoder.SystemMat.copy()
-        self.BigVect = encoder.BigVect.copy()
+        # The sparse (CSR) copy of the system matrix is used for the mat-vec products when useSparse is True,
+        # otherwise the dense matrix is used
+        self.useSparse = useSparse
+        # When incrementalK_on is True the system matrix is never copied or updated. The state dependent K_on terms
+        # are added to the right hand side as a precomputed scatter instead (see F_incremental)
+        self.incrementalK_on = incrementalK_on
+        # The matrices and the state of the encoder, every run starts from them (see reset)
+        self.encoderSystemMat = encoder.SystemMat.copy()
+        self.encoderSystemMatSparse = encoder.SystemMatSparse.copy()
+        self.encoderBigVect = encoder.BigVect.copy()
+        self.SystemMat = self.encoderSystemMat.copy()
+        self.SystemMatSparse = self.encoderSystemMatSparse.copy()
+        self.SystemMatSparseWork = self.SystemMatSparse.copy()
+        self.BigVect = self.encoderBigVect.copy()
 
         # Retrieve the organ information and injection profile from the encoder object
         self.organsObj = encoder.organsObj
@@ -16,17 +32,34 @@ class Solver:
         # Initialize simulation configuration and injection settings
         self.setSimConf()
         self.setInjection()
-
-        # Initialize a matrix to store the state of the system at each time step
-        # The number of rows equals the length of the state vector
-        # The number of columns equals the number of time steps
-        self.BigVectList = np.zeros((self.BigVect.shape[0], self.tList.shape[0]))
+        self.setK_onDataIndex(encoder)
+        self.setK_onScatter()
+
+        # The states of all time steps are streamed to disk by the recorder (a TrajectoryRecorder), which also keeps
+        # the previous state for getSystemMat. After solve, BigVectList is a memory-mapped (N, number of time steps)
+        # view of the recorded states
+        if recorder is None:
+            recorder = TrajectoryRecorder(self.BigVect.shape[0])
+        self.recorder = recorder
+        self.reset()
+
+    def reset(self):
+        # Start of a run: the matrices, the state and the injection bookkeeping of the encoder. The states of an
+        # earlier run stay in their recorder, the new run is recorded by a new recorder of the same kind
+        if self.recorder.count:
+            self.recorder = self.recorder.getEmpty()
+        self.SystemMat = self.encoderSystemMat.copy()
+        self.SystemMatSparse = self.encoderSystemMatSparse.copy()
+        self.SystemMatSparseWork = self.SystemMatSparse.copy()
+        self.BigVect = self.encoderBigVect.copy()
+        self.setInjection()
 
         # Perform the first injection at t = 0
         self.inject(0)
 
-        # Store the initial state in the first column of BigVectList
-        self.BigVectList[:, 0] = self.BigVect.copy()
+        # Record the initial state
+        self.initialState = self.BigVect.copy()
+        self.recorder.append(self.tList[0], self.BigVect)
 
     def setInjection(self):
         # Initialize total amount of hot and cold injections to zero
@@ -57,6 +90,60 @@ class Solver:
             self.eachBolusCold = self.injectionProfile["totalAmountCold"] / self.injectionProfile["N"]
             self.eachBolusHot = self.injectionProfile["totalAmountHot"] / self.injectionProfile["N"]
 
+    def setK_onDataIndex(self, encoder):
+        # For each RecPos organ, get the positions of its K_on entries in the data array of the sparse system matrix
+        # and their signs, so the sparse matrix can be updated without any lookups in the hot loop
+        self.K_onDataIndex = dict()
+        self.K_onSigns = dict()
+        for key in self.organsObj.organsDict["RecPos"].keys():
+            organ = self.organsObj.organsDict["RecPos"][key]
+            positions = np.array(organ["sysMatMap"]["K_on"])
+            rows = positions[:, 0] + organ["stencil"]["base"]
+            cols = positions[:, 1] + organ["stencil"]["base"]
+            self.K_onDataIndex[key] = encoder.systemMatricEncoder.getSparseDataIndex(rows, cols)
+            self.K_onSigns[key] = positions[:, 2].astype(float)
+
+    def setK_onScatter(self):
+        # Flatten the K_on entries of all RecPos organs into index arrays for F_incremental:
+        # the row, column and sign of each entry and the organ it belongs to
+        rows = []
+        cols = []
+        signs = []
+        organIndex = []
+        self.RP_index = []
+        self.RP_unlabeled_index = []
+        R0 = []
+        k_on = []
+        for k, key in enumerate(self.organsObj.organsDict["RecPos"].keys()):
+            organ = self.organsObj.organsDict["RecPos"][key]
+            for elem in organ["sysMatMap"]["K_on"]:
+                rows.append(elem[0] + organ["stencil"]["base"])
+                cols.append(elem[1] + organ["stencil"]["base"])
+                signs.append(elem[-1])
+                organIndex.append(k)
+            self.RP_index.append(organ["stencil"]["base"] + organ["bigVectMap"]["RP"])
+            self.RP_unlabeled_index.append(organ["stencil"]["base"] + organ["bigVectMap"]["RP*"])
+            R0.append(organ["R0"])
+            k_on.append(organ["k_on"])
+
+        # Every row appears only once (the organs do not overlap and each K_on entry of an organ is in its own row),
+        # so the scatter can be done with a plain fancy-indexed add
+        self.K_onRows = np.array(rows, dtype=int)
+        self.K_onCols = np.array(cols, dtype=int)
+        self.K_onSignsScatter = np.array(signs, dtype=float)
+        self.K_onOrganIndex = np.array(organIndex, dtype=int)
+        self.RP_index = np.array(self.RP_index, dtype=int)
+        self.RP_unlabeled_index = np.array(self.RP_unlabeled_index, dtype=int)
+        self.R0 = np.array(R0, dtype=float)
+        self.k_on = np.array(k_on, dtype=float)
+
+        # Preallocated buffers of the RK4 stages, so the step loop does not allocate state sized arrays
+        self.f0 = np.zeros(self.BigVect.shape)
+        self.f1 = np.zeros(self.BigVect.shape)
+        self.f2 = np.zeros(self.BigVect.shape)
+        self.f3 = np.zeros(self.BigVect.shape)
+        self.stage = np.zeros(self.BigVect.shape)
+
     def setSimConf(self):
         # Initial time for the simulation
         t_0 = 0
@@ -81,11 +168,19 @@ class Solver:
 
         # Perform matrix-vector multiplication between the system matrix and the state vector
         # to get the rate of change of the system
+        if self.useSparse:
+            return SystemMat @ X
         return np.matmul(SystemMat, X)
 
     def getSystemMat(self, X, i):
-        # Create a copy of the current system matrix
-        SystemMat = self.SystemMat.copy()
+        # The current system matrix with the K_on entries of the state X: a copy of the dense matrix.
+        # The sparse matrix is not copied: SystemMatSparseWork has the same sparsity pattern and only differs from
+        # SystemMatSparse in the K_on entries, which are all overwritten below. The returned matrix is only valid
+        # until the next call
+        if self.useSparse:
+            SystemMat = self.SystemMatSparseWork
+        else:
+            SystemMat = self.SystemMat.copy()
 
         # TODO: Kidney needs to be added as well
         # Iterate over keys in the RecPos (Receptor Positive) organs dictionary (Tumor, Liver, Kidney, etc.)
@@ -94,7 +189,7 @@ class Solver:
             organ = self.organsObj.organsDict["RecPos"][key]
 
             # Get the previous state vector for time i-1
-            BigVector_pre = self.BigVectList[:, i - 1].copy()
+            BigVector_pre = self.recorder.getPrevious()
 
             # Calculate the index of the receptor positive (RP) and RP* (unlabeled) compartments in the BigVector
             RP_index = organ["stencil"]["base"] + organ["bigVectMap"]["RP"]
@@ -105,6 +200,11 @@ class Solver:
             K_on = (organ["R0"] - (X[RP_index] + X[RP_unlabeled_index])) * organ["k_on"]
 
             # Update the system matrix based on the change in K_on
+            if self.useSparse:
+                dataIndex = self.K_onDataIndex[key]
+                SystemMat.data[dataIndex] = (self.SystemMatSparse.data[dataIndex]
+                                             + self.K_onSigns[key] * (K_on - K_on_pre))
+                continue
             for elem in organ["sysMatMap"]["K_on"]:
                 sign = elem[-1]
                 pos = np.array(elem[:-1]) + organ["stencil"]["base"]
@@ -112,7 +212,72 @@ class Solver:
         # Return the updated system matrix
         return SystemMat
 
+    def getK_on(self, X):
+        # K_on = k_on * (R0 - bound receptors) of every RecPos organ
+        return (self.R0 - (X[self.RP_index] + X[self.RP_unlabeled_index])) * self.k_on
+
+    def F_incremental(self, X, out):
+        # Same right hand side as F, written into 'out'.
+        # getSystemMat adds K_on(X) - K_on(previous state) to a matrix that already holds all of the previous
+        # updates, so the sum telescopes and the matrix used by F is always the initial one plus
+        # K_on(X) - K_on(initial state). That correction only touches the K_on entries, so it is applied as a
+        # scatter on top of the product with the constant matrix
+        if self.useSparse:
+            out[:] = self.SystemMatSparse @ X
+        else:
+            np.dot(self.SystemMat, X, out=out)
+        K_on_change = self.getK_on(X) - self.K_on_initial
+        out[self.K_onRows] += self.K_onSignsScatter * K_on_change[self.K_onOrganIndex] * X[self.K_onCols]
+        return out
+
+    def solveIncremental(self):
+        # RK4 with the constant system matrix and the K_on scatter (see F_incremental). The stages are written into
+        # preallocated buffers and the state is updated in place
+        self.K_on_initial = self.getK_on(self.initialState)
+        X = self.BigVect
+        for j, t in enumerate(self.tList[1:]):
+            i = j + 1
+
+            # Inject substances at time t (inject updates self.BigVect in place)
+            self.inject(t)
+
+            self.F_incremental(X, self.f0)
+            np.multiply(self.f0, self.h / 2, out=self.stage)
+            self.stage += X
+            self.F_incremental(self.stage, self.f1)
+            np.multiply(self.f1, self.h / 2, out=self.stage)
+            self.stage += X
+            self.F_incremental(self.stage, self.f2)
+            np.multiply(self.f2, self.h, out=self.stage)
+            self.stage += X
+            self.F_incremental(self.stage, self.f3)
+
+            # X += h/6 * (f0 + 2*f1 + 2*f2 + f3)
+            self.f1 += self.f2
+            self.f1 *= 2
+            self.f1 += self.f0
+            self.f1 += self.f3
+            self.f1 *= self.h / 6
+            X += self.f1
+
+            self.recorder.append(t, X)
+
+        self.BigVectList = self.recorder.getStates().T
+
     def solve(self):
+        # Fixed step RK4: every step is accepted and takes 4 evaluations of the right hand side
+        start = time.perf_counter()
+        # A solver that already recorded steps starts over from the initial state
+        if self.recorder.count > 1:
+            self.reset()
+        self.stats = SolverStats()
+        self.stats.addStep(self.h, count=self.tList.shape[0] - 1)
+        self.stats.nfev = 4 * (self.tList.shape[0] - 1)
+        if self.incrementalK_on:
+            self.solveIncremental()
+            self.stats.wallTime = time.perf_counter() - start
+            return
+
         # Loop through the time list, starting from the second element
         for j, t in enumerate(self.tList[1:]):
             # Calculate the true index (enumerate starts at 0)
@@ -131,21 +296,24 @@ class Solver:
             self.BigVect = self.BigVect + self.h / 6 * (f0 + 2 * f1 + 2 * f2 + f3)
 
             # Update the system matrix based on the new state
-            self.SystemMat = self.getSystemMat(self.BigVect, i)
+            # (the sparse matrices swap roles, so the next step writes its K_on entries into the old one)
+            if self.useSparse:
+                SystemMat = self.getSystemMat(self.BigVect, i)
+                self.SystemMatSparse, self.SystemMatSparseWork = SystemMat, self.SystemMatSparse
+            else:
+                self.SystemMat = self.getSystemMat(self.BigVect, i)
 
-            # Store the new state vector into the list of all state vectors
-            self.BigVectList[:, i] = self.BigVect.copy()
+            # Record the new state vector
+            self.recorder.append(t, self.BigVect)
 
-            # Print the current iteration if it's a multiple of 1000 (for debugging or monitoring)
-            if j % 1000 == 0:
-                print(j)
+        self.BigVectList = self.recorder.getStates().T
+        self.stats.wallTime = time.perf_counter() - start
 
         ####  Debugging
         # debugList = [9,11,13,15]
         # peptide = self.BigVectList[0,:]*0
         # for i in debugList:
         #     peptide += self.BigVectList[i,:]
-        print("Hello")
 
     def inject(self, t):
         # Check if the injection type is constant
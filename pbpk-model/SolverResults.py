@@ -0,0 +1,78 @@
+import numpy as np
+from scipy.interpolate import interp1d
+from scipy.optimize import OptimizeResult
+
+
+class SolverResults:
+    """
+    Continuous solution of a solver run, made of the dense interpolants of its smooth segments (one per injection
+    segment, see InjectionSchedule). The state is evaluated lazily at any requested times, so the output grid is
+    independent of the steps the integrator took.
+
+    The solution is right continuous: at a bolus time it returns the state right after the bolus. A segment without
+    a dense interpolant (segment.sol is None) falls back to the linear interpolation of its stored samples.
+    """
+    clinicalSamplingTimes = np.array([0.5, 1, 2, 4, 24, 48, 72, 96, 168]) * 60  ## Typical imaging time points (min)
+
+    def __init__(self, segments, organsObj):
+        self.organsObj = organsObj
+        self.N = segments[0].y.shape[0]   ## organsObj.N for the states, other sizes for e.g. the sensitivities
+        self.starts = np.array([segment.t[0] for segment in segments])
+        self.t_0 = segments[0].t[0]
+        self.t_f = segments[-1].t[-1]
+        self.interpolants = [self.getInterpolant(segment) for segment in segments]
+
+    def getInterpolant(self, segment):
+        if getattr(segment, "sol", None) is not None:
+            return segment.sol
+        if segment.t.shape[0] == 1:
+            return lambda t: np.repeat(segment.y[:, :1], np.size(t), axis=1)
+        return interp1d(segment.t, segment.y, axis=1, assume_sorted=True)
+
+    def __call__(self, t):
+        ## State at the times t: (N,) for a scalar t, (N, len(t)) otherwise
+        tArray = np.atleast_1d(np.asarray(t, dtype=float))
+        if np.any(tArray < self.t_0) or np.any(tArray > self.t_f):
+            raise ValueError("The requested times must be in [{}, {}]".format(self.t_0, self.t_f))
+
+        segmentIndex = np.clip(np.searchsorted(self.starts, tArray, side="right") - 1, 0, len(self.interpolants) - 1)
+        Y = np.zeros((self.N, tArray.shape[0]))
+        for k in np.unique(segmentIndex):
+            mask = segmentIndex == k
+            Y[:, mask] = self.interpolants[k](tArray[mask])
+        if np.ndim(t) == 0:
+            return Y[:, 0]
+        return Y
+
+    def getLogTimes(self, n=200, t_min=1e-2):
+        ## t_0 followed by n log spaced times from t_0 + t_min to t_f
+        return np.concatenate([[self.t_0], self.t_0 + np.logspace(np.log10(t_min), np.log10(self.t_f - self.t_0), n)])
+
+    def getClinicalTimes(self):
+        return self.clinicalSamplingTimes[self.clinicalSamplingTimes <= self.t_f]
+
+    def getSolution(self, t):
+        ## OptimizeResult with the t and y fields of a solve_ivp result (what DataProcessing reads)
+        t = np.asarray(t, dtype=float)
+        return OptimizeResult(t=t, y=self(t))
+
+    def getOrganIndex(self, organName):
+        for organType in self.organsObj.organsDict.values():
+            for organ in organType.values():
+                if organ["name"] == organName:
+                    return organ["stencil"]["base"], organ["bigVectMap"]
+        raise KeyError("Unknown organ: {}".format(organName))
+
+    def getOrgan(self, organName, t, variables=None):
+        ## {variable: values at t} of one organ, e.g. getOrgan("Kidney", t, ["RP*", "P*_intern"])
+        base, bigVectMap = self.getOrganIndex(organName)
+        if variables is None:
+            variables = list(bigVectMap.keys())
+        Y = self(t)
+        return {variable: Y[base + bigVectMap[variable]] for variable in variables}
+
+    def getOrganAmount(self, organName, t, labeled=True):
+        ## Summed amount of all the labeled (*) or unlabeled variables of one organ at t
+        base, bigVectMap = self.getOrganIndex(organName)
+        index = [base + i for variable, i in bigVectMap.items() if ("*" in variable) == labeled]
+        return self(t)[index].sum(axis=0)
@@ -0,0 +1,39 @@
+import pickle
+
+
+class SolverSnapshot:
+    """
+    State of a paused StiffSolver run (see StiffSolver.getSnapshot), enough to continue it with advance:
+        t, X                    time and state vector
+        totalCold, totalHot     injection bookkeeping: the amounts injected so far and the time of the last
+        injectedAt              inject call (the boluses of that time are already in X)
+        stepSize                last accepted step size, the first step of a run resumed inside a smooth segment
+        stats, monitor          copies of the SolverStats and of the MassBalanceMonitor (None without one)
+        attributes              the integrator history of the subclasses (snapshotAttributes, e.g. the step level of
+                                the ExponentialSolver or the sensitivities of the SensitivitySolver)
+        segments                the integrated segments of each segmentAttributes list, only with keepSegments=True
+                                (the dense outputs make up most of the memory of a run)
+
+    The arrays are copies, so the snapshot does not change when the solver continues. Without the segments a
+    snapshot only holds a few state sized arrays and pickles to a few kB.
+    """
+    def __init__(self, t, X, totalCold, totalHot, injectedAt, stepSize, stats, monitor, attributes, segments=None):
+        self.t = t
+        self.X = X
+        self.totalCold = totalCold
+        self.totalHot = totalHot
+        self.injectedAt = injectedAt
+        self.stepSize = stepSize
+        self.stats = stats
+        self.monitor = monitor
+        self.attributes = attributes
+        self.segments = segments
+
+    def save(self, path):
+        with open(path, "wb") as file:
+            pickle.dump(self, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def loadSnapshot(path):
+    with open(path, "rb") as file:
+        return pickle.load(file)
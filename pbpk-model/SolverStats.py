@@ -0,0 +1,83 @@
+import math
+
+import numpy as np
+
+
+class SolverStats:
+    """
+    Counters of a solver run, the same for every engine:
+        nsteps      accepted steps
+        nrejected   rejected step attempts (None for the runs that do not count them: solve_ivp and LSODA)
+        nfev        right hand side evaluations
+        njev        Jacobian evaluations (linearizations for the ExponentialSolver)
+        nlu         LU decompositions (matrix exponentials for the ExponentialSolver)
+        wallTime    seconds spent in solve
+    plus a histogram of the accepted step sizes on fixed log spaced bins (binsPerDecade bins per decade between
+    hMin and hMax, the steps outside are counted in the first / last bin), so its memory does not grow with the run.
+    """
+    def __init__(self, hMin=1e-6, hMax=1e6, binsPerDecade=4, countsRejections=True):
+        self.nsteps = 0
+        self.nrejected = 0 if countsRejections else None
+        self.nfev = 0
+        self.njev = 0
+        self.nlu = 0
+        self.wallTime = 0.0
+
+        self.logMin = math.log10(hMin)
+        self.binsPerDecade = binsPerDecade
+        self.binEdges = np.logspace(self.logMin, math.log10(hMax),
+                                    int(round((math.log10(hMax) - self.logMin) * binsPerDecade)) + 1)
+        self.stepCounts = np.zeros(self.binEdges.shape[0] - 1, dtype=int)
+
+    def getBin(self, h):
+        index = int((math.log10(h) - self.logMin) * self.binsPerDecade) if h > 0 else 0
+        return min(max(index, 0), self.stepCounts.shape[0] - 1)
+
+    def addStep(self, h, count=1):
+        self.nsteps += count
+        self.stepCounts[self.getBin(h)] += count
+
+    def addSteps(self, hList):
+        ## Vectorized addStep for an array of step sizes
+        hList = np.asarray(hList, dtype=float)
+        hList = hList[hList > 0]
+        index = ((np.log10(hList) - self.logMin) * self.binsPerDecade).astype(int)
+        np.add.at(self.stepCounts, np.clip(index, 0, self.stepCounts.shape[0] - 1), 1)
+        self.nsteps += hList.shape[0]
+
+    def addReject(self, count=1):
+        self.nrejected += count
+
+    def addSolveIvp(self, result):
+        ## Counters of a solve_ivp (or StiffSolver segment) result
+        self.addSteps(np.diff(result.t))
+        self.nfev += result.nfev
+        self.njev += result.njev
+        self.nlu += result.nlu
+        if getattr(result, "nrejected", None) is not None:  ## Only reported by the solvers with their own step loop
+            self.nrejected = (self.nrejected or 0) + result.nrejected
+
+    def getRejectRatio(self):
+        if self.nrejected is None or self.nsteps + self.nrejected == 0:
+            return None
+        return self.nrejected / (self.nsteps + self.nrejected)
+
+    def getHistogram(self):
+        ## (bin edges, counts) of the accepted step sizes
+        return self.binEdges, self.stepCounts
+
+    def asDict(self):
+        return {"nsteps": self.nsteps, "nrejected": self.nrejected, "rejectRatio": self.getRejectRatio(),
+                "nfev": self.nfev, "njev": self.njev, "nlu": self.nlu, "wallTime": self.wallTime,
+                "stepsPerSecond": self.nsteps / self.wallTime if self.wallTime > 0 else None,
+                "stepSizeBins": self.binEdges.tolist(), "stepSizeCounts": self.stepCounts.tolist()}
+
+    def __str__(self):
+        rejectRatio = self.getRejectRatio()
+        lines = ["steps: {}, rejected: {} ({}), nfev: {}, njev: {}, nlu: {}, wall time: {:.3f} s".format(
+            self.nsteps, self.nrejected, "n/a" if rejectRatio is None else "{:.1%}".format(rejectRatio),
+            self.nfev, self.njev, self.nlu, self.wallTime)]
+        for k in np.flatnonzero(self.stepCounts):
+            lines.append("  h in [{:.2e}, {:.2e}): {}".format(self.binEdges[k], self.binEdges[k + 1],
+                                                               self.stepCounts[k]))
+        return "\n".join(lines)
@@ -1,21 +1,45 @@
+import copy
+import time
+
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.integrate import solve_ivp
+from scipy import integrate
+from scipy.integrate import OdeSolution, solve_ivp
+from scipy.optimize import OptimizeResult
+
+from InjectionSchedule import InjectionSchedule
+from SolverResults import SolverResults
+from SolverSnapshot import SolverSnapshot
+from SolverStats import SolverStats
 
 
 class StiffSolver:
-    def __init__(self, encoder):
+    ## Attributes of the subclasses that are part of the state of a run (copied into the snapshots) and the lists of
+    ## integrated segments (shared by the forks)
+    snapshotAttributes = ()
+    segmentAttributes = ("segments",)
+
+    def __init__(self, encoder, useSparse=True, method="BDF", useJacobian=True, outputTimes=None, rtol=1e-3,
+                 atol=1e-6, monitor=None, countRejections=False):
+        self.useSparse = useSparse  ## Use the sparse (CSR) system matrix for the mat-vec products. Dense is the fallback
+        self.method = method    ## Any implicit method of solve_ivp: BDF, Radau, LSODA
+        self.useJacobian = useJacobian  ## Analytic Jacobian (jac) instead of the finite differences of solve_ivp
+        self.rtol = rtol    ## Tolerances of solve_ivp
+        self.atol = atol
+        self.monitor = monitor  ## Optional MassBalanceMonitor, updated at every accepted step
+        ## Step the integrator here instead of solve_ivp, so the stats also count the rejected steps (not for LSODA)
+        self.countRejections = countRejections
+        self.firstStep = None   ## First step of the next segment (None: chosen by the integrator)
         self.SystemMat = encoder.SystemMat.copy()
+        self.SystemMatSparse = encoder.SystemMatSparse.copy()
         self.BigVect = encoder.BigVect.copy()
+        self.initialState = encoder.BigVect.copy()
         self.organsObj = encoder.organsObj
         self.injectionProfile = self.organsObj.therapy.injectionProfile
 
-        self.setSimConf()
+        self.setSimConf(outputTimes)
         self.setInjection()
-
-        self.BigVectList = np.zeros((self.BigVect.shape[0], self.tList.shape[0]))
-        self.BigVect = self.inject(0, self.BigVect)  ## Doing the very first Injection
-        self.BigVectList[:,0] = self.BigVect.copy()
+        self.setBinding(encoder)
+        self.setJacobian(encoder)
 
 
 
@@ -26,61 +50,77 @@ class StiffSolver:
         Vein_dict = self.organsObj.organsDict["ArtVein"]["Vein"]
         self.Vein_index_cold = Vein_dict["stencil"]["base"] + Vein_dict["bigVectMap"]["P"]  ## the place of P_vein in the BigVect
         self.Vein_index_hot = Vein_dict["stencil"]["base"] + Vein_dict["bigVectMap"]["P*"]  ## the place of P_vein in the BigVect
-        if self.injectionProfile["type"] == "constant":
-            t0 = self.injectionProfile["t0"]
-            tf = self.injectionProfile["tf"]
-            self.toInjectAtEachTimeStep_Hot = self.injectionProfile["totalAmountHot"]*self.h / (tf - t0)    ## injection amount at each time step
-            self.toInjectAtEachTimeStep_Cold = self.injectionProfile["totalAmountCold"]*self.h / (tf - t0)    ## injection amount at each time step
-
-        if self.injectionProfile["type"] == "bolus":
-            self.singleBolusFlag = 0    ## This will help us to make sure that just one bolus will be injected
-
-        if self.injectionProfile["type"] == "bolusTrain":
-            self.multiBolusFlag = 0     ## This will help us to inject exactly N boluses
-            self.eachBolusCold = self.injectionProfile["totalAmountCold"] / self.injectionProfile["N"]
-            self.eachBolusHot = self.injectionProfile["totalAmountHot"] / self.injectionProfile["N"]
-
-
-
-    def setSimConf(self):
-        # t_0 = 0
-        # t_f = 1200        ## 75 for l=16 works best. So increase l by one if you do t_f = 150
-        # l = 20
 
-        t_0 = 0
-        t_f = 35        ## 75 for l=16 works best. So increase l by one if you do t_f = 150
-        l = 15
-        self.tList = np.linspace(t_0, t_f, 2 ** (l))
-        self.h = self.tList[1] - self.tList[0]
+        ## The injection profile is compiled into boluses (applied between two integration segments) and constant
+        ## infusions (a rate source term of F). F itself never changes the state or the injection bookkeeping
+        self.injectionSchedule = InjectionSchedule(self.injectionProfile)
+        self.rateCold = 0.0
+        self.rateHot = 0.0
+
+
+    def setBinding(self, encoder):
+        ## Index arrays and parameters of the receptor binding terms, compiled once by the encoder, plus the
+        ## preallocated buffers that getBFunction writes into
+        self.binding = encoder.bindingEncoder
+        self.B = np.zeros(self.BigVect.shape)
+        self.bindingFlux = np.zeros(self.binding.RP.shape)
+
+    def setJacobian(self, encoder):
+        ## JacobianPattern holds SystemMat on the nonzero pattern of the full Jacobian. Row k of JacobianDataIndex
+        ## holds the positions of the 12 binding derivatives of the k-th receptor organ in its data array (see
+        ## getBindingPositions for the order)
+        self.JacobianPattern = encoder.JacobianPattern.copy()
+        rows, cols = encoder.systemMatricEncoder.getBindingPositions()
+        self.JacobianDataIndex = encoder.systemMatricEncoder.getSparseDataIndex(
+            rows, cols, self.JacobianPattern).reshape(-1, 12)
+
+    def setSimConf(self, outputTimes):
+        self.t_0 = 0
+        self.t_f = 100000
+        ## Times of self.solution. The integrator picks its own steps, the output is evaluated from the dense solution
+        if outputTimes is None:
+            outputTimes = np.concatenate([[self.t_0], np.logspace(-2, np.log10(self.t_f), 200)])
+        self.outputTimes = np.asarray(outputTimes, dtype=float)
 
     def F(self, t, X):
-        X = self.inject(t, X)
         B = self.getBFunction(X)
-        return np.matmul(self.SystemMat, X) + B
+        if self.useSparse:
+            dX = self.SystemMatSparse @ X + B
+        else:
+            dX = np.matmul(self.SystemMat, X) + B
+        dX[self.Vein_index_cold] += self.rateCold
+        dX[self.Vein_index_hot] += self.rateHot
+        return dX
 
     def getBFunction(self, X):
-        B = np.zeros(X.shape)
-        organTypes = ["Kidney", "RecPos"]
-        for type in organTypes:
-
-            for organ in self.organsObj.patient.Organs[type]:  ## Tumor, Kidney, etc
-                organDict = self.organsObj.organsDict[type][organ["name"]]
-
-                RP_index_labeled = organDict["stencil"]["base"] + organDict["bigVectMap"]["RP*"]
-                RP_unlabeled_index = organDict["stencil"]["base"] + organDict["bigVectMap"]["RP"]
-
-                P_int_labeled = organDict["stencil"]["base"] + organDict["bigVectMap"]["P*_int"]
-                P_int_unlabaled = organDict["stencil"]["base"] + organDict["bigVectMap"]["P_int"]
-
-                binded = X[RP_index_labeled] + X[RP_unlabeled_index]
-
-                B[RP_index_labeled] = organDict["k_on"] * X[P_int_labeled] * (organDict["R0"] - binded) / organ["V_int"]
-                B[RP_unlabeled_index] = organDict["k_on"] * X[P_int_unlabaled] * (organDict["R0"] - binded) / organ["V_int"]
-
-                B[P_int_labeled] = -organDict["k_on"] * X[P_int_labeled] * (organDict["R0"] - binded) / organ["V_int"]
-                B[P_int_unlabaled] = -organDict["k_on"] * X[P_int_unlabaled] * (organDict["R0"] - binded) / organ["V_int"]
-
-        return B
+        ## Receptor binding of all Kidney and RecPos organs at once:
+        ## B[RP*] = k_on/V_int * P*_int * (R0 - bound), B[P*_int] = -B[RP*] (the same for the unlabeled ones)
+        ## Only the binding entries of self.B are ever written, so the buffer is reused between calls
+        binding = self.binding
+        rate = binding.kOnPerVolume * (binding.R0 - (X[binding.RP_labeled] + X[binding.RP_unlabeled]))
+        np.multiply(np.tile(rate, 2), X[binding.P_int], out=self.bindingFlux)
+        self.B[binding.RP] = self.bindingFlux
+        self.B[binding.P_int] = -self.bindingFlux
+        return self.B
+
+    def jac(self, t, X):
+        ## Analytic Jacobian of F. With bound = RP* + RP and free = R0 - bound, the binding terms are
+        ## B[RP*] = k_on/V_int * P*_int * free and B[P*_int] = -B[RP*] (the same for the unlabeled ones), so for
+        ## each receptor organ the derivatives are
+        ## d/dP*_int = k_on/V_int * free, d/dRP = d/dRP* = -k_on/V_int * P*_int
+        binding = self.binding
+        rate = binding.kOnPerVolume * (binding.R0 - (X[binding.RP_labeled] + X[binding.RP_unlabeled]))
+        labeled = binding.kOnPerVolume * X[binding.P_int_labeled]
+        unlabeled = binding.kOnPerVolume * X[binding.P_int_unlabeled]
+        labeled = np.stack([rate, -labeled, -labeled], axis=1)
+        unlabeled = np.stack([rate, -unlabeled, -unlabeled], axis=1)
+
+        J = self.JacobianPattern.copy()
+        J.data[self.JacobianDataIndex] += np.concatenate([labeled, -labeled, unlabeled, -unlabeled], axis=1)
+
+        if self.useSparse and self.method != "LSODA":   ## LSODA only accepts dense Jacobians
+            return J
+        return J.toarray()
 
     # def getSystemMat(self, X, i):
     #     SystemMat = self.SystemMat.copy()
@@ -128,53 +168,190 @@ class StiffSolver:
         # # for i in debugList:
         # #     peptide += self.BigVectList[i,:]
         # print("Hello")
-        self.solution = solve_ivp(self.F, [0,100000], self.BigVect, method="BDF")
-        print("hello")
-
-
+        ## Each smooth segment between two injection breakpoints is integrated on its own, so the integrator never
+        ## steps over a bolus or the end of an infusion
+        start = time.perf_counter()
+        self.reset()
+        self.advance(self.t_f)
+        self.BigVect = self.X.copy()
+        if self.monitor is not None:
+            self.monitor.finish(self)
+        self.setResults()
+        self.stats.wallTime = time.perf_counter() - start
+
+    def reset(self):
+        ## Start of a run: the initial state at t_0 and empty bookkeeping
+        self.stats = SolverStats(countsRejections=False)
+        self.t = self.t_0
+        self.X = self.initialState.copy()
+        self.totalCold = 0.0
+        self.totalHot = 0.0
+        self.injectedAt = None  ## Time of the last inject call, its boluses are already in X
+        self.stepSize = None    ## Last accepted step size
+        self.firstStep = None   ## First step of the next segment (None: chosen by the integrator)
+        self.segments = []
+        if self.monitor is not None:
+            self.monitor.setModel(self)
+
+    def advance(self, t_end):
+        ## Continues the run from self.t to t_end, so a run can be paused and resumed (also from a snapshot). The
+        ## boluses of a breakpoint are applied when the segment that starts there is integrated
+        breakpoints = self.injectionSchedule.getBreakpoints(self.t_0, self.t_f)
+        for t_start, t_stop in self.injectionSchedule.getSegments(self.t, t_end):
+            ## A run resumed inside a smooth segment starts with the last step size of the integrator
+            resumed = t_start == self.t and t_start not in breakpoints and self.stepSize is not None
+            self.firstStep = min(self.stepSize, t_stop - t_start) if resumed else None
+            if t_start != self.injectedAt:
+                self.X = self.inject(t_start, self.X)
+                self.injectedAt = t_start
+            if self.monitor is not None:
+                self.monitor.startSegment(t_start, self.X, self.rateCold, self.rateHot)
+            segment = self.integrateSegment(t_start, t_stop, self.X)
+            self.segments.append(segment)
+            self.stats.addSolveIvp(segment)
+            self.X = segment.y[:, -1].copy()
+            self.t = t_stop
+            if segment.t.shape[0] > 1:
+                self.stepSize = segment.t[-1] - segment.t[-2]
+            self.totalCold += self.rateCold * (t_stop - t_start)
+            self.totalHot += self.rateHot * (t_stop - t_start)
+        self.firstStep = None
+        return self.X
+
+    def setResults(self):
+        ## Continuous results of the integrated segments and the solution at the output times they cover
+        self.results = SolverResults(self.segments, self.organsObj)
+        self.solution = self.results.getSolution(
+            self.outputTimes[(self.outputTimes >= self.results.t_0) & (self.outputTimes <= self.results.t_f)])
+        self.solution.nfev = sum(segment.nfev for segment in self.segments)
+        self.solution.njev = sum(segment.njev for segment in self.segments)
+        self.solution.nlu = sum(segment.nlu for segment in self.segments)
+        self.solution.nsteps = sum(segment.t.shape[0] - 1 for segment in self.segments)
+        self.solution.success = all(segment.success for segment in self.segments)
+
+    def getSnapshot(self, keepSegments=False):
+        ## Picklable copy of the state of the run (see SolverSnapshot)
+        segments = None
+        if keepSegments:
+            segments = {name: list(getattr(self, name)) for name in self.segmentAttributes}
+        return SolverSnapshot(self.t, self.X.copy(), self.totalCold, self.totalHot, self.injectedAt, self.stepSize,
+                              copy.deepcopy(self.stats), copy.deepcopy(self.monitor),
+                              {name: copy.deepcopy(getattr(self, name)) for name in self.snapshotAttributes},
+                              segments)
+
+    def restore(self, snapshot):
+        ## Continues from the snapshot with the next advance. Without its segments the results only cover the
+        ## segments integrated after the restore
+        self.t = snapshot.t
+        self.X = snapshot.X.copy()
+        self.totalCold = snapshot.totalCold
+        self.totalHot = snapshot.totalHot
+        self.injectedAt = snapshot.injectedAt
+        self.stepSize = snapshot.stepSize
+        self.firstStep = None
+        self.stats = copy.deepcopy(snapshot.stats)
+        self.monitor = copy.deepcopy(snapshot.monitor)
+        for name, value in snapshot.attributes.items():
+            setattr(self, name, copy.deepcopy(value))
+        for name in self.segmentAttributes:
+            setattr(self, name, [] if snapshot.segments is None else list(snapshot.segments[name]))
+
+    def fork(self):
+        ## Independent copy of the solver at the current state of the run. The model (matrices, index arrays) is
+        ## shared, the state, the bookkeeping, the injection schedule and the scratch buffers are copied and the
+        ## integrated segments are shared up to the fork
+        child = copy.copy(self)
+        child.restore(self.getSnapshot(keepSegments=True))
+        child.injectionSchedule = copy.deepcopy(self.injectionSchedule)
+        child.B = np.zeros(self.B.shape)
+        child.bindingFlux = np.zeros(self.bindingFlux.shape)
+        return child
+
+    def integrateSegment(self, t_start, t_end, X):
+        if self.monitor is not None or self.countRejections:
+            return self.integrateSegmentStepped(t_start, t_end, X)
+        options = {"rtol": self.rtol, "atol": self.atol}
+        if self.firstStep is not None:
+            options["first_step"] = self.firstStep
+        if self.useJacobian:
+            options["jac"] = self.jac
+        return solve_ivp(self.F, [t_start, t_end], X, method=self.method, dense_output=True, **options)
+
+    def integrateWithRates(self, t_start, t_end, X, rateCold=0.0, rateHot=0.0):
+        ## One smooth segment from X over [t_start, t_end] with constant infusion rates (nmol/min), outside of the
+        ## run and its injection schedule (e.g. for an environment that injects its own doses). The state and the
+        ## bookkeeping of the run are not changed, the result is the one of integrateSegment
+        rates = (self.rateCold, self.rateHot)
+        self.rateCold, self.rateHot = rateCold, rateHot
+        try:
+            return self.integrateSegment(t_start, t_end, X)
+        finally:
+            self.rateCold, self.rateHot = rates
+
+    def integrateSegmentStepped(self, t_start, t_end, X):
+        ## The same integration as solve_ivp, stepped here so the monitor sees every accepted step and the rejected
+        ## attempts are counted: every attempt evaluates F at its own times after t_old (see getAttemptTimes)
+        options = {"rtol": self.rtol, "atol": self.atol}
+        if self.firstStep is not None:
+            options["first_step"] = self.firstStep
+        if self.useJacobian:
+            options["jac"] = self.jac
+        times = []
+
+        def F(t, X):
+            times.append(t)
+            return self.F(t, X)
+
+        stepper = getattr(integrate, self.method)(F, t_start, X, t_end, **options)
+        attemptTimes = getAttemptTimes(stepper)
+        nrejected = None if attemptTimes is None else 0
+        tList = [t_start]
+        XList = [X.copy()]
+        interpolants = []
+        while stepper.status == "running":
+            times.clear()
+            message = stepper.step()
+            if stepper.status == "failed":
+                break
+            if attemptTimes is not None:
+                nrejected += round(len(set(times) - {stepper.t_old}) / attemptTimes) - 1
+            interpolant = stepper.dense_output()
+            interpolants.append(interpolant)
+            tList.append(stepper.t)
+            XList.append(stepper.y.copy())
+            if self.monitor is not None:
+                self.monitor.addStep(stepper.t, stepper.y, interpolant((stepper.t_old + stepper.t) / 2))
+
+        tList = np.array(tList)
+        success = stepper.status == "finished"
+        return OptimizeResult(t=tList, y=np.stack(XList, axis=1),
+                              sol=OdeSolution(tList, interpolants) if success else None, nfev=stepper.nfev,
+                              njev=stepper.njev, nlu=stepper.nlu, nrejected=nrejected, success=success,
+                              message="The solver successfully reached the end of the segment" if success else message)
 
     def inject(self, t, X):
-
-        if self.injectionProfile["type"] == "constant":
-            if t < self.injectionProfile["tf"]:
-                X[self.Vein_index_cold] += self.toInjectAtEachTimeStep_Cold
-                X[self.Vein_index_hot] += self.toInjectAtEachTimeStep_Hot
-                self.totalHot += self.toInjectAtEachTimeStep_Hot
-                self.totalCold += self.toInjectAtEachTimeStep_Cold
-
-        if self.injectionProfile["type"] == "bolus":
-            if t >= self.injectionProfile["t0"] and self.singleBolusFlag == 0:
-                X[self.Vein_index_cold] += self.injectionProfile["totalAmountCold"]
-                X[self.Vein_index_hot] += self.injectionProfile["totalAmountHot"]
-                self.totalCold += self.injectionProfile["totalAmountCold"]
-                self.totalHot += self.injectionProfile["totalAmountHot"]
-                self.singleBolusFlag = 1
-
-        ## TODO: I think I need to fix something. when I only have
-        ## RecNeg organ, with 5 bolus trains and total amount of 10,
-        ## instead of 10*2 total peptide in body (cold + disintegerated hot), I get
-        ## 5 * (10*2). There must be something wrong
-        if self.injectionProfile["type"] == "bolusTrain":
-
-            if self.multiBolusFlag != self.injectionProfile["N"]:
-                if t >= self.injectionProfile["t"][self.multiBolusFlag]:
-                    X[self.Vein_index_cold] += self.eachBolusCold
-                    X[self.Vein_index_hot] += self.eachBolusHot
-                    self.totalCold += self.eachBolusCold
-                    self.totalHot += self.eachBolusHot
-                    self.multiBolusFlag += 1
-
+        ## Applies the boluses of time t to X and sets the infusion rate of the segment that starts at t
+        bolusCold, bolusHot = self.injectionSchedule.getBolus(t)
+        X[self.Vein_index_cold] += bolusCold
+        X[self.Vein_index_hot] += bolusHot
+        self.totalCold += bolusCold
+        self.totalHot += bolusHot
+        if self.monitor is not None:
+            self.monitor.addInjection(bolusCold, bolusHot)
+
+        self.rateCold, self.rateHot = self.injectionSchedule.getRate(t)
         return X
 
 
-
-
-
-
-
-
-
-
-
-
-
+def getAttemptTimes(stepper):
+    ## Number of distinct times after t_old at which one step attempt of a scipy OdeSolver evaluates the right hand
+    ## side: the new time for BDF (every Newton iteration), the 3 collocation nodes for Radau and the distinct stage
+    ## nodes (with the FSAL evaluation at the new time) for the explicit Runge-Kutta methods. A rejected attempt is
+    ## retried with a smaller step, so at new times. None for LSODA, which steps in Fortran
+    if isinstance(stepper, integrate.BDF):
+        return 1
+    if isinstance(stepper, integrate.Radau):
+        return 3
+    if hasattr(stepper, "C"):
+        return len(set(stepper.C[1:]) | {1})
+    return None
@@ -0,0 +1,79 @@
+import time
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from Encoder import Encoder
+from Patient import Patient
+from StiffSolver import StiffSolver
+from Therapy import Therapy
+
+
+class Sweep:
+    """
+    Runs the Cartesian grid of patients x injection profiles in parallel worker processes.
+
+    The profiles are given by their names in Therapy.injectionProfiles, the patients are Patient objects (one default
+    Patient if None). Every case is encoded and solved in its own process with solverClass (any solver with the
+    StiffSolver interface: outputTimes and a SolverResults based solution), and the cases are submitted to the
+    ProcessPoolExecutor in chunks of `chunksize`.
+
+    The results are collected into one table of arrays with one row per case:
+        patientIndex, profileName   (n,)         the case
+        Y                           (n, N, T)    the states at the output times t (T,)
+        totalCold, totalHot         (n,)         the injected amounts
+        nfev, wallTime              (n,)         the cost of each solve
+    """
+    def __init__(self, profileNames, patients=None, solverClass=StiffSolver, solverOptions=None, outputTimes=None,
+                 maxWorkers=None, chunksize=1):
+        if patients is None:
+            patients = [Patient()]
+        self.patients = patients
+        self.profileNames = list(profileNames)
+        self.solverClass = solverClass
+        self.solverOptions = dict() if solverOptions is None else solverOptions
+        self.outputTimes = outputTimes  ## None for the default output times of the solver
+        self.maxWorkers = maxWorkers
+        self.chunksize = chunksize
+
+        self.cases = list(itertools.product(range(len(patients)), self.profileNames))
+
+    def run(self):
+        tasks = [(self.patients[patientIndex], profileName, self.solverClass, self.solverOptions, self.outputTimes)
+                 for patientIndex, profileName in self.cases]
+        with ProcessPoolExecutor(max_workers=self.maxWorkers) as pool:
+            rows = list(pool.map(runCase, tasks, chunksize=self.chunksize))
+        self.setTable(rows)
+        return self
+
+    def setTable(self, rows):
+        self.t = rows[0]["t"]
+        self.patientIndex = np.array([case[0] for case in self.cases], dtype=int)
+        self.profileName = np.array([case[1] for case in self.cases])
+        self.Y = np.stack([row["y"] for row in rows])
+        self.totalCold = np.array([row["totalCold"] for row in rows])
+        self.totalHot = np.array([row["totalHot"] for row in rows])
+        self.nfev = np.array([row["nfev"] for row in rows], dtype=int)
+        self.wallTime = np.array([row["wallTime"] for row in rows])
+
+    def getRows(self, profileName=None, patientIndex=None):
+        ## Indices of the table rows of one profile and/or one patient
+        mask = np.ones(len(self.cases), dtype=bool)
+        if profileName is not None:
+            mask &= self.profileName == profileName
+        if patientIndex is not None:
+            mask &= self.patientIndex == patientIndex
+        return np.flatnonzero(mask)
+
+
+def runCase(task):
+    ## Encodes and solves one (patient, profile) case in a worker process
+    patient, profileName, solverClass, solverOptions, outputTimes = task
+    start = time.perf_counter()
+    therapy = Therapy(0, profileName=profileName)
+    encoder = Encoder(patient, therapy)
+    solver = solverClass(encoder, outputTimes=outputTimes, **solverOptions)
+    solver.solve()
+    return {"t": solver.solution.t, "y": solver.solution.y, "totalCold": solver.totalCold, "totalHot": solver.totalHot,
+            "nfev": solver.solution.nfev, "wallTime": time.perf_counter() - start}
@@ -16,7 +16,7 @@ class Therapy:  ## Note that this is a single therapy not the Therapy plan.
     ## the injection.
 
 
-    def __init__(self, i):
+    def __init__(self, i, profileName=None):
         self.Tumor = {
             "name": "Tumor",
             "P_v": 0,
@@ -332,8 +332,27 @@ class Therapy:  ## Note that this is a single therapy not the Therapy plan.
                                 constantInjection300, constantInjection360, bolusInjection, bolusTrainInjection2, bolusTrainInjection3,
                                 bolusTrainInjection4, bolusTrainInjection5, bolusTrainInjection6, bolusTrainInjection7]
 
+        ## All of the profiles by name, so a single profile can be picked with profileName (see Sweep)
+        self.injectionProfiles = {
+            "constantInjection60": constantInjection60,
+            "constantInjection120": constantInjection120,
+            "constantInjection180": constantInjection180,
+            "constantInjection240": constantInjection240,
+            "constantInjection300": constantInjection300,
+            "constantInjection360": constantInjection360,
+            "bolusInjection": bolusInjection,
+            "bolusTrainInjection2": bolusTrainInjection2,
+            "bolusTrainInjection3": bolusTrainInjection3,
+            "bolusTrainInjection4": bolusTrainInjection4,
+            "bolusTrainInjection5": bolusTrainInjection5,
+            "bolusTrainInjection6": bolusTrainInjection6,
+            "bolusTrainInjection7": bolusTrainInjection7
+        }
+
         # self.injectionProfile = injectionProfileList[i]
         self.injectionProfile = bolusInjection
+        if profileName is not None:
+            self.injectionProfile = self.injectionProfiles[profileName]
 
 
 
@@ -0,0 +1,183 @@
+import torch
+import torch.nn as nn
+from torchdiffeq import odeint, odeint_adjoint
+
+from InjectionSchedule import InjectionSchedule
+
+
+class TorchPBPK(nn.Module):
+    """
+    Differentiable PyTorch version of the StiffSolver model, integrated with torchdiffeq.
+
+    The product with the system matrix is computed from the COO map of the Encoder (see AssemblyMap) and the flat
+    parameter vector theta, without assembling the matrix, and the receptor binding terms read k_on, R0 and V_int
+    from the same theta. This means the right hand side
+        dX/dt = SystemMat(theta) @ X + B(X, theta) + infusion rate on the Vein
+    is a differentiable function of theta. theta is a parameter of the module, with shape (n,) or (batch, n) for a
+    batch of patients with the same organs. The states then have the shape (batch, N). Kidney F_fil and F_R are
+    recomputed from GFR, phi and f_exc in every call, so the gradient reaches the parameters of Patient.
+
+    The injection profile is compiled by InjectionSchedule. The bolus amounts (bolusCold, bolusHot) and the infusion
+    rates (infusionCold, infusionHot) are also parameters, of shape (boluses,) / (infusions,) or (batch, ...).
+    simulate integrates each smooth segment between two breakpoints from t_0 = 0 with odeint and adds the boluses
+    between them, so the output is right continuous like SolverResults. The right hand side of a segment is a
+    SegmentDynamics, which holds the infusions of that segment, so the module itself has no state of the run.
+
+    With adjoint=True the segments are integrated with odeint_adjoint. Its gradients only reach the parameters of
+    the module, so theta and the injection amounts should stay parameters instead of tensors computed outside.
+    """
+    def __init__(self, encoder, batchSize=None, adjoint=False, method="dopri5", rtol=1e-6, atol=1e-9,
+                 dtype=torch.float64, options=None):
+        super().__init__()
+        self.N = encoder.BigVect.shape[0]
+        self.adjoint = adjoint
+        self.method = method
+        self.rtol = rtol
+        self.atol = atol
+        self.options = options  ## Extra options of odeint (e.g. {"step_size": 0.01} for the fixed step methods)
+        self.dtype = dtype
+
+        assemblyMap = encoder.assemblyMap
+        self.parameterIndex = assemblyMap.parameterIndex
+        self.register_buffer("rows", torch.as_tensor(assemblyMap.rows, dtype=torch.long))
+        self.register_buffer("cols", torch.as_tensor(assemblyMap.cols, dtype=torch.long))
+        self.register_buffer("flatIndex", torch.as_tensor(assemblyMap.flatIndex, dtype=torch.long))
+        self.register_buffer("signs", torch.as_tensor(assemblyMap.signs, dtype=dtype))
+        self.register_buffer("paramIndex", torch.as_tensor(assemblyMap.paramIndex, dtype=torch.long))
+        self.register_buffer("volumeIndex", torch.as_tensor(assemblyMap.volumeIndex, dtype=torch.long))
+
+        binding = encoder.bindingEncoder
+        self.register_buffer("RP_labeled", torch.as_tensor(binding.RP_labeled, dtype=torch.long))
+        self.register_buffer("RP_unlabeled", torch.as_tensor(binding.RP_unlabeled, dtype=torch.long))
+        self.register_buffer("RP", torch.as_tensor(binding.RP, dtype=torch.long))
+        self.register_buffer("P_int", torch.as_tensor(binding.P_int, dtype=torch.long))
+        self.register_buffer("k_onIndex", self.getThetaIndex(binding.names, "k_on"))
+        self.register_buffer("R0Index", self.getThetaIndex(binding.names, "R0"))
+        self.register_buffer("V_intIndex", self.getThetaIndex(binding.names, "V_int"))
+        self.derivedIndex = {name: self.parameterIndex[("Kidney", name)]
+                             for name in ["GFR", "phi", "f_exc", "F_fil", "F_R"]}
+        ## One-hot masks of the derived parameters in theta, so getTheta replaces them out of place
+        for name in ["F_fil", "F_R"]:
+            mask = torch.zeros(len(self.parameterIndex), dtype=torch.bool)
+            mask[self.derivedIndex[name]] = True
+            self.register_buffer(name + "Mask", mask)
+
+        Vein_dict = encoder.organsObj.organsDict["ArtVein"]["Vein"]
+        self.Vein_index_cold = Vein_dict["stencil"]["base"] + Vein_dict["bigVectMap"]["P"]
+        self.Vein_index_hot = Vein_dict["stencil"]["base"] + Vein_dict["bigVectMap"]["P*"]
+        self.register_buffer("X_0", torch.as_tensor(encoder.BigVect, dtype=dtype))
+
+        theta = torch.as_tensor(encoder.theta, dtype=dtype)
+        self.schedule = InjectionSchedule(encoder.organsObj.therapy.injectionProfile)
+        bolusCold = torch.tensor([bolus[1] for bolus in self.schedule.boluses], dtype=dtype)
+        bolusHot = torch.tensor([bolus[2] for bolus in self.schedule.boluses], dtype=dtype)
+        infusionCold = torch.tensor([infusion[2] for infusion in self.schedule.infusions], dtype=dtype)
+        infusionHot = torch.tensor([infusion[3] for infusion in self.schedule.infusions], dtype=dtype)
+        if batchSize is not None:
+            ## One independent copy of every parameter per patient of the batch
+            theta, bolusCold, bolusHot, infusionCold, infusionHot = [
+                value.expand(batchSize, -1).clone()
+                for value in [theta, bolusCold, bolusHot, infusionCold, infusionHot]]
+        self.theta = nn.Parameter(theta)
+        self.bolusCold = nn.Parameter(bolusCold)
+        self.bolusHot = nn.Parameter(bolusHot)
+        self.infusionCold = nn.Parameter(infusionCold)
+        self.infusionHot = nn.Parameter(infusionHot)
+        self.t_0 = 0    ## Start of the injection schedule and of every simulation
+
+    def getThetaIndex(self, organNames, paramName):
+        return torch.as_tensor([self.parameterIndex[(name, paramName)] for name in organNames], dtype=torch.long)
+
+    def getTheta(self):
+        ## theta with the Kidney F_fil = GFR * phi and F_R = F_fil * (1 - f_exc) of Patient recomputed
+        ## (built out of place: autograd needs F_fil unchanged to differentiate F_R)
+        index = self.derivedIndex
+        F_fil = self.theta[..., index["GFR"]] * self.theta[..., index["phi"]]
+        F_R = F_fil * (1 - self.theta[..., index["f_exc"]])
+        theta = torch.where(self.F_filMask, F_fil.unsqueeze(-1), self.theta)
+        return torch.where(self.F_RMask, F_R.unsqueeze(-1), theta)
+
+    def getValues(self, theta):
+        ## Values of the entries of the COO map: (entries,), or (batch, entries) for a batch of theta
+        return self.signs * theta[..., self.paramIndex] / theta[..., self.volumeIndex]
+
+    def getSystemMat(self, theta):
+        ## The dense system matrix (N, N), or (batch, N, N), e.g. to inspect it. The right hand side does not build it
+        values = self.getValues(theta)
+        SystemMat = values.new_zeros(values.shape[:-1] + (self.N * self.N,))
+        SystemMat = SystemMat.index_add(-1, self.flatIndex, values)
+        return SystemMat.reshape(values.shape[:-1] + (self.N, self.N))
+
+    def getSystemProduct(self, theta, X):
+        ## SystemMat(theta) @ X straight from the COO map: gather X at the columns of the entries, multiply by their
+        ## values and scatter-add into their rows, O(entries) instead of the O(N^2) dense matrix
+        return torch.zeros_like(X).index_add(-1, self.rows, self.getValues(theta) * X[..., self.cols])
+
+    def forward(self, t, X, activeInfusions=()):
+        ## Right hand side with the infusions of the indices activeInfusions (none by default)
+        theta = self.getTheta()
+        dX = self.getSystemProduct(theta, X)
+
+        ## Receptor binding: B[RP*] = k_on/V_int * P*_int * (R0 - bound), B[P*_int] = -B[RP*] (and the unlabeled)
+        kOnPerVolume = theta[..., self.k_onIndex] / theta[..., self.V_intIndex]
+        rate = kOnPerVolume * (theta[..., self.R0Index] - (X[..., self.RP_labeled] + X[..., self.RP_unlabeled]))
+        flux = torch.cat([rate, rate], dim=-1) * X[..., self.P_int]
+        dX = dX.index_add(-1, self.RP, flux).index_add(-1, self.P_int, -flux)
+
+        if activeInfusions:
+            rate = torch.zeros_like(dX)
+            rate[..., self.Vein_index_cold] = self.infusionCold[..., list(activeInfusions)].sum(-1)
+            rate[..., self.Vein_index_hot] = self.infusionHot[..., list(activeInfusions)].sum(-1)
+            dX = dX + rate
+        return dX
+
+    def inject(self, t, X):
+        ## X plus the boluses of time t (out of place, so the gradient reaches the bolus amounts)
+        bolus = [k for k, (tBolus, cold, hot) in enumerate(self.schedule.boluses) if tBolus == t]
+        if not bolus:
+            return X
+        injection = torch.zeros_like(X)
+        injection[..., self.Vein_index_cold] = self.bolusCold[..., bolus].sum(-1)
+        injection[..., self.Vein_index_hot] = self.bolusHot[..., bolus].sum(-1)
+        return X + injection
+
+    def simulate(self, t):
+        ## States at the sorted output times t (T,) in [t_0, ...], shape (T, N) or (T, batch, N). The run always
+        ## starts at t_0 with the injections before the first output time
+        t = torch.as_tensor(t, dtype=self.dtype, device=self.X_0.device)
+        if float(t[0]) < self.t_0:
+            raise ValueError("The output times must start at t_0 = {} or later".format(self.t_0))
+        t_f = float(t[-1])
+        X = self.X_0.expand(self.theta.shape[:-1] + (self.N,))
+        integrate = odeint_adjoint if self.adjoint else odeint
+
+        outputs = []
+        for t_start, t_end in self.schedule.getSegments(self.t_0, t_f):
+            X = self.inject(t_start, X)
+            dynamics = SegmentDynamics(self, [k for k, (t0, tf, cold, hot) in enumerate(self.schedule.infusions)
+                                              if t0 <= t_start < tf])
+            ## The output times of this segment (the last segment also takes t_f), between its two ends
+            last = t_end == t_f
+            inside = t[(t >= t_start) & ((t <= t_end) if last else (t < t_end))]
+            times = torch.cat([t.new_tensor([t_start]), inside[inside > t_start], t.new_tensor([t_end])])
+            times = torch.unique_consecutive(times)
+            solution = integrate(dynamics, X, times, method=self.method, rtol=self.rtol, atol=self.atol,
+                                 options=self.options)
+            ## solution[k] belongs to times[k]: keep the requested ones (t_start only when it was requested)
+            keep = torch.isin(times, inside)
+            outputs.append(solution[keep])
+            X = solution[-1]
+        return torch.cat(outputs, dim=0)
+
+
+class SegmentDynamics(nn.Module):
+    ## Right hand side of one smooth segment: the model with the infusions active on it. odeint_adjoint calls it
+    ## again during backward, after simulate has returned, so the infusions are bound here and not kept in the
+    ## model. Its parameters are the ones of the model
+    def __init__(self, model, activeInfusions):
+        super().__init__()
+        self.model = model
+        self.activeInfusions = tuple(activeInfusions)
+
+    def forward(self, t, X):
+        return self.model(t, X, self.activeInfusions)
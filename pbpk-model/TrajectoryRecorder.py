@@ -0,0 +1,114 @@
+import os
+import tempfile
+import weakref
+
+import numpy as np
+
+
+class TrajectoryRecorder:
+    """
+    Streams the states of a step-by-step solver to disk, so the memory used by a solve does not grow with the
+    horizon or the number of steps.
+
+    The states are collected in a fixed size chunk and every full chunk is appended to a .npy file of shape (T, N)
+    (plus a (T,) .npy file of the times). The header of the files is rewritten with the final T when the recorder
+    is closed, after that they are regular .npy files that can be memory-mapped with np.load(path, mmap_mode="r").
+    With float32=True the states are downcast on disk only. Without a path the files are temporary and deleted
+    with the recorder, with a path they are kept.
+
+    The last `history` states are also kept in a small ring buffer at full precision, for the solvers that need
+    the previous state of the step (see getPrevious).
+    """
+    headerLength = 128  ## Fixed .npy header size, so the final shape can be written over the initial one
+
+    def __init__(self, N, path=None, chunkSize=4096, float32=False, history=2):
+        self.N = N
+        self.givenPath = path   ## None for a record on temporary files
+        if path is None:
+            fileDescriptor, path = tempfile.mkstemp(suffix=".npy", prefix="trajectory_")
+            os.close(fileDescriptor)
+        self.path = path
+        self.timePath = os.path.splitext(path)[0] + "_t.npy"
+        if self.givenPath is None:
+            ## Temporary files are deleted with the recorder (or at exit). The arrays already memory-mapped from them
+            ## stay valid on POSIX systems
+            weakref.finalize(self, removeFiles, [self.path, self.timePath])
+        else:
+            ## An earlier record at path is unlinked rather than truncated, so the arrays memory-mapped from it stay
+            ## valid
+            removeFiles([self.path, self.timePath])
+        self.dtype = np.dtype(np.float32 if float32 else np.float64)
+
+        self.chunk = np.zeros((chunkSize, N), dtype=self.dtype)
+        self.timeChunk = np.zeros(chunkSize)
+        self.chunkCount = 0
+        self.count = 0  ## Number of recorded states
+
+        self.ring = np.zeros((history, N))
+        self.ringPointer = 0
+
+        self.file = open(self.path, "wb")
+        self.timeFile = open(self.timePath, "wb")
+        self.writeHeader(self.file, self.dtype, (0, N))
+        self.writeHeader(self.timeFile, np.dtype(np.float64), (0,))
+
+    def getEmpty(self):
+        ## New recorder with the same settings, for the next run (on new temporary files, or on the same path)
+        return TrajectoryRecorder(self.N, path=self.givenPath, chunkSize=self.chunk.shape[0],
+                                  float32=self.dtype == np.float32, history=self.ring.shape[0])
+
+    def writeHeader(self, file, dtype, shape):
+        header = "{{'descr': '{}', 'fortran_order': False, 'shape': {}, }}".format(
+            np.lib.format.dtype_to_descr(dtype), shape)
+        header = header.ljust(self.headerLength - 10 - 1) + "\n"
+        file.seek(0)
+        file.write(b"\x93NUMPY\x01\x00" + np.uint16(len(header)).tobytes() + header.encode("latin1"))
+
+    def append(self, t, X):
+        self.chunk[self.chunkCount] = X
+        self.timeChunk[self.chunkCount] = t
+        self.chunkCount += 1
+        self.count += 1
+        if self.chunkCount == self.chunk.shape[0]:
+            self.flush()
+
+        self.ring[self.ringPointer] = X
+        self.ringPointer = (self.ringPointer + 1) % self.ring.shape[0]
+
+    def getPrevious(self, k=1):
+        ## The k-th last recorded state (k=1 is the last one), k <= history
+        if k > min(self.count, self.ring.shape[0]):
+            raise IndexError("Only the last {} recorded states are kept".format(min(self.count, self.ring.shape[0])))
+        return self.ring[(self.ringPointer - k) % self.ring.shape[0]]
+
+    def flush(self):
+        self.file.write(self.chunk[:self.chunkCount].tobytes())
+        self.timeFile.write(self.timeChunk[:self.chunkCount].tobytes())
+        self.chunkCount = 0
+
+    def close(self):
+        ## Writes the last partial chunk and the final shapes. Safe to call more than once
+        if self.file.closed:
+            return
+        self.flush()
+        self.writeHeader(self.file, self.dtype, (self.count, self.N))
+        self.writeHeader(self.timeFile, np.dtype(np.float64), (self.count,))
+        self.file.close()
+        self.timeFile.close()
+
+    def getStates(self):
+        ## Memory-mapped (T, N) array of the recorded states
+        self.close()
+        return np.load(self.path, mmap_mode="r")
+
+    def getTimes(self):
+        self.close()
+        return np.load(self.timePath, mmap_mode="r")
+
+
+def removeFiles(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
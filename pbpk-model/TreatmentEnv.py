@@ -0,0 +1,153 @@
+import copy
+
+import numpy as np
+
+from Encoder import Encoder
+from Patient import Patient
+from StiffSolver import StiffSolver
+from Therapy import Therapy
+
+
+class TreatmentEnv:
+    """
+    Treatment planning environment with the reset / step interface of gym (gymnasium), without depending on it.
+
+    An episode is one patient over maxSteps decision intervals of decisionInterval minutes. At every decision the
+    action (cold, hot) is injected as a bolus into the Vein and the model is integrated over the next interval only,
+    starting from the saved state with the implicit solver of a StiffSolver (StiffSolver.integrateWithRates, without
+    any infusion). The history is never integrated again, so the cost of a step is the cost of its interval.
+
+    The observation holds the unlabeled and the labeled amount of every organ (nmol, in the order of organNames) and
+    the time of the episode (min). The reward of a step is the time integrated labeled amount of the target organ
+    minus the weighted ones of the organs at risk over the interval (the absorbed doses up to the decay constant),
+    multiplied by rewardScale (1 / (maxHot * decisionInterval) by default, so a full dose gives rewards of order 1).
+    The integrals are computed with Simpson's rule over the steps of the integrator, with the dense output at the
+    midpoint of each step.
+
+    getSnapshot / restore / fork save and branch the state of an episode (e.g. for a tree search over the doses):
+    the snapshot is a small picklable dictionary and a fork shares the model of the patient.
+
+    patientSampler is an optional function of the random generator of the environment that returns the Patient of
+    a new episode, so every reset(seed) can draw a different patient.
+    """
+    ## The state of an episode (see getSnapshot)
+    stateAttributes = ("t", "stepCount", "X", "totalCold", "totalHot", "organDoses", "nfev")
+
+    def __init__(self, patient=None, patientSampler=None, decisionInterval=1440, maxSteps=7, maxCold=100, maxHot=10,
+                 targetOrgan="Tumor", riskOrgans=None, rewardScale=None, method="BDF", rtol=1e-6, atol=1e-9):
+        self.patient = Patient() if patient is None else patient
+        self.patientSampler = patientSampler
+        self.decisionInterval = decisionInterval    ## Time between two decisions (min)
+        self.maxSteps = maxSteps
+        self.actionHigh = np.array([maxCold, maxHot], dtype=float)  ## The actions are clipped to [0, actionHigh]
+        self.targetOrgan = targetOrgan
+        if riskOrgans is None:
+            riskOrgans = {"Kidney": 1.0, "RedMarrow": 1.0}   ## organ at risk --> weight of its dose in the reward
+        self.riskOrgans = riskOrgans
+        self.rewardScale = 1 / (maxHot * decisionInterval) if rewardScale is None else rewardScale
+        self.solverOptions = {"method": method, "rtol": rtol, "atol": atol}
+        self.rng = np.random.default_rng()
+        self.solver = None
+
+    def setModel(self, patient):
+        ## The encoder of the patient and the solver whose model the environment integrates. The injections of the
+        ## therapy are not used, the environment injects its actions itself
+        self.encoder = Encoder(patient, Therapy(0))
+        self.solver = StiffSolver(self.encoder, **self.solverOptions)
+        self.solver.reset()
+        self.setProjections(self.encoder.organsObj)
+
+    def setProjections(self, organsObj):
+        self.organNames = []
+        coldProjection = []
+        hotProjection = []
+        for type in organsObj.typesList:
+            for name, organDict in organsObj.organsDict[type].items():
+                base = organDict["stencil"]["base"]
+                cold = np.zeros(organsObj.N)
+                hot = np.zeros(organsObj.N)
+                for variable, shift in organDict["bigVectMap"].items():
+                    (hot if "*" in variable else cold)[base + shift] = 1
+                self.organNames.append(name)
+                coldProjection.append(cold)
+                hotProjection.append(hot)
+        ## (organs, N) matrices of the unlabeled and labeled amount of every organ
+        self.coldProjection = np.array(coldProjection)
+        self.hotProjection = np.array(hotProjection)
+
+        ## Reward weights of the organs: +1 for the target, -weight for the organs at risk
+        self.rewardWeights = np.zeros(len(self.organNames))
+        self.rewardWeights[self.organNames.index(self.targetOrgan)] = 1
+        for name, weight in self.riskOrgans.items():
+            self.rewardWeights[self.organNames.index(name)] -= weight
+        self.observationSize = 2 * len(self.organNames) + 1
+
+    def reset(self, seed=None, options=None):
+        if seed is not None:
+            self.rng = np.random.default_rng(seed)
+        if self.patientSampler is not None:
+            self.patient = self.patientSampler(self.rng)
+            self.setModel(self.patient)
+        elif self.solver is None:
+            self.setModel(self.patient)
+        self.t = 0.0
+        self.stepCount = 0
+        self.X = self.encoder.BigVect.copy()
+        self.totalCold = 0.0
+        self.totalHot = 0.0
+        self.organDoses = np.zeros(len(self.organNames))  ## Time integrated labeled amount of each organ (nmol min)
+        self.nfev = 0
+        return self.getObservation(), self.getInfo()
+
+    def step(self, action):
+        ## (observation, reward, terminated, truncated, info) after injecting action = (cold, hot) in nmol
+        cold, hot = np.clip(np.asarray(action, dtype=float), 0, self.actionHigh)
+        self.X[self.solver.Vein_index_cold] += cold
+        self.X[self.solver.Vein_index_hot] += hot
+        self.totalCold += cold
+        self.totalHot += hot
+
+        t_end = self.t + self.decisionInterval
+        segment = self.solver.integrateWithRates(self.t, t_end, self.X)
+        if not segment.success:
+            raise RuntimeError("The integration of [{}, {}] failed: {}".format(self.t, t_end, segment.message))
+        doses = self.hotProjection @ self.getIntegral(segment)
+        self.organDoses += doses
+        self.nfev += segment.nfev
+        self.X = segment.y[:, -1].copy()
+        self.t = t_end
+        self.stepCount += 1
+
+        reward = self.rewardScale * float(self.rewardWeights @ doses)
+        terminated = self.stepCount >= self.maxSteps
+        return self.getObservation(), reward, terminated, False, self.getInfo()
+
+    def getSnapshot(self):
+        return {name: copy.copy(getattr(self, name)) for name in self.stateAttributes}
+
+    def restore(self, snapshot):
+        ## Continues the episode of the snapshot, which must come from an environment of the same patient
+        for name, value in snapshot.items():
+            setattr(self, name, copy.copy(value))
+
+    def fork(self):
+        ## Independent copy of the environment at the current state of the episode, with the model of the patient
+        ## shared and the scratch buffers of the solver copied
+        child = copy.copy(self)
+        child.restore(self.getSnapshot())
+        child.solver = self.solver.fork()
+        child.rng = copy.deepcopy(self.rng)
+        return child
+
+    def getIntegral(self, segment):
+        ## Time integral of the state over a segment: Simpson's rule on every step of the integrator
+        h = np.diff(segment.t)
+        middle = segment.sol((segment.t[:-1] + segment.t[1:]) / 2)
+        return (segment.y[:, :-1] + 4 * middle + segment.y[:, 1:]) @ h / 6
+
+    def getObservation(self):
+        return np.concatenate([self.coldProjection @ self.X, self.hotProjection @ self.X, [self.t]])
+
+    def getInfo(self):
+        return {"t": self.t, "totalCold": self.totalCold, "totalHot": self.totalHot,
+                "organDoses": dict(zip(self.organNames, self.organDoses)), "nfev": self.nfev}
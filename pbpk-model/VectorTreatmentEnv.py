@@ -0,0 +1,135 @@
+import copy
+
+import numpy as np
+
+from BatchSolver import BatchSolver
+from Encoder import Encoder
+from Therapy import Therapy
+from TreatmentEnv import TreatmentEnv
+
+
+class VectorTreatmentEnv(TreatmentEnv):
+    """
+    numEnvs treatment planning episodes (see TreatmentEnv) stepped in lockstep, with the batched vector env
+    interface of gymnasium: the actions are an (numEnvs, 2) array of (cold, hot) doses and the observations, rewards,
+    terminated and truncated flags are NumPy arrays with one row per environment.
+
+    The patients of the environments (`patients`, or drawn by patientSampler at every reset) are encoded once and
+    stacked into a BatchSolver: the states are one (numEnvs, N) array and every step is a single implicit
+    integration (BatchSolver.integrateImplicit) of the block diagonal batch model over the decision interval, with
+    its block diagonal analytic Jacobian. The model is autonomous between two decisions, so all the environments are
+    integrated over [0, decisionInterval] whatever their episode time.
+
+    Environments whose episode ends are reset automatically at the end of step: their returned observation is
+    already the first one of the next episode, the last one is in info["final_observation"] (and their info in
+    info["final_info"]). With a patientSampler the new patients are encoded and only their blocks of the batch
+    model are replaced (BatchSolver.setPatients).
+    """
+    def __init__(self, numEnvs=None, patients=None, patientSampler=None, decisionInterval=1440, maxSteps=7,
+                 maxCold=100, maxHot=10, targetOrgan="Tumor", riskOrgans=None, rewardScale=None, method="BDF",
+                 rtol=1e-6, atol=1e-9):
+        super().__init__(patientSampler=patientSampler, decisionInterval=decisionInterval, maxSteps=maxSteps,
+                         maxCold=maxCold, maxHot=maxHot, targetOrgan=targetOrgan, riskOrgans=riskOrgans,
+                         rewardScale=rewardScale, method=method, rtol=rtol, atol=atol)
+        if patients is None:
+            patients = [self.patient] * (1 if numEnvs is None else numEnvs)
+        self.patients = list(patients)
+        self.numEnvs = len(self.patients)
+        self.batch = None
+
+    def setModel(self, patients):
+        self.encoders = [Encoder(patient, Therapy(0)) for patient in patients]
+        self.batch = BatchSolver(self.encoders, **self.solverOptions)
+        self.batch.rateCold[:] = 0
+        self.batch.rateHot[:] = 0
+        self.initialStates = np.stack([encoder.BigVect for encoder in self.encoders])
+        self.setProjections(self.encoders[0].organsObj)
+
+    def reset(self, seed=None, options=None):
+        if seed is not None:
+            self.rng = np.random.default_rng(seed)
+        if self.patientSampler is not None:
+            self.patients = [self.patientSampler(self.rng) for _ in range(self.numEnvs)]
+            self.setModel(self.patients)
+        elif self.batch is None:
+            self.setModel(self.patients)
+        self.t = np.zeros(self.numEnvs)
+        self.stepCount = np.zeros(self.numEnvs, dtype=int)
+        self.X = self.initialStates.copy()
+        self.totalCold = np.zeros(self.numEnvs)
+        self.totalHot = np.zeros(self.numEnvs)
+        self.organDoses = np.zeros((self.numEnvs, len(self.organNames)))
+        self.nfev = 0
+        return self.getObservation(), self.getInfo()
+
+    def resetDone(self, done):
+        ## New episodes for the environments of the mask done
+        if self.patientSampler is not None:
+            indices = np.flatnonzero(done)
+            for m in indices:
+                self.patients[m] = self.patientSampler(self.rng)
+            encoders = [Encoder(self.patients[m], Therapy(0)) for m in indices]
+            self.batch.setPatients(indices, encoders)
+            self.initialStates[indices] = [encoder.BigVect for encoder in encoders]
+        self.t[done] = 0
+        self.stepCount[done] = 0
+        self.X[done] = self.initialStates[done]
+        self.totalCold[done] = 0
+        self.totalHot[done] = 0
+        self.organDoses[done] = 0
+
+    def step(self, actions):
+        ## (observations, rewards, terminated, truncated, info) after injecting actions (numEnvs, 2) = (cold, hot)
+        actions = np.clip(np.asarray(actions, dtype=float).reshape(self.numEnvs, 2), 0, self.actionHigh)
+        self.X[:, self.batch.Vein_index_cold] += actions[:, 0]
+        self.X[:, self.batch.Vein_index_hot] += actions[:, 1]
+        self.totalCold += actions[:, 0]
+        self.totalHot += actions[:, 1]
+
+        segment = self.batch.integrateImplicit(0, self.decisionInterval, self.X)
+        if not segment.success:
+            raise RuntimeError("The integration of the decision interval failed: {}".format(segment.message))
+        doses = self.getIntegral(segment).reshape(self.numEnvs, -1) @ self.hotProjection.T
+        self.organDoses += doses
+        self.nfev += segment.nfev
+        self.X = segment.y[:, -1].reshape(self.numEnvs, -1).copy()
+        self.t += self.decisionInterval
+        self.stepCount += 1
+
+        rewards = self.rewardScale * (doses @ self.rewardWeights)
+        terminated = self.stepCount >= self.maxSteps
+        truncated = np.zeros(self.numEnvs, dtype=bool)
+        observations = self.getObservation()
+        info = self.getInfo()
+        if terminated.any():
+            info["final_info"] = copy.deepcopy(info)
+            info["final_observation"] = observations.copy()
+            info["_final_observation"] = terminated.copy()
+            self.resetDone(terminated)
+            observations = self.getObservation()
+        return observations, rewards, terminated, truncated, info
+
+    def getObservation(self):
+        return np.concatenate([self.X @ self.coldProjection.T, self.X @ self.hotProjection.T, self.t[:, None]],
+                              axis=1)
+
+    def getInfo(self):
+        return {"t": self.t.copy(), "totalCold": self.totalCold.copy(), "totalHot": self.totalHot.copy(),
+                "organDoses": self.organDoses.copy(), "nfev": self.nfev}
+
+    def fork(self):
+        ## Independent copy of the environments, with the batch model shared and its scratch buffer copied
+        child = copy.copy(self)
+        child.restore(self.getSnapshot())
+        child.patients = list(self.patients)
+        child.batch = copy.copy(self.batch)
+        child.batch.B = np.zeros(self.batch.B.shape)
+        if self.patientSampler is not None:
+            ## The resets of the child replace patients in place (see resetDone), so it gets its own batch model
+            child.encoders = child.batch.encoders = list(self.encoders)
+            child.batch.injectionSchedules = list(self.batch.injectionSchedules)
+            for name in ["SystemMat", "JacobianPattern", "kOnPerVolume", "R0", "BigVect"]:
+                setattr(child.batch, name, getattr(self.batch, name).copy())
+            child.initialStates = self.initialStates.copy()
+        child.rng = copy.deepcopy(self.rng)
+        return child
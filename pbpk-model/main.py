@@ -1,4 +1,5 @@
 # Importing required modules and classes
+from contextlib import nullcontext
 
 # Custom class for data processing
 from DataProcessing import DataProcessing
@@ -6,6 +7,7 @@ from DataProcessing import DataProcessing
 from Encoder import Encoder
 # Custom classes for patient and therapy models
 from Patient import Patient
+from Profiler import Profiler
 from StiffSolver import StiffSolver
 from Therapy import Therapy
 
@@ -14,21 +16,34 @@ from Therapy import Therapy
 # List of injection profiles to be tested
 # Uncomment the line below if you want to test multiple injection profiles
 # injection_profiles = ["constantInjection60", "constantInjection120", "constantInjection180",bolusInjection ...]
-# For this example, only 'bolusInjection' is being tested
+# For this example, only 'constantInjection60' is being tested
+# To solve many profiles (and patients) in parallel without plotting them, use Sweep(injection_profiles).run()
 
 #A "bolus injection" is a method of drug administration in which a single, concentrated dose of a medication is given intravenously,
 # usually all at once over a short period. This is in contrast to other methods like continuous infusion,
 # where the drug is administered over an extended period.
 injection_profiles = ["constantInjection60"]
 
+# Set to True to record the time spent in each phase (encode, solve, RHS, Jacobian, injection, post-processing)
+# The aggregated report is printed at the end and the Chrome trace is written to profile_trace.json
+useProfiler = False
+profiler = Profiler(trackAllocations=True) if useProfiler else None
+
+
+def phase(name):
+    # Records the block as a phase of the profiler, does nothing without one
+    return profiler.phase(name) if profiler else nullcontext()
+
+
 # Loop through each injection profile
 for index, profile in enumerate(injection_profiles):
     # Initialize patient and therapy models
     patient_model = Patient()
-    therapy_model = Therapy(index)  # 'index' is used as an argument here; adjust as needed
+    therapy_model = Therapy(index, profileName=profile)  # The injection profile is picked by its name
 
     # Initialize the encoder
-    encoder_model = Encoder(patient_model, therapy_model)
+    with phase("encode"):
+        encoder_model = Encoder(patient_model, therapy_model)
 
     # Initialize the solver
     # Uncomment the solver you want to use
@@ -37,14 +52,22 @@ for index, profile in enumerate(injection_profiles):
     solver_model = StiffSolver(encoder_model)
 
     # Solve the model
-    solver_model.solve()
+    if profiler:
+        profiler.instrument(solver_model)
+    with phase("solve"):
+        solver_model.solve()
 
     # Process and plot the data
     data_processor = DataProcessing(patient_model, therapy_model, encoder_model, solver_model)
-    data_processor.plotter()
+    with phase("postprocess"):
+        data_processor.plotter()
 
     # Save data if needed
     # np.save("data/" + profile, data_processor.results.BigVectList)
 
+if profiler:
+    print(profiler.getReport())
+    profiler.exportChromeTrace("profile_trace.json")
+
 # Print a message to indicate script has finished running
 print("Finished running the script.........")
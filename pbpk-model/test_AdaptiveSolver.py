@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from AdaptiveSolver import AdaptiveSolver
+from Encoder import Encoder
+from Patient import Patient
+from Solver import Solver
+from StiffSolver import StiffSolver
+from Therapy import Therapy
+
+
+@pytest.fixture(scope="module", params=["bolusInjection", "constantInjection60"])
+def encoder(request):
+    return Encoder(Patient(), Therapy(0, profileName=request.param))
+
+
+def test_matchesRadau(encoder):
+    ## At a tight tolerance the steps and the dense output between them agree with an implicit reference
+    outputTimes = np.linspace(0, 10, 101)
+    solver = AdaptiveSolver(encoder, rtol=1e-10, atol=1e-13, t_f=10, outputTimes=outputTimes)
+    solver.solve()
+    reference = StiffSolver(encoder, method="Radau", rtol=1e-12, atol=1e-15, outputTimes=outputTimes)
+    reference.t_f = 10
+    reference.solve()
+    scale = np.abs(reference.solution.y).max()
+    np.testing.assert_allclose(solver.solution.y, reference.solution.y, rtol=0, atol=1e-8 * scale)
+    np.testing.assert_allclose(solver.BigVect, reference.BigVect, rtol=0, atol=1e-8 * scale)
+
+
+def test_fewerCallsThanRK4(encoder):
+    ## Over the horizon of the fixed step Solver, a tight tolerance run costs a fraction of its RHS calls
+    fixed = Solver(encoder)
+    t_f = fixed.tList[-1]
+    solver = AdaptiveSolver(encoder, rtol=1e-8, atol=1e-11, t_f=t_f)
+    solver.solve()
+    assert solver.stats.nfev < 4 * (fixed.tList.shape[0] - 1) / 5
+    reference = StiffSolver(encoder, method="Radau", rtol=1e-12, atol=1e-15)
+    reference.t_f = t_f
+    reference.solve()
+    np.testing.assert_allclose(solver.BigVect, reference.BigVect, rtol=0, atol=1e-8 * np.abs(reference.BigVect).max())
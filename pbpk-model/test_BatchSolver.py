@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from BatchSolver import BatchSolver
+from Encoder import Encoder
+from Patient import Patient
+from StiffSolver import StiffSolver
+from Therapy import Therapy
+
+
+@pytest.fixture(scope="module")
+def encoders():
+    return [Encoder(Patient(BW=BW, gender=gender), Therapy(0, profileName="bolusInjection"))
+            for BW, gender in [(60, "female"), (95, "male")]]
+
+
+@pytest.mark.parametrize("method", ["BDF", "RK4"])
+def test_matchesStiffSolver(encoders, method):
+    ## Each patient of the batch matches its own tight-tolerance StiffSolver run (RK4 up to the linear interpolation
+    ## of its output times)
+    batch = BatchSolver(encoders, method=method)
+    batch.solve()
+    assert batch.t_f == (75 if method == "RK4" else 100000)
+    for encoder, Y in zip(encoders, batch.Y):
+        solver = StiffSolver(encoder, method="Radau", rtol=1e-10, atol=1e-14, outputTimes=batch.t)
+        solver.t_f = batch.t_f
+        solver.solve()
+        assert np.max(np.abs(Y - solver.solution.y)) < 1e-3 * np.max(np.abs(solver.solution.y))
+
+
+def test_tolerances(encoders):
+    ## The tolerances hold for every patient of the batch, as for its own StiffSolver run
+    errors = []
+    for rtol, atol in [(1e-3, 1e-6), (1e-8, 1e-12)]:
+        batch = BatchSolver(encoders, rtol=rtol, atol=atol, t_f=1000)
+        batch.solve()
+        for encoder, Y in zip(encoders, batch.Y):
+            solver = StiffSolver(encoder, method="Radau", rtol=1e-12, atol=1e-16, outputTimes=batch.t)
+            solver.t_f = batch.t_f
+            solver.solve()
+            errors.append(np.max(np.abs(Y - solver.solution.y)) / np.max(np.abs(solver.solution.y)))
+    assert max(errors[2:]) < 1e-6
+    assert max(errors[2:]) < 1e-3 * min(errors[:2])
+
+
+def test_horizonAndStep(encoders):
+    batch = BatchSolver(encoders, method="RK4", t_f=2, h=0.01)
+    batch.solve()
+    assert batch.t[-1] <= 2
+    np.testing.assert_allclose(batch.totalHot, [encoder.organsObj.therapy.injectionProfile["totalAmountHot"]
+                                                for encoder in encoders])
+
+
+@pytest.mark.parametrize("method", ["BDF", "RK4"])
+def test_stats(encoders, method):
+    batch = BatchSolver(encoders, method=method, t_f=5)
+    batch.solve()
+    assert batch.stats.nsteps > 0
+    assert batch.stats.wallTime > 0
+    if method == "RK4":
+        assert batch.stats.nsteps == 1000
+        assert batch.stats.nfev == 4000
+        assert batch.stats.nrejected == 0
@@ -0,0 +1,43 @@
+import pytest
+
+from Benchmark import Benchmark
+
+
+@pytest.fixture(scope="module")
+def benchmark():
+    benchmark = Benchmark(problems=["bolusInjection"], engines=["Radau", "BDF"], rtols=[1e-6],
+                          outputTimes=[0, 0.1, 1, 10, 100], measureMemory=False)
+    benchmark.run()
+    return benchmark
+
+
+def test_results(benchmark):
+    assert [(result["engine"], result["rtol"]) for result in benchmark.results] == [("Radau", 1e-6), ("BDF", 1e-6)]
+    reference = benchmark.getReference("bolusInjection")
+    for result in benchmark.results:
+        ## One error per organ of the reference, relative to its largest amount
+        assert set(result["errors"]) == set(reference)
+        assert all(0 <= error < 1e-3 for error in result["errors"].values())
+        assert result["maxError"] == max(result["errors"].values())
+        assert result["wallTime"] > 0 and result["peakMemoryMB"] is None
+        assert result["nsteps"] > 0 and result["nfev"] > 0
+        ## The implicit engines count their Jacobians, LU factorizations and rejected steps
+        assert result["njev"] > 0 and result["nlu"] > 0 and result["nrejected"] is not None
+    assert len(benchmark.getReport().splitlines()) == 1 + len(benchmark.results)
+
+
+def test_saveCompare(benchmark, tmp_path):
+    ## An identical run against its own saved results has ratios of one and no regression
+    path = tmp_path / "baseline.json"
+    benchmark.save(path)
+    report, regressions = benchmark.compare(path)
+    assert regressions == []
+    assert report.count(" ok") == len(benchmark.results)
+
+    slower = Benchmark(problems=["bolusInjection"], engines=["Radau"], rtols=[1e-6])
+    slower.results = [dict(benchmark.results[0], wallTime=2 * benchmark.results[0]["wallTime"]),
+                      dict(benchmark.results[1], engine="DOPRI5")]
+    report, regressions = slower.compare(path)
+    assert regressions == [("bolusInjection", "Radau", 1e-6)]
+    assert "new" in report.splitlines()[-1]
+    assert len(report.splitlines()) == 3
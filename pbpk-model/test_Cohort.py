@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from Cohort import Cohort
+from CohortSampler import CohortSampler, allometricBSA
+from FlatPatient import stackPatients
+from ParameterSchema import getSchema
+from Patient import Patient
+
+
+@pytest.mark.parametrize("NETFraction", [1.0, 0.0, 0.5])
+def test_matchesPatient(NETFraction):
+    ## The vectorized formulas of Cohort give the organ parameters of Patient for the same covariates
+    cohort = CohortSampler(NETFraction=NETFraction, seed=0).sample(64)
+    patients = [cohort.getPatient(i) for i in range(len(cohort))]
+    schema = getSchema(Patient())
+    expected = stackPatients(patients, schema)
+    np.testing.assert_allclose(cohort.getFlatValues(schema), expected, rtol=1e-12, atol=1e-15)
+
+    ## Same organs, in the same order
+    assert cohort.organTypes == schema.organTypes
+    for names in cohort.organTypes.values():
+        for name in names:
+            assert set(cohort.organs[name]) == set(schema.organParameters[name])
+
+
+def test_referencePatient():
+    ## The default covariates of Patient give the reference patient
+    covariates = {name: np.array([value]) for name, value in
+                  [("BW", 80), ("BSA", 1.94), ("H", 0.1), ("male", True), ("GFR", 0.11), ("V_tu", 0.087),
+                   ("NET", True), ("R_tu_density", 15), ("R_L_density", 1.4), ("R_S_density", 8.7),
+                   ("R_K_density", 6.5), ("R_rest_density", 0.5)]}
+    schema = getSchema(Patient())
+    np.testing.assert_allclose(Cohort(covariates).getFlatValues(schema)[0], stackPatients([Patient()], schema)[0],
+                               rtol=1e-12, atol=1e-15)
+
+
+def test_streamsKeyedByName():
+    ## Holding a covariate constant does not change the draws of the others
+    full = CohortSampler(seed=1).sample(32)
+    reduced = CohortSampler({"GFR": 0.11, "V_tu": 0.087}, seed=1).sample(32)
+    for name in ["BW", "BSA", "H", "male", "R_tu_density", "R_rest_density"]:
+        np.testing.assert_array_equal(full.covariates[name], reduced.covariates[name])
+    assert np.all(reduced.covariates["GFR"] == 0.11)
+
+    ## Reproducible, and the spawned samplers draw other patients
+    np.testing.assert_array_equal(CohortSampler(seed=1).sample(32).covariates["BW"], full.covariates["BW"])
+    children = CohortSampler(seed=1).spawn(2)
+    draws = [child.sample(32).covariates["BW"] for child in children]
+    assert not np.array_equal(draws[0], draws[1])
+    assert not np.array_equal(draws[0], full.covariates["BW"])
+
+
+@pytest.mark.parametrize("method", ["random", "lhs", "sobol"])
+def test_conditionalBSA(method):
+    cohort = CohortSampler({"BSA": allometricBSA}, method=method, seed=2).sample(256)
+    BW = cohort.covariates["BW"]
+    BSA = cohort.covariates["BSA"]
+    assert np.corrcoef(np.log(BW), np.log(BSA))[0, 1] > 0.8
+    residual = np.log(BSA / (0.1173 * BW ** 0.6466))
+    assert abs(residual.mean()) < 0.02
+    assert 0.04 < residual.std() < 0.08
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from CompiledModel import CompiledModel, compileModel
+from Encoder import Encoder
+from Patient import Patient
+from StiffSolver import StiffSolver
+from Therapy import Therapy
+
+
+@pytest.fixture(scope="module")
+def models(tmp_path_factory):
+    encoder = Encoder(Patient(), Therapy(0, profileName="bolusInjection"))
+    path = str(tmp_path_factory.mktemp("model") / "model.npz")
+    compileModel(encoder, path)
+    return encoder, CompiledModel(path)
+
+
+def test_sparseDataIndex(models):
+    encoder, model = models
+    for (rows, cols), matrix in [(model.getK_onPositions(), encoder.SystemMatSparse),
+                                 (model.getBindingPositions(), encoder.JacobianPattern)]:
+        np.testing.assert_array_equal(model.getSparseDataIndex(rows, cols, matrix),
+                                      encoder.systemMatricEncoder.getSparseDataIndex(rows, cols, matrix))
+
+    ## An entry outside of the pattern is an error, not the position of its neighbour
+    missing = np.argwhere(encoder.JacobianPattern.toarray() == 0)[0]
+    with pytest.raises(ValueError):
+        model.getSparseDataIndex([missing[0]], [missing[1]], encoder.JacobianPattern)
+
+
+def test_solveMatchesEncoder(models):
+    encoder, model = models
+    solutions = []
+    for source in models:
+        solver = StiffSolver(source)
+        solver.solve()
+        solutions.append(solver.solution.y)
+    np.testing.assert_array_equal(solutions[0], solutions[1])
+
+
+def test_setParameters(models, tmp_path):
+    ## Patient A compiled and then set to the parameters of patient B gives the model and the run of B, while a
+    ## solver built before keeps the model of A
+    encoder, _ = models
+    path = str(tmp_path / "model.npz")
+    compileModel(encoder, path)
+    model = CompiledModel(path)
+    solverA = StiffSolver(model)
+    reference = Encoder(Patient(BW=62, GFR=0.09, V_tu=0.2, tumorType="MEN", R_tu_density=20),
+                        Therapy(0, profileName="bolusInjection"))
+    model.setParameters(reference.theta)
+
+    scale = np.abs(reference.SystemMat).max()
+    np.testing.assert_allclose(model.SystemMat, reference.SystemMat, rtol=0, atol=1e-14 * scale)
+    np.testing.assert_allclose(model.JacobianPattern.toarray(), reference.JacobianPattern.toarray(), rtol=0,
+                               atol=1e-14 * scale)
+    for attribute in ["k_on", "R0", "V_int", "kOnPerVolume"]:
+        np.testing.assert_allclose(getattr(model.bindingEncoder, attribute),
+                                   getattr(reference.bindingEncoder, attribute), rtol=1e-14)
+
+    solutions = []
+    for source in [model, reference, encoder]:
+        solver = StiffSolver(source)
+        solver.solve()
+        solutions.append(solver.solution.y)
+    np.testing.assert_allclose(solutions[0], solutions[1], rtol=1e-6, atol=1e-9 * np.abs(solutions[1]).max())
+    solverA.solve()
+    np.testing.assert_array_equal(solverA.solution.y, solutions[2])
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from Encoder import Encoder
+from Patient import Patient
+from Therapy import Therapy
+
+
+def createSysMatLoop(organs):
+    ## The organ by organ assembly of SystemMat that the AssemblyMap replaced, as the reference
+    SystemMat = np.zeros((organs.N, organs.N))
+    LiverDict = organs.organsDict["RecPos"]["Liver"]
+    Art, Vein = sorted(organs.patient.Organs["ArtVein"], key=lambda organ: organ["name"] != "Art")
+    for type in organs.typesList:
+        for organ in organs.patient.Organs[type]:
+            organDict = organs.organsDict[type][organ["name"]]
+            x1 = organDict["stencil"]["base"]
+            L = organDict["stencil"]["length"]
+            subMat = np.zeros((L, L))
+            volumeMap = organDict["volumeMap"]
+            if organDict["name"] == "Kidney":
+                volumeMap = ["V_v", "V_v", "V_intra", "V_intra", "V_int", "V_int"]
+            for paramName in organDict["sysMatMap"].keys():
+                for elem in organDict["sysMatMap"][paramName]:
+                    sign = elem[-1]
+                    if paramName in ["F", "PS", "K_on", "F_fil", "F_R"]:
+                        subMat[elem[0], elem[1]] += sign * organ[paramName] / organ[volumeMap[elem[1]]]
+                    else:
+                        subMat[elem[0], elem[1]] += sign * organ[paramName]
+            SystemMat[x1:x1 + L, x1:x1 + L] = subMat
+
+            if type in ["RecPos", "RecNeg", "Kidney"]:
+                if organ["name"] in ["GI", "Spleen"]:
+                    row = LiverDict["stencil"]["base"]
+                    SystemMat[row, x1] = organ["F"] / organ["V_v"]
+                    SystemMat[row + 1, x1 + 1] = organ["F"] / organ["V_v"]
+                else:
+                    SystemMat[2, x1] = organ["F"] / organ["V_v"]
+                    SystemMat[3, x1 + 1] = organ["F"] / organ["V_v"]
+                SystemMat[x1, 0] = organ["F"] / Art["V_v"]
+                SystemMat[x1 + 1, 1] = organ["F"] / Art["V_v"]
+
+            shift = organs.organsDict["ArtVein"]["Vein"]["stencil"]["base"]
+            if type == "Lungs":
+                SystemMat[x1, shift] = organ["F"] / Vein["V_v"]
+                SystemMat[x1 + 1, 1 + shift] = organ["F"] / Vein["V_v"]
+                SystemMat[0, x1] = organ["F"] / organ["V_v"]
+                SystemMat[1, x1 + 1] = organ["F"] / organ["V_v"]
+
+            if type == "BloodProtein":
+                SystemMat[x1, shift] = organ["k_pr"]
+                SystemMat[x1 + 1, 1 + shift] = organ["k_pr"]
+    return SystemMat
+
+
+PATIENTS = {
+    "reference": {},
+    "female MEN": {"BW": 62, "BSA": 1.7, "H": 0.42, "gender": "female", "GFR": 0.09, "V_tu": 0.2, "tumorType": "MEN"}
+}
+
+
+@pytest.mark.parametrize("name", PATIENTS)
+def test_sysMatIsBitIdentical(name):
+    encoder = Encoder(Patient(**PATIENTS[name]), Therapy(0))
+    np.testing.assert_array_equal(encoder.SystemMat, createSysMatLoop(encoder.organsObj))
+
+
+def test_reassembly():
+    ## The map of one patient assembles the system matrix of any other patient with the same organs
+    encoder = Encoder(Patient(), Therapy(0))
+    other = Encoder(Patient(**PATIENTS["female MEN"]), Therapy(0))
+    theta = encoder.assemblyMap.getParameters(other.organsObj.patient)
+    np.testing.assert_array_equal(theta, other.theta)
+    np.testing.assert_array_equal(encoder.assemblyMap.getSysMat(theta), other.SystemMat)
+
+    SystemMatSparse = encoder.assemblyMap.getSparseSysMat(theta, encoder.SystemMatSparse)
+    np.testing.assert_array_equal(SystemMatSparse.indices, other.SystemMatSparse.indices)
+    np.testing.assert_array_equal(SystemMatSparse.indptr, other.SystemMatSparse.indptr)
+    np.testing.assert_array_equal(SystemMatSparse.data, other.SystemMatSparse.data)
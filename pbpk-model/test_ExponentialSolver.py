@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from Benchmark import Benchmark
+from Encoder import Encoder
+from ExponentialSolver import ExponentialSolver
+from Patient import Patient
+from StiffSolver import StiffSolver
+from Therapy import Therapy
+
+
+def test_errorFollowsTolerance():
+    ## The error at the output times against the Radau reference follows rtol instead of the accuracy of the
+    ## Hermite interpolant (about 2e-3 for every rtol)
+    benchmark = Benchmark(problems=["bolusInjection"], engines=["ETD2RK"], rtols=[1e-3, 1e-4], measureMemory=False)
+    errors = [result["maxError"] for result in benchmark.run()]
+    assert errors[0] < 1e-3
+    assert errors[1] < 1e-4
+
+
+@pytest.mark.parametrize("profileName", ["bolusInjection", "constantInjection60"])
+def test_matchesRadau(profileName):
+    ## The whole run of the bolus and of the infusion matches a tight-tolerance Radau run at the output times
+    encoder = Encoder(Patient(), Therapy(0, profileName=profileName))
+    reference = StiffSolver(encoder, method="Radau", rtol=1e-10, atol=1e-14)
+    reference.solve()
+    solver = ExponentialSolver(encoder, rtol=1e-3)
+    solver.solve()
+    assert solver.solution.success
+    np.testing.assert_array_equal(solver.solution.t, reference.solution.t)
+    error = np.max(np.abs(solver.solution.y - reference.solution.y))
+    assert error < 1e-3 * np.max(np.abs(reference.solution.y))
+    assert solver.totalHot == reference.totalHot
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from Encoder import Encoder
+from FlatPatient import FlatPatient, flattenPatient, loadStack, saveStack, stackPatients
+from ParameterSchema import getSchema
+from Patient import Patient
+from StiffSolver import StiffSolver
+from Therapy import Therapy
+
+
+PATIENTS = [Patient(), Patient(BW=62, BSA=1.7, H=0.42, gender="female", GFR=0.09, V_tu=0.2, tumorType="MEN")]
+
+
+def assertSameModel(encoder, reference):
+    np.testing.assert_array_equal(encoder.theta, reference.theta)
+    np.testing.assert_array_equal(encoder.SystemMat, reference.SystemMat)
+    for name in ["SystemMatSparse", "JacobianPattern"]:
+        for attribute in ["data", "indices", "indptr"]:
+            np.testing.assert_array_equal(getattr(getattr(encoder, name), attribute),
+                                          getattr(getattr(reference, name), attribute))
+    np.testing.assert_array_equal(encoder.BigVect, reference.BigVect)
+    for attribute in ["RP", "P_int", "k_on", "R0", "V_int"]:
+        np.testing.assert_array_equal(getattr(encoder.bindingEncoder, attribute),
+                                      getattr(reference.bindingEncoder, attribute))
+
+
+@pytest.mark.parametrize("i", range(len(PATIENTS)))
+def test_sameModelAndRun(i):
+    therapy = Therapy(0, profileName="constantInjection60")
+    reference = Encoder(PATIENTS[i], therapy)
+    encoder = Encoder(flattenPatient(PATIENTS[i]), therapy)
+    assertSameModel(encoder, reference)
+
+    solver = StiffSolver(encoder)
+    solver.solve()
+    referenceSolver = StiffSolver(reference)
+    referenceSolver.solve()
+    np.testing.assert_array_equal(solver.solution.y, referenceSolver.solution.y)
+    assert solver.stats.nfev == referenceSolver.stats.nfev
+
+
+def test_memoryMappedStack(tmp_path):
+    ## The rows of a memory-mapped stack are patients without copies, gathered into theta with integer indices
+    schema = getSchema(PATIENTS[0])
+    path = str(tmp_path / "cohort")
+    saveStack(path, stackPatients(PATIENTS, schema), schema)
+    values, loadedSchema = loadStack(path)
+    assert loadedSchema == schema
+    assert isinstance(values, np.memmap)
+
+    therapy = Therapy(0)
+    references = [Encoder(patient, therapy) for patient in PATIENTS]
+    for row, reference in zip(values, references):
+        patient = FlatPatient(row, loadedSchema)
+        assert np.shares_memory(patient.values, values)
+        assertSameModel(Encoder(patient, therapy), reference)
+    theta = references[0].assemblyMap.getParameterMatrix(values, loadedSchema)
+    np.testing.assert_array_equal(theta, [reference.theta for reference in references])
+
+
+def test_organViews():
+    patient = flattenPatient(PATIENTS[0])
+    tumor = patient.Organs["RecPos"][0]
+    assert tumor["name"] == "Tumor"
+    assert dict(tumor) == PATIENTS[0].Tumor
+    tumor["R0"] = 2.0
+    assert patient.values[patient.schema.index[("Tumor", "R0")]] == 2.0
+    with pytest.raises(KeyError):
+        tumor["unknown"] = 1.0
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+from scipy.integrate import solve_ivp
+
+from Encoder import Encoder
+from InjectionSchedule import InjectionSchedule
+from MassBalanceMonitor import MassBalanceError, MassBalanceMonitor
+from Patient import Patient
+from StiffSolver import StiffSolver
+from Therapy import Therapy
+
+
+PROFILES = ["bolusInjection", "bolusTrainInjection3", "constantInjection60"]
+
+
+def getSolver(profileName, **options):
+    return StiffSolver(Encoder(Patient(), Therapy(0, profileName=profileName)), **options)
+
+
+def test_schedule():
+    schedule = getSolver("bolusTrainInjection3").injectionSchedule
+    np.testing.assert_array_equal(schedule.getBreakpoints(0, 1000), [0, 180, 360, 1000])
+    assert schedule.getBolus(180) == (30, 10 / 3)
+    assert schedule.getTotalAmount(200) == (60, 20 / 3)
+    assert schedule.getTotalAmount(180, includeBolusesAt=False) == (30, 10 / 3)
+
+    schedule = getSolver("constantInjection60").injectionSchedule
+    np.testing.assert_array_equal(schedule.getBreakpoints(0, 1000), [0, 60, 1000])
+    assert schedule.getRate(0) == (1.5, 10 / 60)
+    assert schedule.getRate(60) == (0, 0)
+    assert schedule.getTotalAmount(30) == (45, 5)
+
+
+@pytest.mark.parametrize("rtol", [1e-3, 1e-6])
+@pytest.mark.parametrize("profileName", PROFILES)
+def test_injectedAmount(profileName, rtol):
+    ## The trial and rejected stages of the integrator do not inject anything, so the injected amount is the one of
+    ## the profile whatever the number of RHS calls, and the mass balance holds over the run
+    monitor = MassBalanceMonitor(rtol=10 * rtol)
+    solver = getSolver(profileName, rtol=rtol, atol=1e-3 * rtol, monitor=monitor)
+    solver.solve()
+    cold, hot = solver.injectionSchedule.getTotalAmount(solver.t_f)
+    assert solver.totalCold == pytest.approx(cold, rel=1e-14)
+    assert solver.totalHot == pytest.approx(hot, rel=1e-14)
+    assert monitor.isValid(), monitor.violations
+
+
+def test_abortsAtTheFirstWrongBolus(monkeypatch):
+    ## A bolus train injecting 5 times its amounts stops the run at its first bolus, not at the end of the run
+    getBolus = InjectionSchedule.getBolus
+    monkeypatch.setattr(InjectionSchedule, "getBolus",
+                        lambda self, t: tuple(5 * amount for amount in getBolus(self, t)))
+    solver = getSolver("bolusTrainInjection3", monitor=MassBalanceMonitor(abort=True))
+    with pytest.raises(MassBalanceError, match="injected amount") as error:
+        solver.solve()
+    assert error.value.violation[0] == 0
+
+
+def test_infusionMatchesContinuousReference():
+    ## The infusion as a rate source term of the segments is the same model as one integration of F with a time
+    ## dependent rate, which only the tight tolerance steps over the end of the infusion correctly
+    outputTimes = np.linspace(0, 600, 61)
+    solver = getSolver("constantInjection60", method="Radau", rtol=1e-10, atol=1e-13, outputTimes=outputTimes)
+    solver.t_f = outputTimes[-1]
+    solver.solve()
+
+    reference = getSolver("constantInjection60")
+    reference.reset()
+
+    def F(t, X):
+        reference.rateCold, reference.rateHot = reference.injectionSchedule.getRate(t)
+        return reference.F(t, X)
+
+    result = solve_ivp(F, [0, solver.t_f], reference.initialState, method="Radau", jac=reference.jac, rtol=1e-12,
+                       atol=1e-15, t_eval=outputTimes)
+    np.testing.assert_allclose(solver.solution.y, result.y, rtol=0, atol=1e-8 * np.abs(result.y).max())
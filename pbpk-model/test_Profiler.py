@@ -0,0 +1,30 @@
+import numpy as np
+
+from Encoder import Encoder
+from Patient import Patient
+from Profiler import Profiler
+from StiffSolver import StiffSolver
+from Therapy import Therapy
+
+
+def test_phases():
+    profiler = Profiler(trackAllocations=True)
+    with profiler.phase("allocate"):
+        kept = np.ones(1 << 20)
+    with profiler.phase("free"):
+        del kept
+    summary = profiler.getSummary()
+    ## Net memory: what the phase kept, negative for a phase that frees memory
+    assert summary["allocate"][3] >= 8 * (1 << 20)
+    assert summary["free"][3] <= -8 * (1 << 20)
+
+
+def test_instrument(tmp_path):
+    profiler = Profiler()
+    solver = profiler.instrument(StiffSolver(Encoder(Patient(), Therapy(0, profileName="bolusInjection"))))
+    solver.solve()
+    summary = profiler.getSummary()
+    assert summary["RHS"][0] == solver.stats.nfev
+    assert summary["Jacobian"][0] == solver.stats.njev
+    profiler.exportChromeTrace(str(tmp_path / "trace.json"))
+    assert "RHS" in profiler.getReport()
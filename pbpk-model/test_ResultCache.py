@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from AdaptiveSolver import AdaptiveSolver
+from Encoder import Encoder
+from FlatPatient import FlatPatient, flattenPatient
+from Patient import Patient
+from ResultCache import ResultCache
+from Solver import Solver
+from StiffSolver import StiffSolver
+from Therapy import Therapy
+
+
+OUTPUT_TIMES = np.linspace(0, 1000, 5)
+
+
+def getKey(cache, patient, solverClass=StiffSolver, solverOptions=None):
+    therapy = Therapy(0)
+    solver = solverClass(Encoder(patient, therapy), outputTimes=OUTPUT_TIMES, **(solverOptions or dict()))
+    return cache.getKey(patient, therapy, solver, solverOptions)
+
+
+def test_hit(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path))
+    entry = cache.solve(Patient(), Therapy(0), outputTimes=OUTPUT_TIMES)
+
+    ## The second run is read from the cache without solving
+    def fail(self):
+        raise AssertionError("The cached run was solved again")
+
+    monkeypatch.setattr(StiffSolver, "solve", fail)
+    cached = cache.solve(Patient(), Therapy(0), outputTimes=OUTPUT_TIMES)
+    for name, value in entry.items():
+        np.testing.assert_array_equal(cached[name], value)
+    ## An explicit default is the same run
+    cache.solve(Patient(), Therapy(0), solverOptions={"rtol": 1e-3, "method": "BDF"}, outputTimes=OUTPUT_TIMES)
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+def test_missWhenAnOptionChanges(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    patient = Patient()
+    key = getKey(cache, patient)
+    assert getKey(cache, patient, solverOptions={"rtol": 1e-6}) != key
+    assert getKey(cache, patient, solverOptions={"useJacobian": False}) != key
+    assert getKey(cache, Patient(BW=70)) != key
+
+    ## The effective horizon of the AdaptiveSolver is part of the key, also when it is its class default
+    key = getKey(cache, patient, AdaptiveSolver)
+    assert getKey(cache, patient, AdaptiveSolver, {"t_f": 75}) == key
+    assert getKey(cache, patient, AdaptiveSolver, {"t_f": 10}) != key
+
+
+def test_rejectsTheRK4Solver(tmp_path):
+    with pytest.raises(TypeError, match="Solver"):
+        ResultCache(str(tmp_path)).solve(Patient(), Therapy(0), solverClass=Solver)
+
+
+def test_evictsLeastRecentlyUsed(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    patients = [Patient(BW=BW) for BW in [60, 70, 80]]
+    keys = [getKey(cache, patient) for patient in patients]
+    cache.solve(patients[0], Therapy(0), outputTimes=OUTPUT_TIMES)
+    cache.maxBytes = 2.5 * (tmp_path / (keys[0] + ".npz")).stat().st_size    ## Room for two entries
+    cache.solve(patients[1], Therapy(0), outputTimes=OUTPUT_TIMES)
+    cache.load(keys[0])     ## patients[0] is now more recently used than patients[1]
+    cache.solve(patients[2], Therapy(0), outputTimes=OUTPUT_TIMES)
+    assert cache.load(keys[1]) is None
+    assert cache.load(keys[0]) is not None
+    assert cache.load(keys[2]) is not None
+
+
+def test_flatPatientKey(tmp_path):
+    ## The key of a FlatPatient only depends on its values: the same for two patients over equal (or shared)
+    ## values, different when a value changes
+    cache = ResultCache(str(tmp_path))
+    patient = flattenPatient(Patient())
+    key = getKey(cache, patient)
+    assert getKey(cache, FlatPatient(patient.values.copy(), patient.schema)) == key
+    assert getKey(cache, flattenPatient(Patient())) == key
+    other = FlatPatient(patient.values.copy(), patient.schema)
+    other.Organs["RecPos"][0]["R0"] = 2.0
+    assert getKey(cache, other) != key
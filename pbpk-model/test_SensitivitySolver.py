@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from Encoder import Encoder
+from Patient import Patient
+from SensitivitySolver import SensitivitySolver
+from StiffSolver import StiffSolver
+from Therapy import Therapy
+
+
+## Organ parameters, a shared constant and a parameter that only enters through the derived F_fil and F_R
+PARAMETERS = [("Tumor", "R0"), ("Liver", "PS"), ("Tumor", "V_int"), "k_on", ("Kidney", "GFR")]
+
+
+def getPerturbedPatient(parameter, relativeStep):
+    ## Patient with the parameter (of every organ that has it, for a name alone) moved by relativeStep of its value
+    patient = Patient()
+    for organs in patient.Organs.values():
+        for organ in organs:
+            if isinstance(parameter, str):
+                paramName, selected = parameter, parameter in organ
+            else:
+                paramName, selected = parameter[1], organ["name"] == parameter[0]
+            if selected:
+                organ[paramName] *= 1 + relativeStep
+                if paramName == "GFR":
+                    organ["F_fil"] = organ["GFR"] * organ["phi"]
+                    organ["F_R"] = organ["F_fil"] * (1 - organ["f_exc"])
+    return patient
+
+
+def getPerturbedStep(parameter, relativeStep):
+    organs = {organ["name"]: organ for organs in Patient().Organs.values() for organ in organs}
+    return relativeStep * (organs["Tumor"][parameter] if isinstance(parameter, str) else
+                           organs[parameter[0]][parameter[1]])
+
+
+@pytest.mark.parametrize("profileName", ["bolusInjection", "constantInjection60"])
+def test_matchesFiniteDifferences(profileName):
+    therapy = Therapy(0, profileName=profileName)
+    outputTimes = np.linspace(0, 1000, 21)
+    options = {"method": "Radau", "rtol": 1e-8, "atol": 1e-11, "outputTimes": outputTimes}
+    solver = SensitivitySolver(Encoder(Patient(), therapy), PARAMETERS, **options)
+    solver.t_f = outputTimes[-1]
+    solver.solve()
+
+    relativeStep = 1e-4
+    for j, parameter in enumerate(PARAMETERS):
+        states = []
+        for sign in [1, -1]:
+            run = StiffSolver(Encoder(getPerturbedPatient(parameter, sign * relativeStep), therapy), **options)
+            run.t_f = outputTimes[-1]
+            run.solve()
+            states.append(run.solution.y)
+        reference = (states[0] - states[1]) / (2 * getPerturbedStep(parameter, relativeStep))
+        np.testing.assert_allclose(solver.sensitivity[j], reference, rtol=0, atol=1e-5 * np.abs(reference).max(),
+                                   err_msg=str(parameter))
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from Encoder import Encoder
+from Patient import Patient
+from Solver import Solver
+from Therapy import Therapy
+
+
+@pytest.fixture(scope="module", params=["bolusInjection", "constantInjection60"])
+def encoder(request):
+    return Encoder(Patient(), Therapy(0, profileName=request.param))
+
+
+@pytest.mark.parametrize("incrementalK_on", [False, True])
+def test_solveTwice(encoder, incrementalK_on):
+    solver = Solver(encoder, incrementalK_on=incrementalK_on)
+    solver.tList = solver.tList[:1001]
+    solver.solve()
+    states = np.array(solver.BigVectList)
+    solver.solve()
+    np.testing.assert_array_equal(solver.BigVectList, states)
+
+
+@pytest.mark.parametrize("useSparse", [True, False])
+def test_incrementalMatchesUpdate(encoder, useSparse):
+    ## The K_on scatter of the incremental mode gives the same run as updating the system matrix
+    runs = []
+    for incrementalK_on in [True, False]:
+        solver = Solver(encoder, useSparse=useSparse, incrementalK_on=incrementalK_on)
+        solver.tList = solver.tList[:1001]
+        solver.solve()
+        runs.append(np.array(solver.BigVectList))
+    np.testing.assert_allclose(runs[0], runs[1], rtol=1e-10, atol=1e-10 * np.abs(runs[1]).max())
+
+
+def test_sparseMatchesDense(encoder):
+    ## The RK4 loop gives the same run with the sparse system matrix as with the dense one
+    runs = []
+    for useSparse in [True, False]:
+        solver = Solver(encoder, useSparse=useSparse)
+        solver.tList = solver.tList[:1001]
+        solver.solve()
+        runs.append(np.array(solver.BigVectList))
+    np.testing.assert_allclose(runs[0], runs[1], rtol=1e-12, atol=1e-12 * np.abs(runs[1]).max())
+
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+from scipy.integrate import solve_ivp
+
+from Encoder import Encoder
+from Patient import Patient
+from StiffSolver import StiffSolver
+from Therapy import Therapy
+
+
+OPTIONS = {"method": "Radau", "rtol": 1e-10, "atol": 1e-14}
+
+
+@pytest.fixture(scope="module")
+def solver():
+    ## Boluses at 0, 180 and 360 min, over the first clinical sampling times
+    solver = StiffSolver(Encoder(Patient(), Therapy(0, profileName="bolusTrainInjection3")), **OPTIONS)
+    solver.t_f = 3000
+    solver.solve()
+    return solver
+
+
+def getReference(solver, t):
+    ## solve_ivp t_eval output of every segment, with the boluses applied at its start. The times of a bolus
+    ## belong to the segment that starts there (right continuous)
+    Y = np.zeros((solver.organsObj.N, t.shape[0]))
+    X = solver.initialState.copy()
+    schedule = solver.injectionSchedule
+    for a, b in schedule.getSegments(solver.t_0, solver.t_f):
+        cold, hot = schedule.getBolus(a)
+        X[solver.Vein_index_cold] += cold
+        X[solver.Vein_index_hot] += hot
+        mask = (t >= a) & ((t < b) | (b == solver.t_f))
+        segment = solve_ivp(solver.F, [a, b], X, t_eval=np.unique(np.append(t[mask], b)), jac=solver.jac, **OPTIONS)
+        Y[:, mask] = segment.y[:, np.isin(segment.t, t[mask])]
+        X = segment.y[:, -1]
+    return Y
+
+
+def test_matchesSolveIvp(solver):
+    results = solver.results
+    t = np.unique(np.concatenate([[0, 90, 180, 270, 360, 3000], results.getClinicalTimes()]))
+    reference = getReference(solver, t)
+    scale = np.max(np.abs(reference))
+    np.testing.assert_allclose(results(t), reference, rtol=0, atol=1e-7 * scale)
+    np.testing.assert_allclose(results(180.0), reference[:, t == 180][:, 0], rtol=0, atol=1e-7 * scale)
+
+    ## At a bolus time the state is the one right after the bolus
+    bolusCold = solver.injectionSchedule.getBolus(180)[0]
+    before = results(np.nextafter(180, 0))[solver.Vein_index_cold]
+    assert results(180.0)[solver.Vein_index_cold] - before == pytest.approx(bolusCold, rel=1e-6)
+
+    base, bigVectMap = results.getOrganIndex("Kidney")
+    organ = results.getOrgan("Kidney", t)
+    assert set(organ) == set(bigVectMap)
+    for variable, values in organ.items():
+        np.testing.assert_allclose(values, reference[base + bigVectMap[variable]], rtol=0, atol=1e-7 * scale)
+    labeled = [base + i for variable, i in bigVectMap.items() if "*" in variable]
+    np.testing.assert_allclose(results.getOrganAmount("Kidney", t), reference[labeled].sum(axis=0), rtol=0,
+                               atol=1e-7 * scale)
+
+
+def test_clinicalTimes(solver):
+    ## The imaging times up to the end of the run (48 h of the 50 h run)
+    np.testing.assert_array_equal(solver.results.getClinicalTimes(), np.array([0.5, 1, 2, 4, 24, 48]) * 60)
+    with pytest.raises(ValueError):
+        solver.results(solver.t_f + 1)
@@ -0,0 +1,168 @@
+import numpy as np
+import pytest
+from scipy.integrate._ivp import bdf, radau
+
+from AdaptiveSolver import AdaptiveSolver
+from Encoder import Encoder
+from ExponentialSolver import ExponentialSolver
+from Patient import Patient
+from SensitivitySolver import SensitivitySolver
+from StiffSolver import StiffSolver
+from Therapy import Therapy
+
+
+## (solver class, options, end of the run, pause time). The explicit AdaptiveSolver only runs over the first minutes
+SOLVERS = {
+    "BDF": (StiffSolver, {"method": "BDF", "rtol": 1e-6, "atol": 1e-9}, 100000, 500),
+    "Radau": (StiffSolver, {"method": "Radau", "rtol": 1e-6, "atol": 1e-9}, 100000, 500),
+    "ETD2RK": (ExponentialSolver, dict(), 100000, 500),
+    "DOPRI5": (AdaptiveSolver, dict(), 10, 3),
+    "Sensitivity": (SensitivitySolver, {"parameters": [("Tumor", "R0")], "rtol": 1e-6, "atol": 1e-9}, 100000, 500)
+}
+
+
+@pytest.fixture(scope="module", params=["bolusInjection", "constantInjection60"])
+def encoder(request):
+    return Encoder(Patient(), Therapy(0, profileName=request.param))
+
+
+def getSolver(encoder, name):
+    solverClass, options, t_f, t_pause = SOLVERS[name]
+    solver = solverClass(encoder, **options)
+    solver.t_f = t_f
+    return solver, t_pause
+
+
+def assertClose(X, reference, rtol):
+    ## A pause restarts the step size control, so the run only matches the uninterrupted one up to the tolerance
+    assert np.max(np.abs(X - reference)) <= 10 * rtol * np.max(np.abs(reference))
+
+
+@pytest.mark.parametrize("name", SOLVERS)
+def test_solveTwice(encoder, name):
+    solver, _ = getSolver(encoder, name)
+    solver.solve()
+    y = solver.solution.y.copy()
+    nfev = solver.stats.nfev
+    solver.solve()
+    np.testing.assert_array_equal(solver.solution.y, y)
+    assert solver.stats.nfev == nfev
+
+
+@pytest.mark.parametrize("name", SOLVERS)
+def test_pauseAndResume(encoder, name):
+    solver, t_pause = getSolver(encoder, name)
+    solver.solve()
+    reference = solver.X.copy()
+
+    solver.reset()
+    solver.advance(t_pause)
+    snapshot = solver.getSnapshot()
+    solver.advance(solver.t_f)
+    assertClose(solver.X, reference, solver.rtol)
+
+    resumed, _ = getSolver(encoder, name)
+    resumed.reset()
+    resumed.restore(snapshot)
+    resumed.advance(resumed.t_f)
+    np.testing.assert_array_equal(resumed.X, solver.X)
+    assert resumed.totalHot == solver.totalHot
+
+
+@pytest.mark.parametrize("name", SOLVERS)
+def test_fork(encoder, name):
+    solver, t_pause = getSolver(encoder, name)
+    solver.solve()
+    reference = solver.X.copy()
+
+    solver.reset()
+    solver.advance(t_pause)
+    child = solver.fork()
+    solver.advance(solver.t_f)
+    child.advance(child.t_f)
+    np.testing.assert_array_equal(child.X, solver.X)
+    assertClose(child.X, reference, child.rtol)
+
+
+@pytest.mark.parametrize("method", ["BDF", "Radau", "RK45"])
+def test_countRejections(encoder, method):
+    ## The stepped integration counts the rejected steps and gives the same run as solve_ivp
+    options = {"method": method, "useJacobian": method != "RK45", "rtol": 1e-6, "atol": 1e-9}
+    solver = StiffSolver(encoder, countRejections=True, **options)
+    reference = StiffSolver(encoder, **options)
+    if method == "RK45":
+        solver.t_f = reference.t_f = 5
+    solver.solve()
+    reference.solve()
+    np.testing.assert_array_equal(solver.solution.y, reference.solution.y)
+    assert solver.stats.nsteps == reference.stats.nsteps
+    assert reference.stats.nrejected is None
+    assert solver.stats.nrejected >= 0
+    if method == "RK45":
+        ## Every attempt costs 6 evaluations, plus 2 for the first step of each segment
+        segments = len(solver.segments)
+        assert solver.stats.nfev == 2 * segments + 6 * (solver.stats.nsteps + solver.stats.nrejected)
+
+
+@pytest.mark.parametrize("method", ["BDF", "Radau"])
+def test_rejectionsMatchAttempts(encoder, method, monkeypatch):
+    ## Independent count of the attempts: every attempt of scipy solves its Newton system at its own step (t_new for
+    ## BDF, (t, h) for Radau), a retry with a refreshed Jacobian solves it again at the same step
+    attempts = set()
+    module, name, key = {"BDF": (bdf, "solve_bdf_system", lambda args: args[1]),
+                         "Radau": (radau, "solve_collocation_system", lambda args: (args[1], args[3]))}[method]
+    original = getattr(module, name)
+
+    def solveCounted(*args, **kwargs):
+        attempts.add(key(args))
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(module, name, solveCounted)
+    ## A first step far too large for the start of the run, so the integrator has to reject it several times
+    solver = StiffSolver(encoder, method=method, countRejections=True, rtol=1e-6, atol=1e-9)
+    solver.reset()
+    solver.firstStep = 1000
+    segment = solver.integrateSegment(0, 5000, solver.inject(0, solver.X))
+    assert segment.nrejected > 0
+    assert segment.nrejected == len(attempts) - (segment.t.shape[0] - 1)
+
+
+def getBFunctionLoop(solver, X):
+    ## The organ by organ binding term that the vectorized getBFunction replaced, as the reference
+    B = np.zeros(X.shape)
+    for type in ["Kidney", "RecPos"]:
+        for organ in solver.organsObj.patient.Organs[type]:
+            organDict = solver.organsObj.organsDict[type][organ["name"]]
+            index = {key: organDict["stencil"]["base"] + shift for key, shift in organDict["bigVectMap"].items()}
+            free = organDict["R0"] - (X[index["RP*"]] + X[index["RP"]])
+            for RP, P_int in [("RP*", "P*_int"), ("RP", "P_int")]:
+                B[index[RP]] = organDict["k_on"] * X[index[P_int]] * free / organ["V_int"]
+                B[index[P_int]] = -B[index[RP]]
+    return B
+
+
+def getStates(encoder, n=5):
+    ## Random states of the scale of a run, with the bound receptors up to their total
+    rng = np.random.default_rng(0)
+    scale = np.maximum(np.abs(encoder.BigVect).max(), 1)
+    return [scale * rng.random(encoder.BigVect.shape) for _ in range(n)]
+
+
+def test_bindingMatchesLoop(encoder):
+    solver = StiffSolver(encoder)
+    for X in getStates(encoder):
+        np.testing.assert_allclose(solver.getBFunction(X), getBFunctionLoop(solver, X), rtol=1e-13, atol=0)
+
+
+@pytest.mark.parametrize("useSparse", [True, False])
+def test_jacobianMatchesFiniteDifferences(encoder, useSparse):
+    solver = StiffSolver(encoder, useSparse=useSparse)
+    solver.reset()
+    for X in getStates(encoder, 2):
+        J = solver.jac(0, X)
+        J = J if isinstance(J, np.ndarray) else J.toarray()
+        ## F is quadratic, so the central differences are exact up to rounding
+        steps = 1e-3 * np.maximum(np.abs(X), 1) * np.eye(X.shape[0])
+        reference = np.stack([(solver.F(0, X + step) - solver.F(0, X - step)) / (2 * step.max()) for step in steps],
+                             axis=1)
+        np.testing.assert_allclose(J, reference, rtol=1e-6, atol=1e-9 * np.abs(reference).max())
@@ -0,0 +1,32 @@
+import numpy as np
+
+from Encoder import Encoder
+from Patient import Patient
+from StiffSolver import StiffSolver
+from Sweep import Sweep
+from Therapy import Therapy
+
+
+PATIENTS = [Patient(), Patient(BW=62, gender="female")]
+PROFILES = ["bolusInjection", "constantInjection60", "bolusTrainInjection3"]
+
+
+def test_matchesSequentialRuns():
+    ## Every row of the table is the run of its (patient, profile) case in this process
+    outputTimes = np.linspace(0, 1000, 11)
+    sweep = Sweep(PROFILES, patients=PATIENTS, outputTimes=outputTimes, maxWorkers=2).run()
+    N = Encoder(PATIENTS[0], Therapy(0)).organsObj.N
+    assert sweep.Y.shape == (len(PATIENTS) * len(PROFILES), N, outputTimes.shape[0])
+    np.testing.assert_array_equal(sweep.t, outputTimes)
+    np.testing.assert_array_equal(sweep.patientIndex, [0, 0, 0, 1, 1, 1])
+    np.testing.assert_array_equal(sweep.profileName, PROFILES * 2)
+
+    for patientIndex, patient in enumerate(PATIENTS):
+        for profileName in PROFILES:
+            rows = sweep.getRows(profileName=profileName, patientIndex=patientIndex)
+            assert rows.shape == (1,)
+            solver = StiffSolver(Encoder(patient, Therapy(0, profileName=profileName)), outputTimes=outputTimes)
+            solver.solve()
+            np.testing.assert_allclose(sweep.Y[rows[0]], solver.solution.y, rtol=1e-12, atol=0)
+            assert sweep.totalHot[rows[0]] == solver.totalHot
+            assert sweep.nfev[rows[0]] == solver.solution.nfev
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+try:
+    import torch
+    from TorchBackend import TorchPBPK
+except (ImportError, OSError):     ## A broken torch install fails with an OSError when loading its libraries
+    pytest.skip("the PyTorch backend needs torch and torchdiffeq", allow_module_level=True)
+
+from Encoder import Encoder
+from Patient import Patient
+from SensitivitySolver import SensitivitySolver
+from StiffSolver import StiffSolver
+from Therapy import Therapy
+
+
+@pytest.fixture(scope="module")
+def encoder():
+    return Encoder(Patient(), Therapy(0, profileName="bolusInjection"))
+
+
+def test_rightHandSide(encoder):
+    ## The gathered product and the binding terms give the right hand side of the StiffSolver
+    model = TorchPBPK(encoder)
+    solver = StiffSolver(encoder)
+    rng = np.random.default_rng(0)
+    with torch.no_grad():
+        np.testing.assert_allclose(model.getSystemMat(model.getTheta()).numpy(), encoder.SystemMat, rtol=1e-12,
+                                   atol=1e-15)
+        for _ in range(3):
+            X = rng.random(encoder.BigVect.shape[0])
+            np.testing.assert_allclose(model(0, torch.as_tensor(X)).numpy(), solver.F(0, X), rtol=1e-10,
+                                       atol=1e-12)
+
+
+def test_batchedRightHandSide(encoder):
+    model = TorchPBPK(encoder, batchSize=3)
+    X = torch.as_tensor(np.random.default_rng(1).random((3, encoder.BigVect.shape[0])))
+    with torch.no_grad():
+        dX = model(0, X)
+        for m in range(3):
+            np.testing.assert_allclose(dX[m].numpy(), TorchPBPK(encoder)(0, X[m]).numpy(), rtol=1e-12)
+
+
+def test_simulateMatchesStiffSolver(encoder):
+    t = np.array([0, 0.1, 1, 5, 10])
+    model = TorchPBPK(encoder, rtol=1e-8, atol=1e-10)
+    with torch.no_grad():
+        states = model.simulate(t).numpy()
+    solver = StiffSolver(encoder, method="Radau", rtol=1e-10, atol=1e-14, outputTimes=t)
+    solver.t_f = 10
+    solver.solve()
+    np.testing.assert_allclose(states.T, solver.solution.y, rtol=1e-5, atol=1e-8 * np.abs(solver.solution.y).max())
+
+
+def test_gradient(encoder):
+    ## The gradient of the final state matches the forward sensitivities of the SensitivitySolver, also for GFR that
+    ## only enters through the derived F_fil and F_R
+    t = np.array([0, 1])
+    model = TorchPBPK(encoder, rtol=1e-10, atol=1e-13)
+    model.simulate(t)[-1].sum().backward()
+    assert torch.isfinite(model.theta.grad).all()
+
+    parameters = [("Tumor", "R0"), ("Kidney", "GFR"), ("Liver", "PS"), ("Tumor", "k_on")]
+    solver = SensitivitySolver(encoder, parameters, method="Radau", rtol=1e-10, atol=1e-13, outputTimes=t)
+    solver.t_f = 1
+    solver.solve()
+    expected = solver.sensitivity[:, :, -1].sum(axis=1)
+    gradient = [model.theta.grad[model.parameterIndex[parameter]].item() for parameter in parameters]
+    np.testing.assert_allclose(gradient, expected, rtol=1e-6)
+
+
+def test_adjointGradientWithInfusion():
+    ## odeint_adjoint calls the right hand side again in backward: the infusions of each segment must still be there
+    encoder = Encoder(Patient(), Therapy(0, profileName="constantInjection60"))
+    t = np.array([0, 0.5, 1.5])
+    gradients = []
+    for adjoint in (False, True):
+        model = TorchPBPK(encoder, adjoint=adjoint, rtol=1e-10, atol=1e-13)
+        model.simulate(t)[-1].sum().backward()
+        gradients.append([model.theta.grad, model.infusionCold.grad, model.infusionHot.grad])
+    for direct, adjoint in zip(*gradients):
+        assert direct.abs().max() > 0
+        np.testing.assert_allclose(adjoint.numpy(), direct.numpy(), rtol=1e-5, atol=1e-8 * direct.abs().max().item())
+
+
+def test_simulateFromLaterTime(encoder):
+    ## The injections before the first output time are kept: the run starts at t_0 = 0
+    model = TorchPBPK(encoder, rtol=1e-8, atol=1e-10)
+    with torch.no_grad():
+        full = model.simulate(np.array([0, 1, 5])).numpy()
+        late = model.simulate(np.array([1, 5])).numpy()
+    np.testing.assert_allclose(late, full[1:], rtol=1e-6, atol=1e-10 * np.abs(full).max())
+    with pytest.raises(ValueError):
+        model.simulate(np.array([-1, 1]))
@@ -0,0 +1,48 @@
+import gc
+import os
+
+import numpy as np
+
+from TrajectoryRecorder import TrajectoryRecorder
+
+
+def record(recorder, T):
+    states = np.random.default_rng(0).random((T, recorder.N))
+    for t, X in enumerate(states):
+        recorder.append(float(t), X)
+    return states
+
+
+def test_roundTrip():
+    recorder = TrajectoryRecorder(5, chunkSize=4)
+    states = record(recorder, 11)
+    np.testing.assert_array_equal(recorder.getStates(), states)
+    np.testing.assert_array_equal(recorder.getTimes(), np.arange(11))
+    np.testing.assert_array_equal(recorder.getPrevious(2), states[-2])
+
+
+def test_temporaryFilesAreDeleted():
+    recorder = TrajectoryRecorder(5, chunkSize=4)
+    states = record(recorder, 11)
+    recorded = recorder.getStates()
+    paths = [recorder.path, recorder.timePath]
+    del recorder
+    gc.collect()
+    assert not any(os.path.exists(path) for path in paths)
+    np.testing.assert_array_equal(recorded, states)
+
+
+def test_givenPathIsKept(tmp_path):
+    path = str(tmp_path / "run.npy")
+    recorder = TrajectoryRecorder(5, path=path, chunkSize=4)
+    states = record(recorder, 11)
+    recorded = recorder.getStates()
+
+    ## The next run on the same path replaces the files without invalidating the earlier arrays
+    empty = recorder.getEmpty()
+    assert empty.path == path
+    del recorder
+    gc.collect()
+    record(empty, 3)
+    assert empty.getStates().shape == (3, 5)
+    np.testing.assert_array_equal(recorded, states)
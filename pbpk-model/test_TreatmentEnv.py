@@ -0,0 +1,58 @@
+import numpy as np
+
+from Encoder import Encoder
+from Patient import Patient
+from StiffSolver import StiffSolver
+from Therapy import Therapy
+from TreatmentEnv import TreatmentEnv
+
+
+OPTIONS = {"decisionInterval": 720, "maxSteps": 3, "rtol": 1e-10, "atol": 1e-13}
+
+
+def getReference(action, env):
+    ## One StiffSolver run of the episode: a bolus train of the action at every decision time
+    therapy = Therapy(0)
+    therapy.injectionProfile = {"type": "bolusTrain", "N": env.maxSteps,
+                                "t": [k * env.decisionInterval for k in range(env.maxSteps)],
+                                "totalAmountCold": env.maxSteps * action[0],
+                                "totalAmountHot": env.maxSteps * action[1]}
+    solver = StiffSolver(Encoder(Patient(), therapy), method="BDF", rtol=1e-10, atol=1e-13)
+    solver.t_f = env.maxSteps * env.decisionInterval
+    solver.solve()
+    return solver
+
+
+def test_matchesStiffSolverRun():
+    env = TreatmentEnv(**OPTIONS)
+    action = np.array([50.0, 5.0])
+    reference = getReference(action, env)
+    observation, info = env.reset(seed=0)
+    assert observation.shape == (env.observationSize,)
+    assert info["totalHot"] == 0
+
+    for k, segment in enumerate(reference.segments):
+        observation, reward, terminated, truncated, info = env.step(action)
+        X = segment.y[:, -1]    ## The state at the end of the interval, before the next bolus
+        scale = np.abs(X).max()
+        np.testing.assert_allclose(env.X, X, rtol=0, atol=1e-8 * scale)
+        np.testing.assert_allclose(observation[:-1], np.concatenate([env.coldProjection @ X, env.hotProjection @ X]),
+                                   rtol=0, atol=1e-8 * scale)
+        assert observation[-1] == (k + 1) * env.decisionInterval
+
+        ## The reward is the weighted time integral of the labeled amounts over the interval
+        t = np.linspace(segment.t[0], segment.t[-1], 20001)
+        doses = np.trapz(env.hotProjection @ segment.sol(t), t, axis=1)
+        np.testing.assert_allclose(reward, env.rewardScale * env.rewardWeights @ doses, rtol=1e-5)
+        assert terminated == (k == env.maxSteps - 1)
+        assert not truncated
+    assert info["totalHot"] == reference.totalHot
+    assert info["totalCold"] == reference.totalCold
+
+
+def test_clipsActions():
+    env = TreatmentEnv(**OPTIONS)
+    env.reset()
+    _, _, _, _, info = env.step([1e6, -1])
+    assert info["totalCold"] == env.actionHigh[0]
+    assert info["totalHot"] == 0
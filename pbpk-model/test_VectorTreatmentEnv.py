@@ -0,0 +1,68 @@
+import numpy as np
+
+from BatchSolver import BatchSolver
+from Encoder import Encoder
+
+from Patient import Patient
+from Therapy import Therapy
+from TreatmentEnv import TreatmentEnv
+from VectorTreatmentEnv import VectorTreatmentEnv
+
+
+PATIENTS = [Patient(), Patient(BW=62, BSA=1.7, H=0.42, gender="female", GFR=0.09, V_tu=0.2, tumorType="MEN")]
+OPTIONS = {"decisionInterval": 720, "maxSteps": 3, "rtol": 1e-10, "atol": 1e-13}
+
+
+def test_matchesScalarEnvs():
+    ## The batched integration of the patients gives the episodes of one TreatmentEnv per patient
+    actions = np.array([[[50, 5], [100, 10]], [[0, 0], [20, 2]], [[80, 8], [0, 10]]])
+    vectorEnv = VectorTreatmentEnv(patients=PATIENTS, **OPTIONS)
+    envs = [TreatmentEnv(patient=patient, **OPTIONS) for patient in PATIENTS]
+    observations, _ = vectorEnv.reset()
+    initial = observations.copy()
+    np.testing.assert_array_equal(observations, [env.reset()[0] for env in envs])
+
+    for stepActions in actions:
+        observations, rewards, terminated, truncated, info = vectorEnv.step(stepActions)
+        steps = [env.step(action) for env, action in zip(envs, stepActions)]
+        if terminated.any():
+            observations = info["final_observation"]
+        expected = np.array([step[0] for step in steps])
+        np.testing.assert_allclose(observations, expected, rtol=0, atol=1e-8 * np.abs(expected[:, :-1]).max())
+        np.testing.assert_allclose(rewards, [step[1] for step in steps], rtol=1e-8)
+        np.testing.assert_array_equal(terminated, [step[2] for step in steps])
+        assert not truncated.any()
+
+    ## Auto-reset: the returned observations are the first ones of the next episodes
+    np.testing.assert_array_equal(terminated, True)
+    np.testing.assert_array_equal(vectorEnv.getObservation(), initial)
+    np.testing.assert_array_equal(info["final_info"]["totalHot"], [env.totalHot for env in envs])
+
+
+def test_resetDoneReplacesOnlyFinishedPatients():
+    ## With a patientSampler only the finished environments get new patients, whose blocks replace theirs in the
+    ## batch model: the same model as a batch built from scratch, the other encoders are kept
+    def sampler(rng):
+        return Patient(BW=rng.uniform(60, 95), V_tu=rng.uniform(0.05, 0.2))
+
+    env = VectorTreatmentEnv(numEnvs=3, patientSampler=sampler, **OPTIONS)
+    env.reset(seed=0)
+    child = env.fork()
+    encoders = list(env.encoders)
+    SystemMat = env.batch.SystemMat
+    env.step(np.ones((3, 2)))
+    env.resetDone(np.array([True, False, True]))
+
+    assert env.encoders[1] is encoders[1]
+    assert env.encoders[0] is not encoders[0] and env.encoders[2] is not encoders[2]
+    assert env.batch.SystemMat is SystemMat
+    reference = BatchSolver([Encoder(patient, Therapy(0)) for patient in env.patients])
+    for name in ["SystemMat", "JacobianPattern"]:
+        np.testing.assert_array_equal(getattr(env.batch, name).toarray(), getattr(reference, name).toarray())
+    for name in ["kOnPerVolume", "R0", "BigVect"]:
+        np.testing.assert_array_equal(getattr(env.batch, name), getattr(reference, name))
+    np.testing.assert_array_equal(env.X[[0, 2]], reference.BigVect[[0, 2]])
+
+    ## The fork taken before kept the model of its own patients
+    np.testing.assert_array_equal(child.batch.SystemMat.toarray(),
+                                  BatchSolver(encoders).SystemMat.toarray())